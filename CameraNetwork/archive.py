@@ -0,0 +1,509 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Per day archive of captured frames.
+
+The archive replaces the mat/jpg/pkl triplets saved for every exposure by a
+single append only frames file per day. All frames of an archive share the
+same shape and dtype so every frame is stored as a fixed size chunk and
+can be read directly by offset. The frames metadata is kept beside the
+frames file in an append only log, and is exposed as a columnar (pandas)
+table.
+
+The layout of an archived day folder is::
+
+    CAPTURE_PATH/YYYY_MM_DD/frames.bin          <- fixed size frame chunks.
+    CAPTURE_PATH/YYYY_MM_DD/frames_header.json  <- shape and dtype of chunks.
+    CAPTURE_PATH/YYYY_MM_DD/frames_index.pkl    <- log of the frames metadata.
+
+Frames stored in an archive are referenced (e.g. in the ``path`` column of
+the images dataframe) by an "archive reference" of the form
+``<frames file path>::<chunk index>``.
+"""
+from __future__ import division, absolute_import, print_function
+from CameraNetwork.catalog import getCatalog
+from CameraNetwork.compression import loadArray
+import CameraNetwork.global_settings as gs
+import cPickle
+from datetime import datetime
+import glob
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import threading
+import traceback
+import weakref
+
+__all__ = (
+    'DayArchive',
+    'openDayArchive',
+    'forgetDayArchive',
+    'archiveRef',
+    'isArchiveRef',
+    'parseArchiveRef',
+    'loadArchivedFrame',
+    'convertDay'
+)
+
+ARCHIVE_REF_SEP = '::'
+
+INDEX_COLUMNS = (
+    'Time', 'hdr', 'chunk', 'exposure_us', 'gain_db', 'gain_boost',
+    'color_mode', 'longitude', 'latitude', 'altitude', 'serial_num'
+)
+
+
+def archiveRef(frames_path, chunk):
+    """Create a reference string to a frame stored in an archive."""
+
+    return '{}{}{}'.format(frames_path, ARCHIVE_REF_SEP, chunk)
+
+
+def isArchiveRef(path):
+    """Check whether a path is a reference to an archived frame."""
+
+    return path is not None and ARCHIVE_REF_SEP in path
+
+
+def parseArchiveRef(ref):
+    """Split an archive reference to the frames path and chunk index."""
+
+    frames_path, chunk = ref.rsplit(ARCHIVE_REF_SEP, 1)
+    return frames_path, int(chunk)
+
+
+class DayArchive(object):
+    """Append only archive of the frames captured during one day.
+
+    Args:
+        day_path (str): Path to the day folder.
+
+    Note:
+        The shape and dtype of the archive are set by the first frame
+        appended to it. Trying to append a frame with a different shape
+        or dtype raises a ValueError.
+    """
+
+    def __init__(self, day_path):
+
+        self.day_path = day_path
+        self.frames_path = os.path.join(day_path, gs.ARCHIVE_FRAMES_FILENAME)
+        self.header_path = os.path.join(day_path, gs.ARCHIVE_HEADER_FILENAME)
+        self.index_path = os.path.join(day_path, gs.ARCHIVE_INDEX_FILENAME)
+
+        self._lock = threading.RLock()
+
+        self.shape = None
+        self.dtype = None
+        self._records = []
+        self._chunks = {}
+        self._df = None
+        self._index_size = 0
+
+        if os.path.exists(self.header_path):
+            self._load()
+
+    @staticmethod
+    def exists(day_path):
+        """Check whether a day folder holds an archive."""
+
+        return os.path.exists(
+            os.path.join(day_path, gs.ARCHIVE_HEADER_FILENAME))
+
+    @property
+    def chunk_nbytes(self):
+        """Size (in bytes) of a single frame chunk."""
+
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self._records)
+
+    def _load(self):
+        """Load the header and index of an existing archive."""
+
+        with open(self.header_path, 'rb') as f:
+            header = json.load(f)
+
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(str(header['dtype']))
+
+        #
+        # Read the metadata log. Records are appended after their frames,
+        # so the valid records are the leading records with consecutive
+        # chunks that are in the frames file. Reading stops at the first
+        # invalid (e.g. partially written) record.
+        #
+        frames_size = 0
+        if os.path.exists(self.frames_path):
+            frames_size = os.path.getsize(self.frames_path)
+        chunks_num = frames_size // self.chunk_nbytes
+
+        index_size = 0
+        valid_size = 0
+        if os.path.exists(self.index_path):
+            index_size = os.path.getsize(self.index_path)
+            with open(self.index_path, 'rb') as f:
+                while True:
+                    try:
+                        record = cPickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception:
+                        logging.warn(
+                            "Failed reading archive index record in: {}\n{}".format(
+                                self.index_path, traceback.format_exc()))
+                        break
+
+                    if record['chunk'] != len(self._records) or \
+                       record['chunk'] >= chunks_num:
+                        break
+
+                    self._records.append(record)
+                    self._chunks[(record['time'], record['hdr'])] = record['chunk']
+                    valid_size = f.tell()
+
+        #
+        # Drop everything after the valid records (e.g. power loss in the
+        # middle of a write), so that the next append is aligned: frames
+        # without a record and partial chunks are truncated from the frames
+        # file, and invalid records are truncated from the index.
+        #
+        records_size = len(self._records) * self.chunk_nbytes
+        if frames_size != records_size:
+            logging.warn(
+                "Truncating {} bytes of unindexed frames in archive: {}".format(
+                    frames_size - records_size, self.frames_path))
+            with open(self.frames_path, 'r+b') as f:
+                f.truncate(records_size)
+
+        if index_size != valid_size:
+            logging.warn(
+                "Truncating {} bytes of invalid records in archive index: {}".format(
+                    index_size - valid_size, self.index_path))
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+        self._index_size = valid_size
+
+    def _stale(self):
+        """Check whether the archive was changed (e.g. by another process)."""
+
+        if self.shape is None:
+            return os.path.exists(self.header_path)
+
+        if not os.path.exists(self.header_path):
+            return True
+
+        index_size = 0
+        if os.path.exists(self.index_path):
+            index_size = os.path.getsize(self.index_path)
+
+        return index_size != self._index_size
+
+    def reload(self):
+        """Reload the archive if it was changed outside of this object."""
+
+        with self._lock:
+            if not self._stale():
+                return
+
+            self.shape = None
+            self.dtype = None
+            self._records = []
+            self._chunks = {}
+            self._df = None
+            self._index_size = 0
+
+            if os.path.exists(self.header_path):
+                self._load()
+
+    def _create(self, shape, dtype):
+        """Create a new archive."""
+
+        if not os.path.isdir(self.day_path):
+            os.makedirs(self.day_path)
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        with open(self.header_path, 'wb') as f:
+            json.dump(dict(shape=self.shape, dtype=self.dtype.str), f)
+
+    def append(self, img_array, img_data, hdr_i):
+        """Append a frame to the archive.
+
+        Args:
+            img_array (array): The frame.
+            img_data (DataObj): Metadata of the frame.
+            hdr_i (int): Index of the hdr exposure.
+
+        Returns:
+            Reference string of the archived frame.
+        """
+
+        with self._lock:
+            if self.shape is None:
+                self._create(img_array.shape, img_array.dtype)
+
+            if img_array.shape != self.shape or img_array.dtype != self.dtype:
+                raise ValueError(
+                    "Frame (shape: {}, dtype: {}) doesn't match archive (shape: {}, dtype: {})".format(
+                        img_array.shape, img_array.dtype, self.shape, self.dtype))
+
+            chunk = len(self._records)
+
+            #
+            # First write the frame and only then its metadata. This way the
+            # index never points to a frame that was not written.
+            # Note:
+            # The frame is written at the offset of its chunk, overwriting
+            # a frame left without a record by a failed append.
+            #
+            mode = 'r+b' if os.path.exists(self.frames_path) else 'wb'
+            with open(self.frames_path, mode) as f:
+                f.seek(chunk * self.chunk_nbytes)
+                f.truncate()
+                f.write(np.ascontiguousarray(img_array).tobytes())
+
+            record = dict(
+                chunk=chunk,
+                time=img_data.name_time.replace(microsecond=0),
+                hdr=str(hdr_i),
+                data=img_data
+            )
+            with open(self.index_path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                index_size = f.tell()
+                try:
+                    cPickle.dump(record, f, cPickle.HIGHEST_PROTOCOL)
+                except:
+                    f.truncate(index_size)
+                    raise
+                self._index_size = f.tell()
+
+            self._records.append(record)
+            self._chunks[(record['time'], record['hdr'])] = chunk
+            self._df = None
+
+        return archiveRef(self.frames_path, chunk)
+
+    def read(self, chunk):
+        """Read a frame from the archive by its chunk index."""
+
+        if not 0 <= chunk < len(self._records):
+            raise IndexError("Chunk {} not in archive: {}".format(chunk, self.frames_path))
+
+        with open(self.frames_path, 'rb') as f:
+            f.seek(chunk * self.chunk_nbytes)
+            img_array = np.fromfile(f, dtype=self.dtype, count=int(np.prod(self.shape)))
+
+        return img_array.reshape(self.shape)
+
+    def data(self, chunk):
+        """Get the metadata (DataObj) of a frame."""
+
+        return self._records[chunk]['data']
+
+    def seek(self, seek_time, hdr_i):
+        """Get the chunk index of a frame by its time and hdr index."""
+
+        return self._chunks[(seek_time, str(hdr_i))]
+
+    def has(self, seek_time, hdr_i):
+        """Check whether a frame (by its time and hdr index) is archived."""
+
+        return (seek_time, str(hdr_i)) in self._chunks
+
+    @property
+    def index(self):
+        """Columnar table of the frames metadata."""
+
+        with self._lock:
+            if self._df is None:
+                rows = []
+                for record in self._records:
+                    data = record['data']
+                    camera_info = getattr(data, 'camera_info', None) or {}
+                    rows.append((
+                        record['time'],
+                        record['hdr'],
+                        record['chunk'],
+                        getattr(data, 'exposure_us', None),
+                        getattr(data, 'gain_db', None),
+                        getattr(data, 'gain_boost', None),
+                        getattr(data, 'color_mode', None),
+                        getattr(data, 'longitude', None),
+                        getattr(data, 'latitude', None),
+                        getattr(data, 'altitude', None),
+                        camera_info.get('serial_num', None),
+                    ))
+
+                self._df = pd.DataFrame.from_records(rows, columns=INDEX_COLUMNS)
+
+            return self._df
+
+
+#
+# The archives of recently used days are kept open (bounded by
+# ARCHIVE_CACHE_DAYS). Archives that are still referenced (e.g. in the
+# middle of an append) are tracked weakly, so that a day never has two
+# archive objects writing to it.
+#
+_archives = None
+_live_archives = weakref.WeakValueDictionary()
+_archives_lock = threading.Lock()
+
+
+def openDayArchive(day_path):
+    """Get the (shared) archive object of a day folder."""
+
+    global _archives
+
+    day_path = os.path.abspath(day_path)
+    with _archives_lock:
+        if _archives is None:
+            #
+            # Imported here as utils imports this module.
+            #
+            from CameraNetwork.utils import LRUCache
+            _archives = LRUCache(max_items=gs.ARCHIVE_CACHE_DAYS)
+
+        archive = _archives.get(day_path)
+        if archive is None:
+            archive = _live_archives.get(day_path)
+            if archive is None:
+                archive = DayArchive(day_path)
+                _live_archives[day_path] = archive
+            else:
+                archive.reload()
+            _archives.put(day_path, archive)
+        else:
+            archive.reload()
+
+    return archive
+
+
+def forgetDayArchive(day_path):
+    """Drop the archive object of a day folder (e.g. after deleting it)."""
+
+    day_path = os.path.abspath(day_path)
+    with _archives_lock:
+        if _archives is not None:
+            _archives.pop(day_path)
+        _live_archives.pop(day_path, None)
+
+
+def loadArchivedFrame(ref):
+    """Load a frame and its metadata using its archive reference.
+
+    Returns:
+        img_array, img_data
+    """
+
+    frames_path, chunk = parseArchiveRef(ref)
+    archive = openDayArchive(os.path.dirname(frames_path))
+
+    return archive.read(chunk), archive.data(chunk)
+
+
+def convertDay(day_path, remove_files=False):
+    """Migrate a day folder of mat/jpg/pkl files to an archive.
+
+    Args:
+        day_path (str): Path to the day folder.
+        remove_files (bool, optional): Remove the mat and pkl files of
+            frames that were archived. The jpg thumbnails are kept.
+
+    Returns:
+        Number of converted frames.
+
+    Note:
+        Frames that don't match the shape/dtype of the archive are left
+        as mat files.
+    """
+
+    archive = openDayArchive(day_path)
+    converted = 0
+    for mat_path in sorted(glob.glob(os.path.join(day_path, '*.mat'))):
+        base_path = os.path.splitext(mat_path)[0]
+
+        #
+        # Parse the time and hdr index from the file name.
+        #
+        tmp_parts = os.path.split(base_path)[-1].split('_')
+        hdr_i = tmp_parts[-1]
+        name_time = datetime(*[int(i) for i in tmp_parts[1:-1]])
+
+        try:
+            if (name_time, hdr_i) in archive._chunks:
+                continue
+
+            with open(base_path + '.pkl', 'rb') as f:
+                img_data = cPickle.load(f)
+
+            img_array = loadArray(mat_path)
+            archive.append(img_array, img_data, hdr_i)
+        except Exception:
+            logging.warn(
+                "Frame not archived: {}\n{}".format(mat_path, traceback.format_exc()))
+            continue
+
+        converted += 1
+        if remove_files:
+            os.remove(mat_path)
+            os.remove(base_path + '.pkl')
+
+    #
+    # The cached images database and the catalog of the day are no longer
+    # valid.
+    #
+    database_path = os.path.join(day_path, "database.pkl")
+    if os.path.exists(database_path):
+        os.remove(database_path)
+
+    try:
+        date = datetime.strptime(os.path.basename(os.path.abspath(day_path)), "%Y_%m_%d")
+        getCatalog().removeDay(date)
+    except Exception:
+        logging.error("Failed removing day {} from the catalog:\n{}".format(
+            day_path, traceback.format_exc()))
+
+    return converted
@@ -40,10 +40,20 @@ Utilities used in the process of calibration.
 
 from __future__ import print_function
 from __future__ import division
+from CameraNetwork.hdr import HDR_WINDOW
+from CameraNetwork.hdr import HDRMerger
+from CameraNetwork.image_utils import fileHash
 from CameraNetwork.image_utils import raw2RGB, RGB2raw
+from CameraNetwork.utils import LRUCache
 import cPickle
+import cv2
+import glob
+import logging
 import os
 import numpy as np
+import scipy.io as sio
+import threading
+import traceback
 from sklearn.linear_model import RANSACRegressor
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import FunctionTransformer
@@ -57,6 +67,18 @@ __all__ = (
 
 READY_REPLY = 'READY'
 
+#
+# Stored vignetting ratio (keyed by the hash of the model file), and the
+# number of stored ratios kept in a folder (the most recently used).
+#
+VIGNETTING_RATIO_FILENAME = "vignetting_ratio_{}.npz"
+VIGNETTING_RATIO_KEEP = 2
+
+#
+# Shape of subsampled (small size) raw frames.
+#
+SMALL_RAW_SHAPE = (300, 400)
+
 
 class Gimbal(object):
     """Calibration Gimbal
@@ -318,7 +340,8 @@ class VignettingCalibration():
         #
         # By default the vignetting is identity.
         #
-        self._ratio = np.ones((1200, 1600))
+        self._ratio = np.ones((1200, 1600), dtype=np.float32)
+        self._variants = {}
 
     def calibrate(self, color_measurements):
         """Calculate vignetting calibration."""
@@ -371,7 +394,133 @@ class VignettingCalibration():
         # For "Numerical stability" (i.e. exploding img radiance values at the
         # extreme of the image) the minimal ratio limited to 0.1.
         #
-        self._ratio = np.clip(self._ratio, 0.1, 1)
+        self._ratio = np.clip(self._ratio, 0.1, 1).astype(np.float32)
+        self._variants = {}
+
+    def ratioOf(self, shape):
+        """The vignetting ratio of a raw image shape.
+
+        The ratio is calculated for full size (1200x1600) raw images. For
+        other shapes (e.g. the subsampled 300x400 mode) each Bayer plane of
+        the ratio is area resized.
+        """
+
+        shape = tuple(shape[:2])
+        if shape == self.ratio.shape:
+            return self.ratio
+
+        key = ('ratio', shape)
+        if key not in self._variants:
+            planes = [
+                cv2.resize(
+                    plane.astype(np.float32),
+                    (shape[1] // 2, shape[0] // 2),
+                    interpolation=cv2.INTER_AREA)
+                for plane in raw2RGB(self.ratio)]
+            ratio = RGB2raw(*planes).astype(np.float32)
+            ratio.flags.writeable = False
+            self._variants[key] = ratio
+
+        return self._variants[key]
+
+    def reciprocal(self, shape=None):
+        """The (read only, float32) reciprocal of the vignetting ratio.
+
+        Applying vignetting to an image is a multiplication by the
+        reciprocal.
+
+        Args:
+            shape (tuple, optional): Shape of the raw image. Defaults to the
+                full size.
+        """
+
+        if shape is None:
+            shape = self.ratio.shape
+        shape = tuple(shape[:2])
+
+        key = ('reciprocal', shape)
+        if key not in self._variants:
+            reciprocal = (1 / self.ratioOf(shape)).astype(np.float32)
+            reciprocal.flags.writeable = False
+            self._variants[key] = reciprocal
+
+        return self._variants[key]
+
+    def _saveArtifact(self, artifact_path, file_hash):
+        """Store the calculated ratios (see `load`)."""
+
+        try:
+            #
+            # Write to a temporary file and rename, so that a partially
+            # written artifact is never loaded.
+            #
+            tmp_path = artifact_path + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(
+                    f,
+                    hash=file_hash,
+                    ratio=self.ratio,
+                    small_ratio=self.ratioOf(SMALL_RAW_SHAPE)
+                )
+            os.rename(tmp_path, artifact_path)
+        except:
+            logging.error(
+                "Failed saving the vignetting ratio to {}:\n{}".format(
+                    artifact_path, traceback.format_exc()))
+            return
+
+        #
+        # Remove the ratios of older models (e.g. of a replaced vignetting
+        # file), keeping the most recently used.
+        #
+        artifacts = []
+        for path in glob.glob(os.path.join(
+                os.path.dirname(artifact_path),
+                VIGNETTING_RATIO_FILENAME.format('*'))):
+            try:
+                artifacts.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+
+        artifacts = [path for _, path in sorted(artifacts, reverse=True)
+                     if path != artifact_path]
+        for path in artifacts[VIGNETTING_RATIO_KEEP-1:]:
+            try:
+                os.remove(path)
+            except OSError:
+                logging.warn("Failed removing vignetting ratio: {}".format(path))
+
+    def _loadArtifact(self, artifact_path, file_hash):
+        """Load stored ratios. Returns False if not available."""
+
+        if not os.path.exists(artifact_path):
+            return False
+
+        try:
+            data = np.load(artifact_path)
+            if str(data['hash']) != file_hash:
+                return False
+
+            self._ratio = data['ratio'].astype(np.float32)
+            small_ratio = data['small_ratio'].astype(np.float32)
+        except:
+            logging.error(
+                "Failed loading the vignetting ratio from {}:\n{}".format(
+                    artifact_path, traceback.format_exc()))
+            return False
+
+        small_ratio.flags.writeable = False
+        self._variants = {('ratio', small_ratio.shape): small_ratio}
+
+        #
+        # Mark the ratio as recently used (see `_saveArtifact`).
+        #
+        try:
+            os.utime(artifact_path, None)
+        except OSError:
+            pass
+
+        return True
 
     def applyVignetting(self, raw_img, dtype=None):
         """Apply vignetting to an image."""
@@ -382,7 +531,7 @@ class VignettingCalibration():
             #
             dtype = raw_img.dtype
 
-        return (raw_img.astype(np.float) / self._ratio).astype(dtype)
+        return (raw_img * self.reciprocal(raw_img.shape)).astype(dtype)
 
     def save(self, file_path):
         """Save the model."""
@@ -464,13 +613,25 @@ class VignettingCalibration():
 
     @staticmethod
     def load(file_path):
-        """Load model from path."""
+        """Load model from path.
+
+        The ratio calculated from the models is stored next to the model
+        file (keyed by the hash of the file) and loaded by later calls
+        instead of evaluating the models again.
+        """
 
         with open(file_path, 'rb') as f:
             data = cPickle.load(f)
 
         obj = VignettingCalibration(models=data['models'])
-        obj._calcRatio()
+
+        file_hash = fileHash(file_path)
+        artifact_path = os.path.join(
+            os.path.dirname(file_path),
+            VIGNETTING_RATIO_FILENAME.format(file_hash[:16]))
+        if not obj._loadArtifact(artifact_path, file_hash):
+            obj._calcRatio()
+            obj._saveArtifact(artifact_path, file_hash)
 
         return obj
 
@@ -520,3 +681,290 @@ class RadiometricCalibration():
             dtype = img.dtype
 
         return (img.astype(np.float) * self._ratios).astype(dtype)
+
+    @property
+    def ratios(self):
+        """The (red, green, blue) ratios."""
+
+        return self._ratios.ravel()
+
+
+class DarkCalibration():
+    """Model of the dark current.
+
+    The dark level of each pixel is modelled as a linear function of the
+    exposure: offset + slope * exposure_us. The model is fitted (per gain
+    boost) to a stack of dark images and kept as two float32 planes.
+    Materialized dark frames are cached by (gain_boost, exposure_us) as
+    the loop usually repeats the same exposures.
+
+    Args:
+        offsets (dict): Offset plane per gain boost.
+        slopes (dict): Slope plane (per microsecond) per gain boost.
+        cache_size (int, optional): Number of dark frames to cache.
+    """
+
+    def __init__(self, offsets, slopes, cache_size=8):
+
+        self._offsets = offsets
+        self._slopes = slopes
+        self._cache = LRUCache(max_items=cache_size)
+
+    @staticmethod
+    def fit(dark_paths, cache_size=8):
+        """Fit the model to dark images.
+
+        The least squares fit is accumulated one image at a time so that
+        the stack of dark images is never held in memory.
+
+        Args:
+            dark_paths (list): Paths of dark images (.mat files with the
+                keys image, exposure and gain_boost).
+            cache_size (int, optional): Number of dark frames to cache.
+        """
+
+        sums = {}
+        for path in dark_paths:
+            d = sio.loadmat(path)
+            gain_boost = d['gain_boost'][0][0] == 1
+            x = float(d['exposure'][0][0])
+            y = d['image'].astype(np.float64)
+
+            if gain_boost not in sums:
+                sums[gain_boost] = dict(
+                    n=0, x=0., xx=0., y=np.zeros_like(y), xy=np.zeros_like(y))
+            s = sums[gain_boost]
+            s['n'] += 1
+            s['x'] += x
+            s['xx'] += x * x
+            s['y'] += y
+            s['xy'] += x * y
+
+        offsets, slopes = {}, {}
+        for gain_boost, s in sums.items():
+            n = s['n']
+            det = n * s['xx'] - s['x'] ** 2
+            if det <= 0:
+                #
+                # Single exposure. The dark level is taken as constant.
+                #
+                slope = np.zeros_like(s['y'])
+            else:
+                slope = (n * s['xy'] - s['x'] * s['y']) / det
+            offset = (s['y'] - slope * s['x']) / n
+
+            offsets[gain_boost] = offset.astype(np.float32)
+            slopes[gain_boost] = slope.astype(np.float32)
+
+        return DarkCalibration(offsets, slopes, cache_size=cache_size)
+
+    @staticmethod
+    def load(path, cache_size=8):
+        """Fit the model to the dark images in a folder.
+
+        Returns:
+            The model, or None if there are no dark images in the folder.
+        """
+
+        dark_paths = sorted(glob.glob(os.path.join(path, '*.mat')))
+        if not dark_paths:
+            return None
+
+        return DarkCalibration.fit(dark_paths, cache_size=cache_size)
+
+    def darkFrame(self, gain_boost, exposure_us):
+        """Get the (read only) float32 dark frame of an exposure."""
+
+        gain_boost = bool(gain_boost)
+        if gain_boost not in self._offsets:
+            #
+            # Fall back to the other gain boost model.
+            #
+            gain_boost = not gain_boost
+
+        key = (gain_boost, exposure_us)
+        dark_frame = self._cache.get(key)
+        if dark_frame is None:
+            dark_frame = self._slopes[gain_boost] * np.float32(exposure_us)
+            dark_frame += self._offsets[gain_boost]
+            np.maximum(dark_frame, 0, out=dark_frame)
+            dark_frame.flags.writeable = False
+            self._cache.put(key, dark_frame)
+
+        return dark_frame
+
+    def applyDark(self, img, gain_boost, exposure_us, out=None):
+        """Subtract the dark frame from an image.
+
+        Args:
+            img (array): Raw image.
+            gain_boost (bool): Gain boost of the image.
+            exposure_us (int): Exposure of the image.
+            out (array, optional): float32 array to store the result in.
+
+        Returns:
+            float32 image clamped at 0.
+        """
+
+        out = np.subtract(
+            img, self.darkFrame(gain_boost, exposure_us),
+            out=out, dtype=np.float32)
+        np.maximum(out, 0, out=out)
+
+        return out
+
+    @property
+    def stats(self):
+        """Statistics of the dark frames cache."""
+
+        return self._cache.stats
+
+
+class RawPreprocessor():
+    """Fused preprocessing of raw frames.
+
+    Applies dark subtraction, clamping, exposure scaling, vignetting and
+    radiometric scaling in float32 using in place operations. The
+    vignetting and radiometric corrections are both per pixel gains and
+    are folded to a single (cached) gain plane. The radiometric ratios are
+    applied in the Bayer domain, which is equivalent to applying them to
+    the RGB channels after debayering and normalization (both linear).
+
+    Args:
+        dark (DarkCalibration, optional): Dark current model.
+        vignetting (VignettingCalibration, optional): Vignetting model.
+        radiometric (RadiometricCalibration, optional): Radiometric model.
+        hdr_weighting (str, optional): Weighting of the HDR merge (see
+            `HDRMerger`).
+        hdr_tile_rows (int, optional): Tile rows of the HDR merge (see
+            `HDRMerger`).
+    """
+
+    def __init__(self, dark=None, vignetting=None, radiometric=None,
+                 hdr_weighting=HDR_WINDOW, hdr_tile_rows=None):
+
+        self.dark = dark
+        self.vignetting = vignetting
+        self.radiometric = radiometric
+        self.hdr_weighting = hdr_weighting
+        self.hdr_tile_rows = hdr_tile_rows
+
+        self._gains = LRUCache(max_items=4)
+        self._local = threading.local()
+
+    def gainPlane(self, shape, radiometric=True):
+        """Get the (read only) float32 gain plane of a frame shape.
+
+        Args:
+            shape (tuple): Shape of the frame. 2D shapes are raw (Bayer)
+                frames, 3D shapes are RGB frames.
+            radiometric (bool, optional): Include the radiometric ratios.
+        """
+
+        key = (shape, radiometric)
+        gain = self._gains.get(key)
+        if gain is not None:
+            return gain
+
+        if self.vignetting is not None:
+            gain = self.vignetting.reciprocal(shape).copy()
+        else:
+            gain = np.ones(shape[:2], dtype=np.float32)
+
+        if len(shape) == 3:
+            gain = np.repeat(gain[..., np.newaxis], shape[2], axis=2)
+
+        if radiometric and self.radiometric is not None:
+            r, g, b = self.radiometric.ratios.astype(np.float32)
+            if len(shape) == 3:
+                gain *= np.array((r, g, b), dtype=np.float32)
+            else:
+                #
+                # Same Bayer layout as raw2RGB.
+                #
+                gain[::2, ::2] *= r
+                gain[1::2, 0::2] *= g
+                gain[0::2, 1::2] *= g
+                gain[1::2, 1::2] *= b
+
+        gain.flags.writeable = False
+        self._gains.put(key, gain)
+
+        return gain
+
+    def scratch(self, shape):
+        """Get a per thread float32 scratch buffer."""
+
+        buff = getattr(self._local, 'buff', None)
+        if buff is None or buff.shape != shape:
+            buff = np.empty(shape, dtype=np.float32)
+            self._local.buff = buff
+
+        return buff
+
+    def subtractDark(self, img, img_data, subtract_dark=True, out=None):
+        """Convert a frame to float32 and subtract its dark frame."""
+
+        if subtract_dark and self.dark is not None:
+            return self.dark.applyDark(
+                img, img_data.gain_boost, img_data.exposure_us, out=out)
+
+        if out is None:
+            return img.astype(np.float32)
+
+        out[...] = img
+        return out
+
+    def process(
+            self,
+            img_arrays,
+            img_datas,
+            subtract_dark=True,
+            scale=True,
+            radiometric=True,
+            reuse_buffer=False):
+        """Preprocess frames.
+
+        Args:
+            img_arrays (list): Frames. Multiple frames are merged to an HDR
+                frame.
+            img_datas (list): Corresponding frames data.
+            subtract_dark (bool, optional): Subtract the dark frames.
+            scale (bool, optional): Scale a single frame by its exposure (to
+                units of [RGB/ms]). HDR frames are always scaled.
+            radiometric (bool, optional): Apply the radiometric ratios.
+            reuse_buffer (bool, optional): Store the result of a single frame
+                in a per thread scratch buffer. The result is then
+                overwritten by the next call, use it only if the result is
+                consumed (e.g. normalized) before that.
+
+        Returns:
+            float32 frame.
+        """
+
+        if len(img_arrays) == 1:
+            img_array, img_data = img_arrays[0], img_datas[0]
+            out = self.scratch(img_array.shape) if reuse_buffer else None
+            img = self.subtractDark(img_array, img_data, subtract_dark, out=out)
+            if scale:
+                img *= np.float32(1000 / img_data.exposure_us)
+        else:
+            #
+            # The frames are merged one at a time (through the scratch
+            # buffer) so only the merge planes are kept in memory.
+            #
+            img_exposures = [img_data.exposure_us / 1000 for img_data in img_datas]
+            merger = HDRMerger(
+                img_exposures,
+                weighting=self.hdr_weighting,
+                tile_rows=self.hdr_tile_rows
+            )
+            for img_array, img_data, img_exposure in zip(img_arrays, img_datas, img_exposures):
+                frame = self.subtractDark(
+                    img_array, img_data, subtract_dark, out=self.scratch(img_array.shape))
+                merger.add(frame, img_exposure)
+            img = merger.result()
+
+        img *= self.gainPlane(img.shape, radiometric)
+
+        return img
@@ -0,0 +1,331 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Registry of the camera calibrations.
+
+The calibrations are stored in the repository under
+``data/calibration/<serial_num>/<date>``. The registry indexes these
+folders once and keeps the fully built calibration bundles (fisheye model,
+normalization, vignetting and radiometric calibration) in an LRU, so that
+switching between cameras or calibration dates (e.g. seeking across days in
+a local server) does not reload them.
+"""
+from __future__ import division
+import bisect
+from CameraNetwork.archive import DayArchive
+from CameraNetwork.archive import openDayArchive
+from CameraNetwork.calibration import RadiometricCalibration
+from CameraNetwork.calibration import VignettingCalibration
+import CameraNetwork.global_settings as gs
+from CameraNetwork.image_utils import FisheyeProxy
+from CameraNetwork.image_utils import Normalization
+from CameraNetwork.utils import DataObj
+from CameraNetwork.utils import LRUCache
+import cPickle
+from datetime import datetime
+import filecmp
+import fisheye
+import glob
+import logging
+import numpy as np
+import os
+import pkg_resources
+import shutil
+import threading
+import traceback
+
+__all__ = (
+    'CalibrationRegistry',
+)
+
+
+class CalibrationRegistry(object):
+    """Index and cache of the camera calibrations.
+
+    Args:
+        base_path (str, optional): Base folder of the calibrations. Defaults
+            to the ``data/calibration`` folder of the package.
+        max_bundles (int, optional): Number of built calibration bundles to
+            keep.
+    """
+
+    def __init__(self, base_path=None, max_bundles=4):
+
+        if base_path is None:
+            base_path = pkg_resources.resource_filename(__name__, '../data/calibration/')
+        self.base_path = base_path
+
+        self._index = None
+        self._bundles = LRUCache(max_items=max_bundles)
+        self._day_serials = {}
+        self._lock = threading.RLock()
+
+    def _indexCalibrations(self):
+        """Index the calibration dates of all the cameras (once)."""
+
+        with self._lock:
+            if self._index is not None:
+                return self._index
+
+            index = {}
+            for serial_path in glob.glob(os.path.join(self.base_path, '*')):
+                if not os.path.isdir(serial_path):
+                    continue
+
+                dates, paths = [], []
+                for path in sorted(glob.glob(os.path.join(serial_path, "20*"))):
+                    try:
+                        dates.append(datetime.strptime(os.path.split(path)[-1], "%Y_%m_%d"))
+                        paths.append(path)
+                    except ValueError:
+                        logging.warn("Ignoring calibration folder: {}".format(path))
+
+                index[os.path.basename(serial_path)] = (dates, paths)
+
+            self._index = index
+
+            return index
+
+    def calibrationPath(self, serial_num, capture_date=None):
+        """Get the calibration path of a camera at some date.
+
+        Args:
+            serial_num (str): Serial number of the sensor.
+            capture_date (datetime, optional): Date of capture. None means
+                the most updated calibration (live capture).
+
+        Returns:
+            base_calibration_path, calibration_path
+        """
+
+        base_calibration_path = os.path.join(self.base_path, serial_num)
+
+        dates, paths = self._indexCalibrations().get(serial_num, ([], []))
+        if len(paths) == 0:
+            return base_calibration_path, base_calibration_path
+
+        if capture_date is None:
+            calibration_index = -1
+        else:
+            calibration_index = bisect.bisect(dates, capture_date) - 1
+
+        return base_calibration_path, paths[calibration_index]
+
+    def daySerial(self, capture_date):
+        """Get the serial number of the camera that captured some day.
+
+        The serial number is read from the data of the last image of the
+        day (this handles the case that the sensor was replaced during the
+        day). Past days are cached.
+        """
+
+        day = capture_date.strftime("%Y_%m_%d")
+        if day in self._day_serials:
+            return self._day_serials[day]
+
+        day_path = os.path.join(gs.CAPTURE_PATH, day)
+        serial_num = None
+        datas_list = sorted(glob.glob(os.path.join(day_path, '*.pkl')))
+        for data_path in datas_list[::-1]:
+            try:
+                with open(data_path, "rb") as f:
+                    data = cPickle.load(f)
+                serial_num = data.camera_info["serial_num"]
+                logging.debug(
+                    "Serial number {} taken from: {}".format(serial_num, data_path)
+                )
+                break
+            except:
+                pass
+
+        if serial_num is None and DayArchive.exists(day_path):
+            #
+            # The day was stored in an archive.
+            #
+            archive = openDayArchive(day_path)
+            if len(archive) > 0:
+                serial_num = archive.data(len(archive) - 1).camera_info["serial_num"]
+                logging.debug(
+                    "Serial number {} taken from archive: {}".format(
+                        serial_num, archive.frames_path)
+                )
+
+        if serial_num is not None and day != datetime.utcnow().strftime("%Y_%m_%d"):
+            self._day_serials[day] = serial_num
+
+        return serial_num
+
+    def bundle(self, serial_num, capture_date=None):
+        """Get the calibration bundle of a camera at some date.
+
+        Returns:
+            DataObj with the attributes: calibration_path,
+            base_calibration_path, fe (fisheye model or None), intrinsic_path,
+            normalization (or None), default_R, vignetting and radiometric.
+
+        Note:
+            The bundles are shared. The rotation of the normalization should
+            be set by the user before normalizing (e.g. to the extrinsic
+            calibration of a day, or to the read only default_R).
+        """
+
+        base_calibration_path, calibration_path = \
+            self.calibrationPath(serial_num, capture_date)
+
+        with self._lock:
+            bundle = self._bundles.get(calibration_path)
+            if bundle is None:
+                bundle = self._build(base_calibration_path, calibration_path)
+                self._bundles.put(calibration_path, bundle)
+
+        return bundle
+
+    def invalidate(self):
+        """Drop the built bundles (after the calibration was changed)."""
+
+        self._bundles.clear()
+
+    @property
+    def stats(self):
+        """Hit/miss counters of the bundles cache."""
+
+        return self._bundles.stats
+
+    def _build(self, base_calibration_path, calibration_path):
+        """Load and build the calibration of a calibration path."""
+
+        logging.debug("Building calibration of: {}".format(calibration_path))
+
+        #
+        # Check if the data exists in the data folder of the code.
+        # If so, the data is copied to the home folder.
+        # Note:
+        # This is done to support old cameras that were not calibrated
+        # using the test bench. Files are copied only when changed, so that
+        # the modification times of the settings (see
+        # `Controller.calibrationVersion`) are not changed.
+        #
+        if os.path.exists(base_calibration_path):
+            for base_path, file_name, dst_path in zip(
+                    (calibration_path, calibration_path, base_calibration_path),
+                    (gs.INTRINSIC_SETTINGS_FILENAME, gs.VIGNETTING_SETTINGS_FILENAME, gs.RADIOMETRIC_SETTINGS_FILENAME),
+                    (gs.INTRINSIC_SETTINGS_PATH, gs.VIGNETTING_SETTINGS_PATH, gs.RADIOMETRIC_SETTINGS_PATH)
+            ):
+                src_path = os.path.join(base_path, file_name)
+                try:
+                    if os.path.exists(dst_path) and \
+                            filecmp.cmp(src_path, dst_path, shallow=False):
+                        continue
+                    shutil.copyfile(src_path, dst_path)
+                except Exception as e:
+                    logging.error("Failed copying calibration data: {}\n{}".format(
+                        file_name, traceback.format_exc()))
+
+        #
+        # Try to load calibration data.
+        #
+        fe = None
+        intrinsic_path = None
+        ocam_path = os.path.join(calibration_path, "ocamcalib.pkl")
+        logging.info("Will search for ocamcalib in path: {}".format(ocam_path))
+        if os.path.exists(ocam_path):
+            #
+            # Found an ocamcalib model load it.
+            #
+            logging.info("Loading an ocamcalib model from: {}".format(ocam_path))
+            with open(ocam_path, "rb") as f:
+                fe = cPickle.load(f)
+            intrinsic_path = ocam_path
+        elif os.path.exists(gs.INTRINSIC_SETTINGS_PATH):
+            #
+            # Found an opencv2 fisheye model.
+            #
+            logging.info("Loading a standard opencv fisheye model")
+            fe = fisheye.load_model(
+                gs.INTRINSIC_SETTINGS_PATH, calib_img_shape=(1200, 1600))
+            intrinsic_path = gs.INTRINSIC_SETTINGS_PATH
+
+        #
+        # Load the default extrinsic calibration.
+        #
+        default_R = np.eye(3)
+        if os.path.exists(gs.EXTRINSIC_SETTINGS_PATH):
+            default_R = np.load(gs.EXTRINSIC_SETTINGS_PATH)
+        default_R.setflags(write=False)
+
+        if fe is not None:
+            #
+            # Creating the normalization object.
+            #
+            normalization = Normalization(
+                gs.DEFAULT_NORMALIZATION_SIZE, FisheyeProxy(fe), Rot=default_R,
+                calibration_path=intrinsic_path
+            )
+        else:
+            normalization = None
+
+        #
+        # Load vignetting settings.
+        #
+        try:
+            vignetting = VignettingCalibration.load(gs.VIGNETTING_SETTINGS_PATH)
+        except:
+            vignetting = VignettingCalibration()
+            logging.error(
+                "Failed loading vignetting data:\n{}".format(
+                    traceback.format_exc()))
+
+        #
+        # Load radiometric calibration.
+        #
+        try:
+            radiometric = RadiometricCalibration.load(gs.RADIOMETRIC_SETTINGS_PATH)
+        except:
+            radiometric = RadiometricCalibration(gs.DEFAULT_RADIOMETRIC_SETTINGS)
+            logging.debug("Failed loading radiometric data. Will use the default values.")
+
+        return DataObj(
+            calibration_path=calibration_path,
+            base_calibration_path=base_calibration_path,
+            fe=fe,
+            intrinsic_path=intrinsic_path,
+            normalization=normalization,
+            default_R=default_R,
+            vignetting=vignetting,
+            radiometric=radiometric
+        )
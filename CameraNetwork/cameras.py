@@ -39,6 +39,7 @@ from CameraNetwork.utils import CameraException
 import logging
 import numpy as np
 import os
+import time
 
 
 DEFAULT_IDS_SETTINGS = {
@@ -52,6 +53,133 @@ DEFAULT_IDS_SETTINGS = {
 #
 IDS_MAX_PIXEL_CLOCK = 25
 
+#
+# Frame sizes (width, height).
+#
+SMALL_SIZE = 'small'
+LARGE_SIZE = 'large'
+FRAME_SIZES = {
+    SMALL_SIZE: (400, 300),
+    LARGE_SIZE: (1600, 1200),
+}
+
+
+class FrameAccumulator(object):
+    """Streaming accumulator of captured frames.
+
+    Frames are summed into a preallocated buffer as they arrive, so that
+    the memory used is constant regardless of the number of frames.
+    Integer frames are summed into a uint32 buffer, float frames into a
+    float32 buffer. Optionally a running (Welford) variance is kept for
+    noise estimation.
+
+    Args:
+        variance (bool, optional): Keep a running variance of the frames.
+
+    Note:
+        The buffers are reused between captures. `mean` and `variance`
+        return new arrays that are safe to keep.
+    """
+
+    def __init__(self, variance=False):
+
+        self.track_variance = variance
+        self.count = 0
+        self.shape = None
+        self.dtype = None
+        self._sum = None
+        self._mean = None
+        self._m2 = None
+        self._scratch = None
+        self._delta = None
+
+    def _allocate(self, frame):
+        """Allocate the buffers for the frame shape and type."""
+
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        if np.issubdtype(frame.dtype, np.integer):
+            sum_dtype = np.uint32
+        else:
+            sum_dtype = np.float32
+
+        self._sum = np.zeros(frame.shape, dtype=sum_dtype)
+        if self.track_variance:
+            self._mean = np.zeros(frame.shape, dtype=np.float32)
+            self._m2 = np.zeros(frame.shape, dtype=np.float32)
+            self._scratch = np.empty(frame.shape, dtype=np.float32)
+            self._delta = np.empty(frame.shape, dtype=np.float32)
+        else:
+            self._mean = self._m2 = self._scratch = self._delta = None
+
+    def reset(self):
+        """Reset the accumulator (the buffers are kept)."""
+
+        self.count = 0
+        if self._sum is not None:
+            self._sum.fill(0)
+        if self._mean is not None:
+            self._mean.fill(0)
+            self._m2.fill(0)
+
+    def add(self, frame):
+        """Add a frame to the accumulator."""
+
+        if self._sum is None or self.shape != frame.shape or \
+           self.dtype != frame.dtype or \
+           (self.track_variance and self._mean is None):
+            if self.count > 0:
+                raise ValueError(
+                    "Frame shape/type {}/{} differs from accumulated {}/{}".format(
+                        frame.shape, frame.dtype, self.shape, self.dtype))
+            self._allocate(frame)
+
+        self.count += 1
+        np.add(self._sum, frame, out=self._sum, casting='unsafe')
+
+        if self.track_variance:
+            #
+            # Welford update:
+            # mean += (x - mean) / n
+            # m2 += (x - mean_old) * (x - mean_new)
+            #
+            delta, scratch = self._delta, self._scratch
+            np.subtract(frame, self._mean, out=delta, casting='unsafe')
+            np.multiply(delta, np.float32(1 / self.count), out=scratch)
+            self._mean += scratch
+            np.subtract(frame, self._mean, out=scratch, casting='unsafe')
+            delta *= scratch
+            self._m2 += delta
+
+    def mean(self):
+        """Return the mean of the accumulated frames.
+
+        A single integer frame is returned in its original type. Otherwise
+        the mean is returned as float32.
+        """
+
+        if self.count == 0:
+            raise ValueError("No frames were accumulated.")
+
+        if self.count == 1:
+            return self._sum.astype(self.dtype)
+
+        out = np.empty(self.shape, dtype=np.float32)
+        np.multiply(
+            self._sum, np.float32(1 / self.count), out=out, casting='unsafe')
+        return out
+
+    def variance(self, ddof=1):
+        """Return the (float32) per pixel variance of the accumulated frames."""
+
+        if not self.track_variance:
+            raise ValueError("The accumulator does not track the variance.")
+
+        if self.count <= ddof:
+            return np.zeros(self.shape, dtype=np.float32)
+
+        return self._m2 / np.float32(self.count - ddof)
+
 
 class IDSCamera(object):
     """A wrapper for the IDS cameras"""
@@ -93,6 +221,20 @@ class IDSCamera(object):
         #
         self._last_settings = None
 
+        #
+        # Accumulator used for streaming multi-frame captures.
+        #
+        self._accumulator = FrameAccumulator()
+
+        #
+        # Current frame size and the latency of the size switches.
+        #
+        self._size = LARGE_SIZE
+        self._switch_stats = dict(
+            (size, dict(switches=0, seconds=0., last_seconds=0.))
+            for size in FRAME_SIZES
+        )
+
     def close(self):
         """Close the camera"""
 
@@ -122,36 +264,69 @@ class IDSCamera(object):
 
         return self.capture_dev.info.copy()
 
-    def small_size(self):
-        """Set small frame size."""
+    @property
+    def switch_stats(self):
+        """Flat dict of the frame size switch statistics."""
 
-        logging.debug('Setting camera to small size')
-        self.capture_dev.subsampling = \
-            ids.ids_core.SUBSAMPLING_4X_HORIZONTAL | ids.ids_core.SUBSAMPLING_4X_VERTICAL
+        stats = {}
+        for size, size_stats in self._switch_stats.items():
+            for k, v in size_stats.items():
+                stats['{}_{}'.format(size, k)] = v
+
+        return stats
+
+    def _set_size(self, size, subsampling):
+        """Switch the frame size of the camera.
+
+        Note:
+            The driver image memory is owned by the ids wrapper and has to be
+            reallocated for the new size. Instead of throwing away a frame
+            here (captured with throwaway settings, which would force yet
+            another throwaway frame on the next capture), the next capture
+            is marked to throw away its first frame.
+        """
+
+        t0 = time.time()
+
+        logging.debug('Setting camera to {} size'.format(size))
+        self.capture_dev.subsampling = subsampling
         logging.debug('Free up memory')
         self.capture_dev.free_all()
-        self.capture_dev.width = 400
-        self.capture_dev.height = 300
+        self.capture_dev.width, self.capture_dev.height = FRAME_SIZES[size]
         logging.debug('Allocating memory')
         self.capture_dev._allocate_memory()
-        _ = self.capture({"exposure_us": 50})
+
+        self._last_settings = None
+        self._size = size
+
+        dt = time.time() - t0
+        stats = self._switch_stats[size]
+        stats['switches'] += 1
+        stats['seconds'] += dt
+        stats['last_seconds'] = dt
+        logging.debug('Switched to {} size in {:.3f} secs.'.format(size, dt))
+
+    def small_size(self):
+        """Set small frame size."""
+
+        if self._size == SMALL_SIZE:
+            logging.debug('Camera is already set to small size.')
+            return
+
+        self._set_size(
+            SMALL_SIZE,
+            ids.ids_core.SUBSAMPLING_4X_HORIZONTAL | ids.ids_core.SUBSAMPLING_4X_VERTICAL
+        )
 
     def large_size(self):
         """Set large frame size."""
 
         if self.capture_dev.subsampling == ids.ids_core.SUBSAMPLING_DISABLE:
             logging.debug('Camera is already set to large size.')
+            self._size = LARGE_SIZE
             return
 
-        logging.debug('Setting camera to large size')
-        self.capture_dev.subsampling = ids.ids_core.SUBSAMPLING_DISABLE
-        logging.debug('Free up memory')
-        self.capture_dev.free_all()
-        self.capture_dev.width = 1600
-        self.capture_dev.height = 1200
-        logging.debug('Allocating memory')
-        self.capture_dev._allocate_memory()
-        _ = self.capture({"exposure_us": 50})
+        self._set_size(LARGE_SIZE, ids.ids_core.SUBSAMPLING_DISABLE)
 
     def update_settings(self, new_settings={}):
         """Update capture settings of the camera.
@@ -238,11 +413,33 @@ class IDSCamera(object):
 
         return True
 
-    def capture(self, settings, frames_num=1):
+    def capture(self, settings, frames_num=1, accumulate=False, variance=False):
+        """Capture frames.
+
+        Args:
+            settings (dict): Capture settings.
+            frames_num (int, optional): Number of frames to capture.
+            accumulate (bool, optional): Sum the frames into a preallocated
+                accumulator as they arrive instead of stacking them. The
+                memory used is then independent of frames_num.
+            variance (bool, optional): When accumulating, keep also a
+                running variance of the frames.
+
+        Returns:
+            frames, exposure_us, gain_db. When accumulate is False, frames is
+            the stacked frames (along the last axis). Otherwise it is a
+            `FrameAccumulator` (which is reused by the next capture).
+        """
 
         if self.capture_dev is None:
             raise Exception('Failed to init the capture device (in class constructor).')
 
+        if accumulate:
+            accumulator = self._accumulator
+            if accumulator.track_variance != variance:
+                accumulator = self._accumulator = FrameAccumulator(variance)
+            accumulator.reset()
+
         try:
             if self.update_settings(settings):
                 #
@@ -260,11 +457,22 @@ class IDSCamera(object):
             for i in range(frames_num):
                 logging.debug('Capturing frame {}.'.format(i))
                 img_array, meta_data = self.capture_dev.next()
-                img_arrays.append(img_array)
+                if accumulate:
+                    accumulator.add(img_array)
+                else:
+                    img_arrays.append(img_array)
                 logging.debug('Finished capturing frame {}.'.format(i))
         finally:
             self.capture_dev.continuous_capture = False
 
+        if accumulate:
+            if self._callback is not None:
+                self._callback(
+                    accumulator.mean(), self.capture_dev.exposure * 1e3,
+                    self.capture_dev.gain)
+
+            return accumulator, self.capture_dev.exposure * 1e3, self.capture_dev.gain
+
         #
         # Concatenate the frames.
         #
@@ -0,0 +1,347 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Persistent catalog of captured frames.
+
+The catalog is an SQLite database that is updated by the controller as
+each frame is saved. It holds the time, hdr index, exposure, gain, serial
+number and location of every frame, so that querying the captured images
+(of one or more days) never has to touch the image files.
+"""
+from __future__ import division, absolute_import, print_function
+import CameraNetwork.global_settings as gs
+from datetime import datetime
+from datetime import timedelta
+import logging
+import pandas as pd
+import sqlite3
+import threading
+
+__all__ = (
+    'CaptureCatalog',
+    'getCatalog'
+)
+
+DAY_FORMAT = "%Y_%m_%d"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+FRAME_COLUMNS = (
+    'Time', 'hdr', 'path', 'longitude', 'latitude', 'altitude', 'serial_num',
+    'exposure_us', 'gain_db', 'gain_boost', 'color_mode'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    time TEXT NOT NULL,
+    hdr TEXT NOT NULL,
+    day TEXT NOT NULL,
+    path TEXT NOT NULL,
+    longitude REAL,
+    latitude REAL,
+    altitude REAL,
+    serial_num TEXT,
+    exposure_us REAL,
+    gain_db REAL,
+    gain_boost INTEGER,
+    color_mode TEXT,
+    PRIMARY KEY (time, hdr)
+);
+CREATE INDEX IF NOT EXISTS frames_day ON frames (day);
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,
+    frames INTEGER
+);
+"""
+
+
+def _day(date):
+    return date.strftime(DAY_FORMAT)
+
+
+class CaptureCatalog(object):
+    """Catalog of captured frames.
+
+    Args:
+        path (str): Path to the SQLite database file.
+
+    Note:
+        The ``days`` table lists the days for which the catalog is complete,
+        i.e. days that were cataloged since their first frame or that were
+        indexed from the day folder. Queries of other days should be
+        completed by scanning the day folder (see `utils.getImagesDF`).
+        Each complete day also stores the number of frames saved in its
+        folder (mat files and archived frames, including duplicates). A day
+        whose folder holds a different number of frames (e.g. a day that
+        was rewritten by another tool) is not complete.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self._lock = threading.Lock()
+
+        #
+        # Number of frames added per day (by this process). Used for
+        # detecting frames added while a day is indexed (see `indexDay`).
+        #
+        self._adds = {}
+
+        #
+        # The connection is shared between the capture threads and the
+        # server thread. Access is serialized using the lock.
+        #
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+
+            #
+            # Catalogs created before the days had a frames count. Their
+            # days are indexed again on the first query.
+            #
+            columns = [r[1] for r in self._conn.execute("PRAGMA table_info(days)")]
+            if 'frames' not in columns:
+                self._conn.execute("ALTER TABLE days ADD COLUMN frames INTEGER")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _frame_row(path, img_data, hdr_i):
+        """Convert a frame data object to a catalog row."""
+
+        name_time = img_data.name_time.replace(microsecond=0)
+        camera_info = getattr(img_data, 'camera_info', None) or {}
+        gain_boost = getattr(img_data, 'gain_boost', None)
+
+        return (
+            name_time.strftime(TIME_FORMAT),
+            str(hdr_i),
+            _day(name_time),
+            path,
+            getattr(img_data, 'longitude', None),
+            getattr(img_data, 'latitude', None),
+            getattr(img_data, 'altitude', None),
+            camera_info.get('serial_num', None),
+            getattr(img_data, 'exposure_us', None),
+            getattr(img_data, 'gain_db', None),
+            None if gain_boost is None else int(gain_boost),
+            getattr(img_data, 'color_mode', None),
+        )
+
+    def add(self, path, img_data, hdr_i, new_day=False):
+        """Add a saved frame to the catalog.
+
+        Args:
+            path (str): Path (or archive reference) of the saved frame.
+            img_data (DataObj): Data object of the frame.
+            hdr_i (int): Index of the hdr exposure.
+            new_day (bool, optional): The frame is the first frame of its
+                day. The day is marked as complete.
+        """
+
+        row = self._frame_row(path, img_data, hdr_i)
+        day = row[2]
+        with self._lock, self._conn:
+            self._adds[day] = self._adds.get(day, 0) + 1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                row
+            )
+            if new_day:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO days VALUES (?,?)", (day, 1))
+            else:
+                self._conn.execute(
+                    "UPDATE days SET frames=frames+1 WHERE day=?", (day,))
+
+    def addsCount(self, date):
+        """Number of frames added to a day (see `indexDay`)."""
+
+        with self._lock:
+            return self._adds.get(_day(date), 0)
+
+    def indexDay(self, date, images_df, frames_num=None, adds_count=None):
+        """Replace the catalog of a day by an images dataframe.
+
+        Args:
+            date (datetime): The indexed day.
+            images_df (DataFrame): Images dataframe (as created by
+                `utils.getImagesDF`) of the day.
+            frames_num (int, optional): Number of frames in the day folder
+                that the dataframe was created from. None means that the day
+                is not marked as complete.
+            adds_count (int, optional): `addsCount` of the day before the
+                day folder was scanned.
+
+        Note:
+            If frames were added to the day since its folder was scanned
+            (adds_count changed), they might be missing from the dataframe.
+            The dataframe is then only merged into the catalog and the day
+            is not marked as complete, so that it is scanned again.
+        """
+
+        day = _day(date)
+        rows = []
+        for (t, hdr), row in images_df.iterrows():
+            rows.append((
+                pd.Timestamp(t).strftime(TIME_FORMAT),
+                str(hdr),
+                day,
+                row['path'],
+                row['longitude'],
+                row['latitude'],
+                row['altitude'],
+                row['serial_num'],
+                row.get('exposure_us', None),
+                row.get('gain_db', None),
+                row.get('gain_boost', None),
+                row.get('color_mode', None),
+            ))
+
+        with self._lock, self._conn:
+            if adds_count is not None and self._adds.get(day, 0) != adds_count:
+                logging.debug(
+                    "Frames added to day {} while indexing it.".format(day))
+                frames_num = None
+            else:
+                self._conn.execute("DELETE FROM frames WHERE day=?", (day,))
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                rows
+            )
+
+            if frames_num is None:
+                self._conn.execute("DELETE FROM days WHERE day=?", (day,))
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO days VALUES (?,?)", (day, frames_num))
+
+    def invalidateDay(self, date):
+        """Mark the catalog of a day as not complete.
+
+        The frames of the day are kept, but the next query of the day
+        scans its folder (see `utils.getImagesDF`).
+        """
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM days WHERE day=?", (_day(date),))
+
+    def removeDay(self, date):
+        """Remove a day from the catalog."""
+
+        day = _day(date)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM frames WHERE day=?", (day,))
+            self._conn.execute("DELETE FROM days WHERE day=?", (day,))
+
+    def hasDay(self, date, frames_num=None):
+        """Check whether the catalog of a day is complete.
+
+        Args:
+            date (datetime): The day.
+            frames_num (int, optional): Number of frames in the day folder.
+                If given, the day is complete only if the catalog was
+                created from the same number of frames.
+        """
+
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT frames FROM days WHERE day=?", (_day(date),))
+            row = cur.fetchone()
+
+        if row is None:
+            return False
+
+        return frames_num is None or row[0] == frames_num
+
+    def days(self):
+        """List the days that have frames in the catalog."""
+
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT DISTINCT day FROM frames ORDER BY day")
+            return [r[0] for r in cur.fetchall()]
+
+    def query(self, start_date, end_date=None):
+        """Query the frames captured in a range of days.
+
+        Args:
+            start_date (datetime): First day to query.
+            end_date (datetime, optional): Last day (inclusive) to query.
+                Defaults to start_date.
+
+        Returns:
+            Database of images in the form of a pandas dataframe, indexed
+            by Time and hdr (same as `utils.getImagesDF`).
+        """
+
+        if end_date is None:
+            end_date = start_date
+
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT time, hdr, path, longitude, latitude, altitude, "
+                "serial_num, exposure_us, gain_db, gain_boost, color_mode "
+                "FROM frames WHERE day BETWEEN ? AND ? ORDER BY time, hdr",
+                (_day(start_date), _day(end_date))
+            )
+            rows = cur.fetchall()
+
+        df = pd.DataFrame.from_records(rows, columns=FRAME_COLUMNS)
+        df['Time'] = pd.to_datetime(df['Time'], format=TIME_FORMAT)
+
+        return df.set_index(['Time', 'hdr']).sort_index()
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def getCatalog():
+    """Get the catalog of the current capture path."""
+
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None or _catalog.path != gs.CATALOG_PATH:
+            logging.debug("Opening capture catalog: {}".format(gs.CATALOG_PATH))
+            _catalog = CaptureCatalog(gs.CATALOG_PATH)
+
+        return _catalog
@@ -0,0 +1,347 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compression codecs for stored arrays and network replies.
+
+A codec is a compressor (zlib, bz2, lzma or raw) with an optional level and
+a chain of filters applied to the array bytes before compression:
+
+    delta   - Difference of neighbouring pixels of the same Bayer color
+              (integer arrays only).
+    shuffle - Byte shuffle, i.e. group the bytes by their significance.
+
+Codecs are specified by dicts (as stored in the capture settings), e.g.
+``{"name": "zlib", "level": 1, "filters": ["delta"]}``, or by strings of the
+form ``name[:level][:filter+filter]``, e.g. ``"zlib:1:delta+shuffle"``.
+A None spec means the legacy mat file (zlib) compression.
+"""
+from __future__ import division
+import bz2
+import json
+import numpy as np
+import scipy.io as sio
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+__all__ = (
+    'Codec',
+    'decodeBuffer',
+    'encodeBuffer',
+    'loadArray',
+    'saveArray'
+)
+
+COMPRESSORS = ('raw', 'zlib', 'bz2', 'lzma')
+FILTERS = ('delta', 'shuffle')
+
+#
+# Magic of a codec encoded buffer.
+#
+BUFFER_MAGIC = b'CNCODEC1'
+
+
+class Codec(object):
+    """Compression codec.
+
+    Args:
+        name (str, optional): Compressor name (raw, zlib, bz2, lzma).
+        level (int, optional): Compression level. None means the default
+            level of the compressor.
+        filters (list, optional): Filters applied (in order) before the
+            compression.
+        delta_stride (int, optional): Stride of the delta filter. The
+            default (2) takes the difference between pixels of the same
+            Bayer color.
+    """
+
+    def __init__(self, name='zlib', level=None, filters=(), delta_stride=2):
+
+        if name not in COMPRESSORS:
+            raise ValueError("Unknown compressor: {}".format(name))
+        if name == 'lzma' and lzma is None:
+            raise ValueError("The lzma compressor is not available.")
+        for f in filters:
+            if f not in FILTERS:
+                raise ValueError("Unknown filter: {}".format(f))
+        if len(set(filters)) != len(filters) or \
+           ('shuffle' in filters and filters[-1] != 'shuffle'):
+            raise ValueError(
+                "Filters should be unique, shuffle last: {}".format(filters))
+
+        self.name = name
+        self.level = level
+        self.filters = tuple(filters)
+        self.delta_stride = delta_stride
+
+    @classmethod
+    def fromSpec(cls, spec):
+        """Create a codec from a dict or string spec.
+
+        Returns:
+            Codec, or None for a None spec (legacy compression).
+        """
+
+        if spec is None or isinstance(spec, Codec):
+            return spec
+
+        if isinstance(spec, basestring):
+            parts = spec.split(':')
+            kwds = dict(name=parts[0])
+            if len(parts) > 1 and parts[1]:
+                kwds['level'] = int(parts[1])
+            if len(parts) > 2 and parts[2]:
+                kwds['filters'] = parts[2].split('+')
+            spec = kwds
+
+        spec = dict((str(k), v) for k, v in spec.items())
+
+        return cls(**spec)
+
+    @property
+    def spec(self):
+        """Dict spec of the codec."""
+
+        return dict(
+            name=self.name,
+            level=self.level,
+            filters=list(self.filters),
+            delta_stride=self.delta_stride
+        )
+
+    def forDtype(self, dtype):
+        """Get the codec to use for arrays of some dtype.
+
+        The delta filter supports only integer arrays. For other arrays a
+        copy of the codec without the delta filter is returned.
+        """
+
+        if 'delta' not in self.filters or np.issubdtype(dtype, np.integer):
+            return self
+
+        return Codec(
+            name=self.name,
+            level=self.level,
+            filters=[f for f in self.filters if f != 'delta'],
+            delta_stride=self.delta_stride
+        )
+
+    def __repr__(self):
+
+        return "{}{}{}".format(
+            self.name,
+            '' if self.level is None else ':{}'.format(self.level),
+            ':' + '+'.join(self.filters) if self.filters else ''
+        )
+
+    #
+    # Compressors.
+    #
+    def compress(self, data):
+        """Compress a bytes string."""
+
+        if self.name == 'raw':
+            return data
+        if self.name == 'zlib':
+            return zlib.compress(data, 6 if self.level is None else self.level)
+        if self.name == 'bz2':
+            return bz2.compress(data, 9 if self.level is None else self.level)
+
+        return lzma.compress(data, preset=6 if self.level is None else self.level)
+
+    def decompress(self, data):
+        """Decompress a bytes string."""
+
+        if self.name == 'raw':
+            return data
+        if self.name == 'zlib':
+            return zlib.decompress(data)
+        if self.name == 'bz2':
+            return bz2.decompress(data)
+
+        return lzma.decompress(data)
+
+    #
+    # Filters.
+    #
+    def _delta(self, arr):
+
+        if not np.issubdtype(arr.dtype, np.integer):
+            raise ValueError("The delta filter supports only integer arrays.")
+
+        s = self.delta_stride
+        out = arr.copy()
+        out[..., s:] -= arr[..., :-s]
+        return out
+
+    def _undelta(self, arr):
+
+        s = self.delta_stride
+        out = np.empty_like(arr)
+        for phase in range(s):
+            np.cumsum(arr[..., phase::s], axis=-1, dtype=arr.dtype, out=out[..., phase::s])
+        return out
+
+    @staticmethod
+    def _shuffle(arr):
+
+        itemsize = arr.dtype.itemsize
+        return np.ascontiguousarray(
+            arr.reshape(-1).view(np.uint8).reshape(-1, itemsize).T)
+
+    @staticmethod
+    def _unshuffle(data, dtype):
+
+        itemsize = dtype.itemsize
+        return np.ascontiguousarray(
+            data.reshape(itemsize, -1).T).view(dtype).reshape(-1)
+
+    def encodeArray(self, arr):
+        """Encode an array to a bytes string.
+
+        The shape and dtype are not stored (see `saveArray`).
+        """
+
+        arr = np.ascontiguousarray(arr)
+        if 'delta' in self.filters:
+            arr = self._delta(arr)
+        if 'shuffle' in self.filters:
+            arr = self._shuffle(arr)
+
+        return self.compress(arr.tostring())
+
+    def decodeArray(self, data, shape, dtype):
+        """Decode an array encoded by `encodeArray`."""
+
+        dtype = np.dtype(dtype)
+        raw = np.frombuffer(self.decompress(data), dtype=np.uint8)
+
+        if 'shuffle' in self.filters:
+            arr = self._unshuffle(raw, dtype)
+        else:
+            arr = raw.view(dtype)
+        arr = arr.reshape(shape)
+
+        if 'delta' in self.filters:
+            return self._undelta(arr)
+
+        return arr.copy()
+
+
+def encodeBuffer(buff, codec):
+    """Encode a bytes buffer with a self describing header."""
+
+    codec = Codec.fromSpec(codec)
+    header = json.dumps(codec.spec)
+
+    return BUFFER_MAGIC + struct.pack('<I', len(header)) + header + codec.compress(buff)
+
+
+def decodeBuffer(buff):
+    """Decode a buffer encoded by `encodeBuffer`.
+
+    Buffers without the codec header are returned as is.
+    """
+
+    if not buff.startswith(BUFFER_MAGIC):
+        return buff
+
+    offset = len(BUFFER_MAGIC)
+    header_len = struct.unpack('<I', buff[offset:offset+4])[0]
+    offset += 4
+    codec = Codec.fromSpec(json.loads(buff[offset:offset+header_len]))
+
+    return codec.decompress(buff[offset+header_len:])
+
+
+def saveArray(mat_path, img_array, codec=None):
+    """Save an array in a mat file.
+
+    Args:
+        mat_path (str or file): Path of the mat file.
+        img_array (array): The array to save.
+        codec (Codec or spec, optional): Codec of the array. None means the
+            legacy (zlib compressed) ``img_array`` variable. The delta
+            filter is skipped for non integer arrays.
+
+    Note:
+        Arrays saved with a codec are stored (uncompressed by the mat file)
+        as the encoded bytes ``img_bytes`` and the json ``img_codec``
+        (holding also the shape and dtype of the array).
+    """
+
+    codec = Codec.fromSpec(codec)
+    if codec is None:
+        sio.savemat(mat_path, dict(img_array=img_array), do_compression=True)
+        return
+
+    img_array = np.asarray(img_array)
+    codec = codec.forDtype(img_array.dtype)
+    header = codec.spec
+    header.update(shape=list(img_array.shape), dtype=img_array.dtype.str)
+
+    sio.savemat(
+        mat_path,
+        dict(
+            img_bytes=np.frombuffer(codec.encodeArray(img_array), dtype=np.uint8),
+            img_codec=json.dumps(header)
+        ),
+        do_compression=False
+    )
+
+
+def loadArray(mat_path):
+    """Load an array saved by `saveArray` (or a legacy mat file)."""
+
+    d = sio.loadmat(mat_path)
+    if 'img_bytes' not in d:
+        return d['img_array']
+
+    header = json.loads(str(d['img_codec'][0]))
+    shape = tuple(header.pop('shape'))
+    dtype = header.pop('dtype')
+    codec = Codec.fromSpec(header)
+
+    return codec.decodeArray(d['img_bytes'].tobytes(), shape, dtype)
@@ -36,15 +36,28 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import division
-import bisect
+from CameraNetwork.archive import isArchiveRef
+from CameraNetwork.archive import openDayArchive
+from CameraNetwork.archive import parseArchiveRef
 from CameraNetwork.arduino_utils import ArduinoAPI
+from CameraNetwork.calibration import DarkCalibration
 from CameraNetwork.calibration import RadiometricCalibration
+from CameraNetwork.calibration import RawPreprocessor
 from CameraNetwork.calibration import VignettingCalibration
+from CameraNetwork.calibration_registry import CalibrationRegistry
+from CameraNetwork.catalog import getCatalog
+from CameraNetwork.compression import saveArray
+from CameraNetwork.hdr import BracketPlanner
 from CameraNetwork.cameras import IDSCamera
 import CameraNetwork.global_settings as gs
-from CameraNetwork.image_utils import calcHDR
+from CameraNetwork.image_utils import compactFrame
 from CameraNetwork.image_utils import FisheyeProxy
 from CameraNetwork.image_utils import Normalization
+from CameraNetwork.pipeline import PreviewStage
+from CameraNetwork.pipeline import ThumbnailStage
+from CameraNetwork.pipeline import ThumbnailStore
+from CameraNetwork.pipeline import WriterPool
+from CameraNetwork.reprocess import loadFrame
 import CameraNetwork.sunphotometer as spm
 from CameraNetwork.utils import cmd_callback
 from CameraNetwork.utils import DataObj
@@ -52,6 +65,7 @@ from CameraNetwork.utils import find_camera_orientation_ransac
 from CameraNetwork.utils import find_centroid
 from CameraNetwork.utils import getImagesDF
 from CameraNetwork.utils import IOLoop
+from CameraNetwork.utils import LRUCache
 from CameraNetwork.utils import mean_with_outliers
 from CameraNetwork.utils import name_time
 from CameraNetwork.utils import object_direction
@@ -63,6 +77,7 @@ from dateutil import parser as dtparser
 from datetime import datetime
 from datetime import timedelta
 import ephem
+import errno
 import fisheye
 
 try:
@@ -74,7 +89,6 @@ except:
     from concurrent import futures
 
 import glob
-import json
 
 try:
     from PIL import Image
@@ -99,6 +113,7 @@ import subprocess
 import sys
 import time
 import thread
+import threading
 from tornado import gen
 from tornado.concurrent import Future
 from tornado.concurrent import run_on_executor
@@ -106,38 +121,6 @@ from tornado.queues import PriorityQueue as tPriorityQueue
 import traceback
 
 
-def interpolate_dark_images(exposure, exposures, dark_images):
-    """Interpolate the corresponding dark image."""
-
-    ri = np.searchsorted(exposures, exposure)
-
-    #
-    # Check if index in bounds
-    #
-    if ri == len(exposures):
-        return dark_images[-1]
-    elif ri == 0:
-        return dark_images[0]
-
-    re = exposures[ri]
-
-    #
-    # Check if we measured exactly the same exposure.
-    #
-    if exposure == re:
-        return dark_images[ri]
-
-    li = ri - 1
-    le = exposures[li]
-
-    #
-    # Estimate dark image using linear interpolation.
-    #
-    dark_image = dark_images[li] + (dark_images[ri] - dark_images[li]) * (exposure - le) / (re - le)
-
-    return dark_image
-
-
 def time2seconds(dt):
     """Convert datetime object to seconds."""
 
@@ -172,11 +155,73 @@ class Controller(object):
         self._offline = offline
 
         #
-        # Set the last calibration path.
+        # Background writers of the loop captures.
+        #
+        self._writer_pool = WriterPool(
+            max_workers=gs.WRITER_WORKERS,
+            max_pending=gs.WRITER_MAX_PENDING
+        )
+
+        #
+        # Serializes the creation of the day folders by the writers.
+        #
+        self._day_lock = threading.Lock()
+
+        #
+        # Deferred creation of the jpeg thumbnails.
+        #
+        self._thumbnail_stage = ThumbnailStage(
+            min_interval=gs.THUMBNAIL_MIN_INTERVAL,
+            max_pending=gs.THUMBNAIL_MAX_PENDING
+        )
+
+        #
+        # Callbacks of saved frames.
+        #
+        self._frame_listeners = []
+
+        #
+        # Decoded stored frames, shared by the seek, thumbnails and
+        # radiometric commands.
+        #
+        self._frame_cache = LRUCache(max_bytes=gs.FRAME_CACHE_MB*2**20)
+
+        #
+        # Normalized thumbnails (of the thumbnails command) and the threads
+        # creating them.
+        #
+        self._thumbnail_store = ThumbnailStore()
+        self._thumbnails_executor = futures.ThreadPoolExecutor(gs.THUMBNAIL_WORKERS)
+
+        #
+        # Background normalized previews of the loop captures.
+        #
+        self._previews_bundle = None
+        self._previews_preprocessor = None
+        self._previews_normalizations = {}
+        self._preview_stage = PreviewStage(
+            self.createPreviews,
+            min_interval=gs.PREVIEW_MIN_INTERVAL,
+            max_pending=gs.PREVIEW_MAX_PENDING
+        )
+
+        #
+        # Planner of adaptive HDR brackets.
+        #
+        self._bracket_planner = None
+
+        #
+        # The calibration bundle in use.
         # Note:
-        # The calibration path handles the case of multiple calibration dates.
+        # The bundles handle the case of multiple calibration dates. The
+        # normalization of a bundle is shared, therefore its rotation is set
+        # per command (see `preprocess_array`), and the last calculated
+        # extrinsic rotation is kept separately.
         #
-        self._last_calibration_path = None
+        self._bundle = None
+        self._default_R = None
+        self._extrinsic_R = None
+        self._calibrations = CalibrationRegistry()
 
         #
         # Load the camera calibration information.
@@ -231,6 +276,10 @@ class Controller(object):
                 None (default), now will be assumed.
             serial_num (str, optional): serial number of sensor. If None
                 (default), will be taken directly from the sensor.
+
+        Note:
+            The calibrations are built once and kept by the calibration
+            registry (see `CalibrationRegistry`).
         """
 
         logging.debug("Loading Camera Calibration.")
@@ -239,28 +288,10 @@ class Controller(object):
             logging.debug("Serial number not given.")
             if capture_date is not None:
                 #
-                # Read the serial number from an arbitrary image from the
-                # requested dat.
-                #
-                day_path = os.path.join(gs.CAPTURE_PATH, capture_date.strftime("%Y_%m_%d"))
-                datas_list = sorted(glob.glob(os.path.join(day_path, '*.pkl')))
-
-                #
-                # I search the inverted datas_list for the case that the
-                # function was called to handle intrinsic calibration. This
-                # handles the case that the sensor was replaced during the day.
+                # Read the serial number from the images of the requested
+                # day.
                 #
-                for data_path in datas_list[::-1]:
-                    try:
-                        with open(data_path, "rb") as f:
-                            data = cPickle.load(f)
-                        serial_num = data.camera_info["serial_num"]
-                        logging.debug(
-                            "Serial number {} taken from: {}".format(serial_num, data_path)
-                        )
-                        break
-                    except:
-                        pass
+                serial_num = self._calibrations.daySerial(capture_date)
             else:
                 #
                 # Not loading a previously saved image use the camera sensor num.
@@ -270,38 +301,14 @@ class Controller(object):
                     "Serial number {} taken from Camera sensor.".format(serial_num)
                 )
 
-        self.base_calibration_path = os.path.join(
-            pkg_resources.resource_filename(__name__, '../data/calibration/'),
-            serial_num
-        )
-
-        #
-        # Get the list of calibration dates.
-        #
-        calibration_dates_paths = sorted(glob.glob(os.path.join(self.base_calibration_path, "20*")))
-        if len(calibration_dates_paths) == 0:
-            calibration_path = self.base_calibration_path
-        else:
-            calibration_dates = [os.path.split(cdp)[-1] for cdp in calibration_dates_paths]
-            calibration_dates = [datetime.strptime(d, "%Y_%m_%d") for d in calibration_dates]
-
-            #
-            # Check the relevant calibration date.
-            #
-            if capture_date is None:
-                #
-                # Live capture, take the most updated index.
-                #
-                calibration_index = -1
-            else:
-                calibration_index = bisect.bisect(calibration_dates, capture_date) - 1
-
-            calibration_path = calibration_dates_paths[calibration_index]
+        base_calibration_path, calibration_path = \
+            self._calibrations.calibrationPath(serial_num, capture_date)
+        self.base_calibration_path = base_calibration_path
 
         logging.debug("Calibration path is: {}".format(calibration_path))
 
-        if self._last_calibration_path is not None and \
-                self._last_calibration_path == calibration_path:
+        bundle = self._calibrations.bundle(serial_num, capture_date)
+        if bundle is self._bundle:
             #
             # No need to load new calibration data.
             #
@@ -309,120 +316,29 @@ class Controller(object):
 
             return
 
-        self._last_calibration_path = calibration_path
-
-        #
-        # Check if the data exists in the data folder of the code.
-        # If so, the data is copied to the home folder.
-        # Note:
-        # This is done to support old cameras that were not calibrated
-        # using the test bench.
-        #
-        if os.path.exists(self.base_calibration_path):
-            for base_path, file_name, dst_path in zip(
-                    (calibration_path, calibration_path, self.base_calibration_path),
-                    (gs.INTRINSIC_SETTINGS_FILENAME, gs.VIGNETTING_SETTINGS_FILENAME, gs.RADIOMETRIC_SETTINGS_FILENAME),
-                    (gs.INTRINSIC_SETTINGS_PATH, gs.VIGNETTING_SETTINGS_PATH, gs.RADIOMETRIC_SETTINGS_PATH)
-            ):
-                try:
-                    shutil.copyfile(
-                        os.path.join(base_path, file_name),
-                        dst_path)
-                except Exception as e:
-                    logging.error("Failed copying calibration data: {}\n{}".format(
-                        file_name, traceback.format_exc()))
+        self._bundle = bundle
+        self._default_R = bundle.default_R
+        self._fe = bundle.fe
+        self._normalization = bundle.normalization
+        self._vignetting = bundle.vignetting
+        self._radiometric = bundle.radiometric
 
-        #
-        # Try to load calibration data.
-        #
-        self._fe = None
-        ocam_path = os.path.join(calibration_path, "ocamcalib.pkl")
-        print("Searching for ocam path: {}".format(ocam_path))
-        logging.info("Will search for ocamcalib in path: ".format(ocam_path))
-        if os.path.exists(ocam_path):
-            #
-            # Found an ocamcalib model load it.
-            #
-            print("Found ocam path: {}".format(ocam_path))
-            logging.info("Loading an ocamcalib model from:".format(ocam_path))
-            with open(ocam_path, "rb") as f:
-                self._fe = cPickle.load(f)
-        elif os.path.exists(gs.INTRINSIC_SETTINGS_PATH):
-            #
-            # Found an opencv2 fisheye model.
-            #
-            logging.info("Loading a standard opencv fisheye model")
-            self._fe = fisheye.load_model(
-                gs.INTRINSIC_SETTINGS_PATH, calib_img_shape=(1200, 1600))
+    def loadDarkImages(self):
+        """Load the dark current model.
 
-        if self._fe is not None:
-            #
-            # Creating the normalization object.
-            #
-            self._normalization = Normalization(
-                gs.DEFAULT_NORMALIZATION_SIZE, FisheyeProxy(self._fe)
-            )
-            if os.path.exists(gs.EXTRINSIC_SETTINGS_PATH):
-                self._normalization.R = np.load(
-                    gs.EXTRINSIC_SETTINGS_PATH
-                )
-        else:
-            self._normalization = None
+        Dark images are used for reducing dark current noise. The dark
+        images are fitted by a per pixel linear (in exposure) model.
+        """
 
-        #
-        # Load vignetting settings.
-        #
         try:
-            self._vignetting = VignettingCalibration.load(gs.VIGNETTING_SETTINGS_PATH)
+            self._dark_calibration = DarkCalibration.load(gs.DARK_IMAGES_PATH)
         except:
-            self._vignetting = VignettingCalibration()
             logging.error(
-                "Failed loading vignetting data:\n{}".format(
-                    traceback.format_exc()))
+                "Failed loading the dark images:\n{}".format(traceback.format_exc()))
+            self._dark_calibration = None
 
-        #
-        # Load radiometric calibration.
-        #
-        try:
-            self._radiometric = RadiometricCalibration.load(gs.RADIOMETRIC_SETTINGS_PATH)
-        except:
-            self._radiometric = RadiometricCalibration(gs.DEFAULT_RADIOMETRIC_SETTINGS)
-            logging.debug("Failed loading radiometric data. Will use the default values.")
-
-    def loadDarkImages(self):
-        """Load dark images from disk.
-
-        Dark images are used for reducing dark current noise.
-        """
-
-        di_paths = sorted(glob.glob(os.path.join(gs.DARK_IMAGES_PATH, '*.mat')))
-        if di_paths:
-            self._dark_images = {
-                False: {'exposures': [], 'images': []},
-                True: {'exposures': [], 'images': []},
-            }
-
-            #
-            # Load the dark images from disk
-            #
-            for path in di_paths:
-                d = sio.loadmat(path)
-                gain_boost = d['gain_boost'][0][0] == 1
-                self._dark_images[gain_boost]['exposures'].append(d['exposure'][0][0])
-                self._dark_images[gain_boost]['images'].append(d['image'])
-
-            #
-            # Sort the images according to exposures.
-            #
-            for gain_boost in (False, True):
-                exposures = np.array(self._dark_images[gain_boost]['exposures'])
-                indices = np.argsort(exposures)
-                self._dark_images[gain_boost]['exposures'] = exposures[indices]
-                dark_images = self._dark_images[gain_boost]['images']
-                self._dark_images[gain_boost]['images'] = [dark_images[i] for i in indices]
-        else:
+        if self._dark_calibration is None:
             logging.info("No dark images available")
-            self._dark_images = None
 
     def loadSunMeasurements(self):
         """Load previously stored sun measurements."""
@@ -500,19 +416,20 @@ class Controller(object):
             del self._camera
 
     def safe_capture(self, settings, frames_num=1,
-                     max_retries=gs.MAX_CAMERA_RETRIES):
+                     max_retries=gs.MAX_CAMERA_RETRIES, **kwds):
         """A wrapper around the camera capture.
 
         It will retry to capture a frame handling
         a predetermined amount of failures before
-        raising an error.
+        raising an error. Extra keywords are passed to
+        the camera capture.
         """
 
         retries = max_retries
         while True:
             try:
                 img_array, real_exposure_us, real_gain_db = \
-                    self._camera.capture(settings, frames_num)
+                    self._camera.capture(settings, frames_num, **kwds)
                 break
             except Exception as e:
                 if retries <= 0:
@@ -892,12 +809,15 @@ class Controller(object):
         )
         logging.debug("Finished calibration. RMS: {}.".format(rms))
         self._fe.save(gs.INTRINSIC_SETTINGS_PATH)
+        self._calibrations.invalidate()
+        self._thumbnail_store.clear()
 
         #
         # Creating the normalization object.
         #
         self._normalization = Normalization(
-            gs.DEFAULT_NORMALIZATION_SIZE, FisheyeProxy(self._fe)
+            gs.DEFAULT_NORMALIZATION_SIZE, FisheyeProxy(self._fe),
+            calibration_path=gs.INTRINSIC_SETTINGS_PATH
         )
         normalized_img = self._normalization.normalize(img)
 
@@ -1042,11 +962,16 @@ class Controller(object):
             calculated_directions, measured_directions, residual_threshold)
 
         #
-        # Update normalization model.
+        # Keep the rotation (for the save extrinsic command).
+        # Note:
+        # The normalization is shared by the commands and is not updated.
+        # When saving, the calibrations are rebuilt with the new rotation.
         #
-        self._normalization.R = R
+        self._extrinsic_R = R
         if save:
             np.save(gs.EXTRINSIC_SETTINGS_PATH, R)
+            self._calibrations.invalidate()
+            self._thumbnail_store.clear()
             #
             # Save a copy in the calibration day.
             #
@@ -1087,9 +1012,14 @@ class Controller(object):
                 date,
                 gs.EXTRINSIC_SETTINGS_FILENAME
             ),
-            self._normalization.R
+            self._extrinsic_R if self._extrinsic_R is not None else self._default_R
         )
 
+        #
+        # The stored thumbnails of the day use the previous calibration.
+        #
+        self._thumbnail_store.clear(datetime.strptime(date, "%Y_%m_%d"))
+
     @cmd_callback
     @run_on_executor
     def handle_radiometric(
@@ -1171,6 +1101,7 @@ class Controller(object):
                     os.path.join(self.base_calibration_path, gs.RADIOMETRIC_SETTINGS_FILENAME),
                 )
             self._radiometric = RadiometricCalibration(ratios)
+            self._calibrations.invalidate()
 
         #
         # Send back the analysis.
@@ -1230,8 +1161,8 @@ class Controller(object):
         #
         # Capture the array.
         #
-        img_array, exposure_us, gain_db = self._camera.capture(
-            capture_settings, frames_num)
+        accumulator, exposure_us, gain_db = self._camera.capture(
+            capture_settings, frames_num, accumulate=True)
 
         #
         # update image data object.
@@ -1242,12 +1173,13 @@ class Controller(object):
         img_data.gain_boost = capture_settings[gs.GAIN_BOOST]
         img_data.color_mode = capture_settings[gs.COLOR_MODE]
         img_data.camera_info = self._camera.info
+        img_data.frames_num = frames_num
 
         #
         # Average the images.
         #
+        img_array = accumulator.mean()
         if frames_num > 1:
-            img_array = img_array.mean(axis=img_array.ndim - 1)
             logging.debug('Averaged %d arrays' % frames_num)
 
         #
@@ -1306,6 +1238,52 @@ class Controller(object):
 
         logging.debug("Seeking time: {} and hdr: {}".format(seek_time, hdr_index))
 
+        seek_time = self.seekFrameTime(df, seek_time, hdr_index, timedelta_threshold)
+
+        #
+        # Either get a specific hdr index or all exposures.
+        #
+        if hdr_index < 0:
+            mat_paths = df["path"].loc[seek_time].values.flatten()
+        else:
+            mat_paths = [df["path"].loc[seek_time, hdr_index]]
+
+        img_arrays, img_datas = [], []
+        for mat_path in mat_paths:
+            print("Seeking: {}".format(mat_path))
+            img_array, img_data = self.loadFrame(mat_path, camera_settings, seek_time)
+            img_arrays.append(img_array)
+            img_datas.append(img_data)
+
+        img_array = self.preprocess_array(
+            img_arrays,
+            img_datas,
+            seek_time,
+            normalize,
+            resolution,
+            jpeg,
+            correct_radiometric,
+            ignore_date_extrinsic
+        )
+
+        return img_datas, img_array
+
+    @staticmethod
+    def seekFrameTime(df, seek_time, hdr_index, timedelta_threshold=60):
+        """Find the time of the frame closest to a seeked time.
+
+        Args:
+            df (DataFrame): Pandas DataFrame holding all paths to images captured at
+                some day. It is created using `CameraNetwork.utils.getImagesDF`
+            seek_time (datetime): Seeked time.
+            hdr_index (int): Index of hdr exposure (<0 for HDR images).
+            timedelta_threshold (int, optional): Allow for time delta between
+                seeked time to returned index (in seconds).
+
+        Returns:
+            The time (pd.Timestamp) of the frame in the DataFrame.
+        """
+
         #
         # Convert the seeked time to Timestamp type.
         #
@@ -1330,60 +1308,175 @@ class Controller(object):
             raise ValueError("Seeked time not available - seek_time: {}}".format(
                 original_seek_time))
 
-        seek_time = df.xs(checked_hdr, level='hdr').index[np.argmin(dts)]
+        return df.xs(checked_hdr, level='hdr').index[np.argmin(dts)]
 
-        #
-        # Either get a specific hdr index or all exposures.
-        #
-        if hdr_index < 0:
-            mat_paths = df["path"].loc[seek_time].values.flatten()
-        else:
-            mat_paths = [df["path"].loc[seek_time, hdr_index]]
+    def normalizedThumbnails(
+            self,
+            df,
+            seek_times,
+            hdr_index,
+            resolution,
+            camera_settings):
+        """Create the normalized jpeg thumbnails of a list of (slot) times.
 
-        img_arrays, img_datas = [], []
-        for mat_path in mat_paths:
-            print("Seeking: {}".format(mat_path))
-            assert os.path.exists(mat_path), "Non existing array: {}".format(mat_path)
-            img_array = sio.loadmat(mat_path)['img_array']
+        Thumbnails found in the thumbnail store are read from it. The rest
+        are created by a pool of threads that share the calibration of the
+        controller, and are added to the store.
 
-            base_path = os.path.splitext(mat_path)[0]
-            if os.path.exists(base_path + '.json'):
-                #
-                # Support old json data files.
-                #
-                img_data = DataObj(
-                    longitude=camera_settings[gs.CAMERA_LONGITUDE],
-                    latitude=camera_settings[gs.CAMERA_LATITUDE],
-                    altitude=camera_settings[gs.CAMERA_ALTITUDE],
-                    name_time=seek_time.to_datetime()
-                )
+        Args:
+            df (DataFrame): Images DataFrame of the day (see
+                `CameraNetwork.utils.getImagesDF`).
+            seek_times (list): Times of the slots.
+            hdr_index (int): Index of hdr exposure.
+            resolution (int): Resolution of the thumbnails.
+            camera_settings (DataObj): Object holding camera information.
+
+        Yields:
+            slot index, frame time, jpeg stream (uint8 array). The slots are
+            yielded in order, as soon as they are ready. Slots without a
+            frame (or that failed) are skipped.
+        """
+
+        def create(frame_time):
+            _, jpeg_array = self.seekImageArray(
+                df,
+                seek_time=frame_time,
+                hdr_index=hdr_index,
+                normalize=True,
+                resolution=resolution,
+                jpeg=True,
+                camera_settings=camera_settings
+            )
+            self._thumbnail_store.save(frame_time, hdr_index, resolution, jpeg_array)
 
-                data_path = base_path + '.json'
-                with open(data_path, mode='rb') as f:
-                    img_data.update(**json.load(f))
+            return jpeg_array
 
-            elif os.path.exists(base_path + '.pkl'):
+        #
+        # Match the slots to frames and check the store.
+        # Note:
+        # The first missing thumbnail is created here, before starting the
+        # pool, so that the calibration and normalization of the day (and
+        # resolution) are set once.
+        #
+        slots = []
+        warm = False
+        validated = set()
+        for slot, seek_time in enumerate(seek_times):
+            try:
+                frame_time = self.seekFrameTime(df, seek_time, hdr_index)
+            except Exception:
                 #
-                # New pickle data files.
+                # Sampling the "right" time creates a time sample
+                # that might not be in the data frame (e.g. hdr=0).
                 #
-                with open(base_path + '.pkl', 'rb') as f:
-                    img_data = cPickle.load(f)
+                continue
 
-            img_arrays.append(img_array)
-            img_datas.append(img_data)
+            #
+            # Drop the thumbnails created with a previous calibration.
+            #
+            day = frame_time.date()
+            if day not in validated:
+                validated.add(day)
+                self._thumbnail_store.validate(
+                    frame_time, self.calibrationVersion(frame_time))
+
+            jpeg_array = self._thumbnail_store.load(frame_time, hdr_index, resolution)
+            if jpeg_array is None:
+                if not warm:
+                    warm = True
+                    try:
+                        jpeg_array = create(frame_time)
+                    except Exception:
+                        logging.error("Failed creating thumbnail of {}:\n{}".format(
+                            frame_time, traceback.format_exc()))
+                        continue
+                else:
+                    jpeg_array = self._thumbnails_executor.submit(create, frame_time)
 
-        img_array = self.preprocess_array(
-            img_arrays,
-            img_datas,
-            seek_time,
-            normalize,
-            resolution,
-            jpeg,
-            correct_radiometric,
-            ignore_date_extrinsic
-        )
+            slots.append((slot, frame_time, jpeg_array))
 
-        return img_datas, img_array
+        for slot, frame_time, jpeg_array in slots:
+            if isinstance(jpeg_array, futures.Future):
+                try:
+                    jpeg_array = jpeg_array.result()
+                except Exception:
+                    logging.error("Failed creating thumbnail of {}:\n{}".format(
+                        frame_time, traceback.format_exc()))
+                    continue
+
+            yield slot, frame_time, jpeg_array
+
+    @property
+    def thumbnail_store_stats(self):
+        """Statistics of the normalized thumbnails store."""
+
+        return self._thumbnail_store.stats
+
+    def loadFrame(self, mat_path, camera_settings, seek_time):
+        """Load a stored frame and its data object.
+
+        Args:
+            mat_path (str): Path to the mat file of the frame or an archive
+                reference.
+            camera_settings (DataObj): Object holding camera information.
+            seek_time (pd.Timestamp): Time of frame. Used for old json data
+                files.
+
+        Returns:
+            img_array, img_data
+
+        Note:
+            Decoded frames are cached (by path and modification time). The
+            returned array is shared with the cache and is read only.
+        """
+
+        key = self.frameKey(mat_path)
+        if key is not None:
+            cached = self._frame_cache.get(key)
+            if cached is not None:
+                img_array, img_data = cached
+                return img_array, copy.copy(img_data)
+
+        img_array, img_data = loadFrame(mat_path, camera_settings, seek_time)
+
+        if key is not None:
+            img_array.setflags(write=False)
+            self._frame_cache.put(key, (img_array, img_data))
+            img_data = copy.copy(img_data)
+
+        return img_array, img_data
+
+    @staticmethod
+    def frameKey(mat_path):
+        """Cache key of a stored frame (None if the frame doesn't exist).
+
+        Note:
+            Archived frames are never modified. The archive header is
+            written only when the archive is (re)created, so its
+            modification time identifies the archive.
+        """
+
+        if isArchiveRef(mat_path):
+            frames_path, _ = parseArchiveRef(mat_path)
+            stat_path = os.path.join(
+                os.path.dirname(frames_path), gs.ARCHIVE_HEADER_FILENAME)
+        else:
+            stat_path = mat_path
+
+        try:
+            return mat_path, os.path.getmtime(stat_path)
+        except OSError:
+            return None
+
+    @property
+    def frame_cache_stats(self):
+        """Statistics of the decoded frames cache."""
+
+        stats = self._frame_cache.stats
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / requests if requests else 0.
+
+        return stats
 
     def preprocess_array(
             self,
@@ -1425,8 +1518,13 @@ class Controller(object):
         self.loadCameraCalibration(capture_date=capture_date, serial_num=serial_num)
 
         #
-        # Check if there a need to update the extrinsic calibration.
+        # Set the extrinsic calibration: the calibration of the day (if
+        # exists) or the default calibration.
+        # Note:
+        # The rotation is set on every call, as the normalization is shared
+        # by all the commands.
         #
+        R = self._default_R
         extrinsic_path = os.path.join(
             gs.CAPTURE_PATH,
             img_time.strftime("%Y_%m_%d"),
@@ -1434,34 +1532,14 @@ class Controller(object):
         )
         if not ignore_date_extrinsic and os.path.exists(extrinsic_path):
             try:
-                self._normalization.R = np.load(extrinsic_path)
+                R = np.load(extrinsic_path)
             except:
                 logging.error(
                     "Failed loading extrinsic data from {}\n{}".format(
                         extrinsic_path, traceback.format_exc())
                 )
-
-        #
-        # if raw image, subtract the dark image and apply vignetting.
-        #
-        if img_datas[0].color_mode == gs.COLOR_RAW and self._dark_images is not None:
-            dark_images = self._dark_images[img_datas[0].gain_boost]
-            tmp_arrays = []
-            for img_array, img_data in zip(img_arrays, img_datas):
-                dark_image = interpolate_dark_images(
-                    img_data.exposure_us,
-                    dark_images['exposures'],
-                    dark_images['images'])
-
-                logging.debug(
-                    'Applying dark image, exposure: {} boost: {} shape: {}'.format(
-                        img_data.exposure_us, img_data.gain_boost, dark_image.shape)
-                )
-                img_array = img_array.astype(np.float) - dark_image
-                img_array[img_array < 0] = 0
-                tmp_arrays.append(img_array)
-
-            img_arrays = tmp_arrays
+        if self._normalization is not None and R is not None:
+            self._normalization.R = R
 
         #
         # Check the type of the jpeg argument. If it is int, handle it as quality.
@@ -1472,37 +1550,40 @@ class Controller(object):
         else:
             jpeg_quality = gs.MIN_JPEG_QUALITY
 
-        if jpeg:
-            #
-            # When sending jpeg, the image is not scaled by exposure.
-            #
-            img_array = img_arrays[0].astype(np.float)
-        else:
-            if len(img_arrays) == 1:
-                img_array = \
-                    img_arrays[0].astype(np.float) / (img_datas[0].exposure_us / 1000)
-            else:
-                img_exposures = [img_data.exposure_us / 1000 for img_data in img_datas]
-                img_array = calcHDR(img_arrays, img_exposures)
-
         #
-        # Apply vignetting.
+        # Subtract the dark image (raw images), scale by exposure, merge hdr
+        # and apply vignetting and radiometric correction in one float32
+        # stage.
+        # Note:
+        # When sending jpeg, the image is not scaled by exposure and the
+        # radiometric correction is not applied.
+        # The scratch buffer is used only when the result is consumed
+        # (normalized or compressed) before returning.
         #
-        logging.info('IMAGE SHAPE: {}'.format(img_array.shape))
-        img_array = self._vignetting.applyVignetting(img_array)
+        normalize = normalize and self._normalization is not None
+        if jpeg:
+            img_arrays, img_datas = img_arrays[:1], img_datas[:1]
+        img_array = self.preprocessor.process(
+            img_arrays,
+            img_datas,
+            subtract_dark=img_datas[0].color_mode == gs.COLOR_RAW,
+            scale=not jpeg,
+            radiometric=correct_radiometric and not jpeg,
+            reuse_buffer=normalize or jpeg
+        )
         logging.info('IMAGE SHAPE: {}'.format(img_array.shape))
 
         #
         # Check if there is a need to normalize
         #
-        if normalize and self._normalization is not None:
+        if normalize:
             if self._normalization.resolution != resolution:
                 #
                 # Recalculate normalization mapping for new resolution.
                 #
                 self._normalization.calc_normalization_map(resolution)
 
-            img_array = self._normalization.normalize(img_array)
+            img_array = self._normalization.normalize(img_array, reuse_buffer=jpeg)
 
         if jpeg:
             #
@@ -1511,21 +1592,100 @@ class Controller(object):
             # The jpeg stream is converted back to numpy array
             # to allow sending as matfile.
             #
-            img_array = img_array.clip(0, 255)
-            img = Image.fromarray(img_array.astype(np.uint8))
-            f = StringIO.StringIO()
-            img.save(f, format="JPEG", quality=jpeg_quality)
-            img_array = np.fromstring(f.getvalue(), dtype=np.uint8)
-        else:
-            if correct_radiometric:
-                #
-                # Scale to Watts.
-                #
-                img_array = \
-                    self._radiometric.applyRadiometric(img_array).astype(np.float32)
+            img_array = self.jpegArray(img_array, jpeg_quality)
 
         return np.ascontiguousarray(img_array)
 
+    @staticmethod
+    def jpegArray(img_array, quality=gs.MIN_JPEG_QUALITY):
+        """Compress an image to a jpeg stream (as a uint8 array)."""
+
+        img_array = img_array.clip(0, 255)
+        img = Image.fromarray(img_array.astype(np.uint8))
+        f = StringIO.StringIO()
+        img.save(f, format="JPEG", quality=quality)
+
+        return np.fromstring(f.getvalue(), dtype=np.uint8)
+
+    def createPreviews(self, img_array, img_data, hdr_i):
+        """Create the normalized jpeg previews of a captured frame.
+
+        The previews (in the PREVIEW_RESOLUTIONS) are the same as the
+        thumbnails created by `seekImageArray` (normalize=True, jpeg=True).
+        They are added to the thumbnail store, and served from it by the
+        thumbnails command.
+
+        Note:
+            Called from the previews stage thread. The previews use their
+            own preprocessor and normalization objects (one per
+            resolution), built from the calibration bundle of the frame,
+            so the calibration of the commands is neither used nor changed.
+        """
+
+        bundle = self._calibrations.bundle(
+            img_data.camera_info["serial_num"], img_data.capture_time)
+        if bundle.normalization is None:
+            return
+
+        if bundle is not self._previews_bundle or \
+           self._previews_preprocessor.dark is not self._dark_calibration:
+            self._previews_bundle = bundle
+            self._previews_normalizations = {}
+            self._previews_preprocessor = RawPreprocessor(
+                dark=self._dark_calibration,
+                vignetting=bundle.vignetting,
+                radiometric=bundle.radiometric,
+                hdr_weighting=gs.HDR_WEIGHTING,
+                hdr_tile_rows=gs.HDR_TILE_ROWS
+            )
+
+        #
+        # Use the extrinsic calibration of the day (if exists), else the
+        # default extrinsic calibration of the bundle.
+        # Note:
+        # The rotation of the shared normalization of the bundle depends on
+        # the last command, and is not used.
+        #
+        R = bundle.default_R
+        extrinsic_path = os.path.join(
+            gs.CAPTURE_PATH,
+            img_data.name_time.strftime("%Y_%m_%d"),
+            gs.EXTRINSIC_SETTINGS_FILENAME
+        )
+        if os.path.exists(extrinsic_path):
+            R = np.load(extrinsic_path)
+
+        img = self._previews_preprocessor.process(
+            [img_array],
+            [img_data],
+            subtract_dark=img_data.color_mode == gs.COLOR_RAW,
+            scale=False,
+            radiometric=False,
+            reuse_buffer=True
+        )
+
+        frame_time = img_data.name_time.replace(microsecond=0)
+        self._thumbnail_store.validate(
+            frame_time, self.calibrationVersion(frame_time))
+        for resolution in gs.PREVIEW_RESOLUTIONS:
+            normalization = self._previews_normalizations.get(resolution)
+            if normalization is None:
+                normalization = Normalization(
+                    resolution, FisheyeProxy(bundle.fe), Rot=R,
+                    calibration_path=bundle.intrinsic_path
+                )
+                self._previews_normalizations[resolution] = normalization
+
+            normalization.R = R
+            jpeg_array = self.jpegArray(normalization.normalize(img, reuse_buffer=True))
+            self._thumbnail_store.save(frame_time, hdr_i, resolution, jpeg_array)
+
+    @property
+    def preview_stats(self):
+        """Statistics of the previews stage."""
+
+        return self._preview_stage.stats
+
     @cmd_callback
     @run_on_executor
     def handle_dark_images(self):
@@ -1554,28 +1714,67 @@ class Controller(object):
                 logging.debug(
                     "Capturing dark image exposure: {}, gain: {}".format(
                         exp, gain_boost))
-                img_array, exposure_us, _ = self._camera.capture(
+                accumulator, exposure_us, _ = self._camera.capture(
                     settings={
                         "exposure_us": exp,
                         "gain_db": 0,
                         "gain_boost": gain_boost,
                         "color_mode": gs.COLOR_RAW
                     },
-                    frames_num=FRAMES_NUM
+                    frames_num=FRAMES_NUM,
+                    accumulate=True,
+                    variance=True
                 )
 
-                img_array = img_array.mean(axis=img_array.ndim - 1)
-
+                #
+                # Store also the temporal variance of the dark frames
+                # as an estimate of the read noise.
+                #
                 sio.savemat(
                     os.path.join(gs.DARK_IMAGES_PATH, '{}_{}.mat'.format(img_index, gain_boost)),
-                    {'image': img_array, 'exposure': exposure_us, 'gain_boost': gain_boost},
+                    {
+                        'image': accumulator.mean(),
+                        'variance': accumulator.variance(),
+                        'exposure': exposure_us,
+                        'gain_boost': gain_boost
+                    },
                     do_compression=True
                 )
                 img_index += 1
 
+        #
+        # Refit the dark current model.
+        #
+        self.loadDarkImages()
+
     @cmd_callback
     @run_on_executor
-    def handle_loop(self, capture_settings, frames_num, hdr_mode, img_data):
+    def handle_loop(self, capture_settings, frames_num, hdr_mode, img_data,
+                    storage_mode=gs.STORAGE_MAT, compact=False,
+                    storage_codec=None, adaptive_hdr=False,
+                    hdr_time_budget=None):
+        """Capture the (hdr) frames of a loop cycle.
+
+        The frames are only captured here. Saving them is handed to the
+        background writers so that the next capture is not delayed by the
+        disk.
+
+        Args:
+            compact (bool, optional): Store the frames as compact uint16
+                sums of frames (see `save_array`).
+            storage_codec (dict, optional): Codec spec of the saved
+                frames (see `save_array`).
+            adaptive_hdr (bool, optional): Plan the hdr exposures from the
+                histograms of the captured frames (see `BracketPlanner`)
+                instead of doubling the exposure hdr_mode times. The plan is
+                stored in the ``hdr_plan`` attribute of the frames data.
+            hdr_time_budget (float, optional): Time budget (in seconds) of
+                an adaptive hdr bracket.
+
+        Returns:
+            A list of (concurrent) futures, one per hdr frame, of the
+            (mat_path, jpg_path, data_path) of the saved frames.
+        """
 
         #
         # Change camera to large size.
@@ -1583,14 +1782,25 @@ class Controller(object):
         # Nothing should be done in case the camera is already in large size.
         self._camera.large_size()
 
-        img_arrays = []
-        img_datas = []
+        save_futures = []
         capture_settings = capture_settings.copy()
+
+        planner = None
+        if adaptive_hdr and capture_settings['exposure_us'] is not None:
+            if self._bracket_planner is None:
+                self._bracket_planner = BracketPlanner(hdr_mode)
+            planner = self._bracket_planner
+            planner.max_frames = hdr_mode
+            planner.time_budget = hdr_time_budget
+            capture_settings['exposure_us'] = \
+                planner.start(capture_settings['exposure_us'])
+
         for hdr_i in range(hdr_mode):
             #
             # Capture the array.
             #
-            img_array, exposure_us, gain_db = self.safe_capture(capture_settings, frames_num)
+            accumulator, exposure_us, gain_db = self.safe_capture(
+                capture_settings, frames_num, accumulate=True)
 
             #
             # update image data object.
@@ -1601,20 +1811,53 @@ class Controller(object):
             img_data.gain_boost = capture_settings[gs.GAIN_BOOST]
             img_data.color_mode = capture_settings[gs.COLOR_MODE]
             img_data.camera_info = self._camera.info
+            img_data.frames_num = frames_num
 
             #
             # Average the images.
             #
+            img_array = accumulator.mean()
             if frames_num > 1:
-                img_array = img_array.mean(axis=img_array.ndim - 1)
                 logging.debug('Averaged %d arrays' % frames_num)
 
+            if planner is not None:
+                #
+                # Plan the next exposure from the histogram of this frame.
+                # Each frame records the plan up to itself, the last frame
+                # holds the complete plan.
+                #
+                next_exposure = planner.next(img_array, exposure_us, frames_num)
+                img_data.hdr_plan = planner.plan
+                logging.debug("HDR plan: {}".format(img_data.hdr_plan))
+
+            #
+            # Hand the array and a copy of its data to the writers.
+            # Note:
+            # This blocks when the writers fall behind.
             #
+            save_futures.append(
+                self._writer_pool.submit(
+                    self.save_array,
+                    img_array,
+                    copy.copy(img_data),
+                    hdr_i,
+                    storage_mode,
+                    compact,
+                    storage_codec
+                )
+            )
+
             #
-            # Copy the array and its data for a later saving.
+            # Queue the normalized previews of the frame.
             #
-            img_arrays.append(img_array)
-            img_datas.append(copy.copy(img_data))
+            self._preview_stage.submit(img_array, copy.copy(img_data), hdr_i)
+
+            if planner is not None:
+                if next_exposure is None:
+                    break
+
+                capture_settings['exposure_us'] = next_exposure
+                continue
 
             if hdr_mode < 2:
                 #
@@ -1630,68 +1873,260 @@ class Controller(object):
 
             capture_settings['exposure_us'] = capture_settings['exposure_us'] * 2
 
-        mat_names = []
-        jpg_names = []
-        data_names = []
-        for img_array, img_data, hdr_i in zip(img_arrays, img_datas, range(hdr_mode)):
-            #
-            # Save the array and its data.
-            #
-            mat_path, jpg_path, data_path = self.save_array(
-                img_array, img_data, hdr_i)
+        return save_futures
 
-            mat_names.append(mat_path)
-            jpg_names.append(jpg_path)
-            data_names.append(data_path)
+    @property
+    def writer_stats(self):
+        """Statistics of the background writers."""
 
-        #
-        # Send back the image.
-        #
-        return jpg_names, mat_names, data_names
+        return self._writer_pool.stats
+
+    @property
+    def thumbnail_stats(self):
+        """Statistics of the thumbnails stage."""
+
+        return self._thumbnail_stage.stats
+
+    def addFrameListener(self, callback):
+        """Add a callback called (from the writer threads) with the
+        mat_path, img_data and hdr index of every saved frame."""
+
+        self._frame_listeners.append(callback)
+
+    def addThumbnailListener(self, callback):
+        """Add a callback called (from the thumbnails thread) with the path
+        of every completed thumbnail."""
 
-    def save_array(self, img_array, img_data, hdr_i):
+        self._thumbnail_stage.addListener(callback)
+
+    @property
+    def camera_stats(self):
+        """Statistics of the camera frame size switches."""
+
+        if getattr(self, '_camera', None) is None:
+            return {}
+
+        return self._camera.switch_stats
+
+    @property
+    def preprocessor(self):
+        """The preprocessor of the current calibration."""
+
+        preprocessor = getattr(self, '_preprocessor', None)
+        if preprocessor is None or \
+           preprocessor.dark is not self._dark_calibration or \
+           preprocessor.vignetting is not self._vignetting or \
+           preprocessor.radiometric is not self._radiometric:
+            preprocessor = RawPreprocessor(
+                dark=self._dark_calibration,
+                vignetting=self._vignetting,
+                radiometric=self._radiometric,
+                hdr_weighting=gs.HDR_WEIGHTING,
+                hdr_tile_rows=gs.HDR_TILE_ROWS
+            )
+            self._preprocessor = preprocessor
+
+        return preprocessor
+
+    @property
+    def normalization_stats(self):
+        """Statistics of the normalization maps cache."""
+
+        return Normalization.cacheStats()
+
+    def calibrationVersion(self, query_date, ignore_date_extrinsic=False):
+        """Version of the calibration used for processing the frames of a day.
+
+        The version is the modification times of the calibration files
+        (intrinsic, extrinsic, vignetting, radiometric and dark images) and of
+        the extrinsic calibration of the day. It changes whenever one of
+        these is saved.
+
+        Args:
+            query_date (datetime): The day.
+            ignore_date_extrinsic (bool, optional): Ignore the extrinsic
+                calibration of the day.
+        """
+
+        paths = [
+            gs.INTRINSIC_SETTINGS_PATH,
+            gs.EXTRINSIC_SETTINGS_PATH,
+            gs.VIGNETTING_SETTINGS_PATH,
+            gs.RADIOMETRIC_SETTINGS_PATH,
+            gs.DARK_IMAGES_PATH
+        ]
+        if not ignore_date_extrinsic:
+            paths.append(os.path.join(
+                gs.CAPTURE_PATH,
+                query_date.strftime("%Y_%m_%d"),
+                gs.EXTRINSIC_SETTINGS_FILENAME
+            ))
+
+        version = []
+        for path in paths:
+            try:
+                version.append(os.path.getmtime(path))
+            except OSError:
+                version.append(None)
+
+        return tuple(version)
+
+    @property
+    def calibration_stats(self):
+        """Statistics of the calibration bundles cache."""
+
+        return self._calibrations.stats
+
+    @property
+    def dark_stats(self):
+        """Statistics of the dark frames cache."""
+
+        if getattr(self, '_dark_calibration', None) is None:
+            return {}
+
+        return self._dark_calibration.stats
+
+    def save_array(self, img_array, img_data, hdr_i, storage_mode=gs.STORAGE_MAT,
+                   compact=False, codec=None):
+        """Save a captured array and its data.
+
+        Args:
+            img_array (array): The captured array.
+            img_data (DataObj): The data of the array.
+            hdr_i (int): Index of the hdr exposure.
+            storage_mode (str, optional): Either store the array as mat/pkl
+                files (gs.STORAGE_MAT) or in the day archive
+                (gs.STORAGE_ARCHIVE).
+            compact (bool, optional): Store the (averaged) array as a uint16
+                sum of frames. The number of frames and the scale are stored
+                in the data (``sum_frames``, ``sum_scale``) and the values are
+                restored by `loadFrame`. Lossless for up to 256 frames.
+            codec (dict, optional): Codec spec (see `compression.Codec`) of
+                arrays saved as mat files. None means the legacy mat file
+                compression. Archived arrays are stored raw.
+
+        Returns:
+            mat_path, jpg_path, data_path. When the array is stored in the
+            archive, mat_path is an archive reference and data_path is None.
+
+        Note:
+            The jpeg thumbnail is created later by the thumbnails stage,
+            i.e. jpg_path might not exist yet when this method returns.
+            Completed thumbnails are listed in the thumbnails index of the
+            day.
+        """
 
         #
         # Form file names.
         #
         _, base_path, base_name = name_time(img_data.name_time)
 
-        if not os.path.isdir(base_path):
-            os.makedirs(base_path)
-
         #
-        # Save as mat
+        # Create the day folder.
+        # Note:
+        # The writers run concurrently. The folder is created under a lock
+        # so that only the first frame of a day opens the day.
         #
-        mat_path = '{base}_{i}.mat'.format(base=base_name, i=hdr_i)
-        mat_path = os.path.join(base_path, mat_path)
-        sio.savemat(
-            mat_path,
-            dict(
-                img_array=img_array,
-            ),
-            do_compression=True
-        )
-        logging.debug('Saved mat file %s' % mat_path)
+        with self._day_lock:
+            new_day = not os.path.isdir(base_path)
+            if new_day:
+                try:
+                    os.makedirs(base_path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    new_day = False
+
+        #
+        # Compact the array to a sum of frames.
+        # Note:
+        # All frames (also single frames) are compacted so that the frames
+        # of a day share the dtype (required by the day archive).
+        #
+        store_array = img_array
+        if compact:
+            frames_num = getattr(img_data, 'frames_num', 1)
+            store_array, scale = compactFrame(img_array, frames_num)
+            img_data = copy.copy(img_data)
+            img_data.sum_frames = frames_num
+            img_data.sum_scale = scale
+
+        mat_path = None
+        data_path = None
+        if storage_mode == gs.STORAGE_ARCHIVE:
+            #
+            # Save in the day archive.
+            #
+            try:
+                mat_path = openDayArchive(base_path).append(store_array, img_data, hdr_i)
+                logging.debug('Archived frame %s' % mat_path)
+            except ValueError:
+                logging.warn(
+                    "Failed archiving frame, will be saved as mat:\n{}".format(
+                        traceback.format_exc()))
+
+        if mat_path is None:
+            #
+            # Save as mat
+            #
+            mat_path = '{base}_{i}.mat'.format(base=base_name, i=hdr_i)
+            mat_path = os.path.join(base_path, mat_path)
+            try:
+                saveArray(mat_path, store_array, codec)
+            except Exception:
+                #
+                # Never lose a frame because of the codec. Fall back to the
+                # legacy compression.
+                #
+                logging.error(
+                    "Failed saving with codec {}, using legacy compression:\n{}".format(
+                        codec, traceback.format_exc()))
+                saveArray(mat_path, store_array, None)
+            logging.debug('Saved mat file %s' % mat_path)
+
+            #
+            # Save the image data
+            #
+            data_path = '{base}_{i}.pkl'.format(base=base_name, i=hdr_i)
+            data_path = os.path.join(base_path, data_path)
+            with open(data_path, mode='wb') as f:
+                cPickle.dump(img_data, f)
+
+            logging.debug('Saved data file %s' % data_path)
 
         #
-        # Save as jpeg thumbnail
+        # Queue the jpeg thumbnail.
         #
         jpg_path = '{base}_{i}.jpg'.format(base=base_name, i=hdr_i)
         jpg_path = os.path.join(base_path, jpg_path)
-        img = Image.fromarray(img_array.astype(np.uint8))
-        img.thumbnail((400, 300), Image.ANTIALIAS)
-        img.save(jpg_path)
-        logging.debug('Saved jpg file %s' % jpg_path)
+        self._thumbnail_stage.submit(img_array, jpg_path)
 
         #
-        # Save the image data
+        # Add the frame to the capture catalog. A frame that opens a new
+        # day folder marks the day as fully cataloged.
         #
-        data_path = '{base}_{i}.pkl'.format(base=base_name, i=hdr_i)
-        data_path = os.path.join(base_path, data_path)
-        with open(data_path, mode='wb') as f:
-            cPickle.dump(img_data, f)
+        try:
+            getCatalog().add(mat_path, img_data, hdr_i, new_day=new_day)
+        except Exception:
+            logging.error("Failed cataloging frame {}:\n{}".format(
+                mat_path, traceback.format_exc()))
 
-        logging.debug('Saved data file %s' % data_path)
+            #
+            # The frame is missing from the catalog. The next query of
+            # the day should scan the day folder.
+            #
+            try:
+                getCatalog().invalidateDay(img_data.name_time)
+            except Exception:
+                logging.error("Failed invalidating catalog day {}:\n{}".format(
+                    base_path, traceback.format_exc()))
+
+        for listener in self._frame_listeners:
+            try:
+                listener(mat_path, img_data, hdr_i)
+            except Exception:
+                logging.error("Frame listener failed:\n{}".format(
+                    traceback.format_exc()))
 
         return mat_path, jpg_path, data_path
 
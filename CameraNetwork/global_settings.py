@@ -181,11 +181,24 @@ DAY_PERIOD_START = 'day_start'
 DAY_PERIOD_END = 'day_end'
 COLOR_MODE = 'color_mode'
 HDR_MODE = 'hdr'
+HDR_ADAPTIVE = 'hdr_adaptive'
+HDR_TIME_BUDGET = 'hdr_time_budget'
 GAIN_BOOST = 'gain_boost'
 COLOR_RAW = 'raw'
 COLOR_RGB = 'rgb'
 UPLOAD_JPG_FILE = 'upload_jpg'
 UPLOAD_MAT_FILE = 'upload_mat'
+STORAGE_MODE = 'storage_mode'
+STORAGE_MAT = 'mat'
+STORAGE_ARCHIVE = 'archive'
+COMPACT_STORAGE = 'compact_storage'
+STORAGE_CODEC = 'storage_codec'
+WIRE_CODEC = 'wire_codec'
+RETENTION_ENABLED = 'retention_enabled'
+RETENTION_FULL_DAYS = 'retention_full_days'
+RETENTION_COMPACT_DAYS = 'retention_compact_days'
+RETENTION_MIN_FREE_MB = 'retention_min_free_mb'
+RETENTION_RATE_MB = 'retention_rate_mb'
 INTERNET_FAILURE_THRESH = 'internet_failure_thresh'
 SUNSHADER_MIN_ANGLE = 'sunshader_min'
 SUNSHADER_MAX_ANGLE = 'sunshader_max'
@@ -195,6 +208,47 @@ CAMERA_ALTITUDE = 'altitude'
 MAX_CAMERA_RETRIES = 3
 CAMERA_RESTART_PERIOD = 4
 
+#
+# Background writers of captured frames.
+#
+WRITER_WORKERS = 2
+WRITER_MAX_PENDING = 6
+
+#
+# Background thumbnails stage.
+#
+THUMBNAIL_MIN_INTERVAL = 0.5  # [sec]
+THUMBNAIL_MAX_PENDING = 4
+
+#
+# Threads creating normalized thumbnails (of the thumbnails command).
+#
+THUMBNAIL_WORKERS = 3
+
+#
+# Background normalized previews of the loop captures (served by the
+# thumbnails command). The previews stage keeps at most PREVIEW_MAX_PENDING
+# full frames, later frames are skipped (their previews are created on
+# demand).
+#
+PREVIEW_RESOLUTIONS = (101, 201, 301)
+PREVIEW_MIN_INTERVAL = 0.2  # [sec]
+PREVIEW_MAX_PENDING = 6
+
+#
+# Merge of HDR brackets (see hdr.HDRMerger). The weighting is one of
+# 'window', 'hat' or 'snr'. Tile rows limit the memory of the merge on
+# low memory devices (None merges whole frames).
+#
+HDR_WEIGHTING = 'window'
+HDR_TILE_ROWS = None
+
+#
+# Retention of captured data.
+#
+RETENTION_PERIOD = 600  # [sec]
+COMPACT_RESOLUTION = 201
+
 DEFAULT_LONGITUDE = 35.024963
 DEFAULT_LATITUDE = 32.775776
 DEFAULT_ALTITUDE = 229
@@ -219,6 +273,17 @@ CAPTURE_SETTINGS = {
     DAY_PERIOD_END: 19,
     UPLOAD_JPG_FILE: False,
     UPLOAD_MAT_FILE: False,
+    STORAGE_MODE: STORAGE_MAT,
+    COMPACT_STORAGE: False,
+    STORAGE_CODEC: None,  # None: legacy mat compression, else codec spec.
+    WIRE_CODEC: None,
+    RETENTION_ENABLED: False,  # Only days confirmed uploaded are retired.
+    RETENTION_FULL_DAYS: None,  # [days] None: keep while there is space.
+    RETENTION_COMPACT_DAYS: None,  # [days] None: keep while there is space.
+    RETENTION_MIN_FREE_MB: 2048,
+    RETENTION_RATE_MB: 4,  # [MB/sec] I/O rate of the retention work.
+    HDR_ADAPTIVE: False,
+    HDR_TIME_BUDGET: 60,  # [sec]
     DAY_SETTINGS: {
         LOOP_DELAY: 300,  # [sec]
         IMAGE_EXPOSURE: 50,  # [usec]
@@ -260,7 +325,54 @@ RADIOMETRIC_SETTINGS_FILENAME = "radiometric.pkl"
 VIGNETTING_SETTINGS_FILENAME = "vignetting.pkl"
 INTRINSIC_SETTINGS_FILENAME = "fisheye.pkl"
 
+#
+# Per day archive of captured frames.
+#
+ARCHIVE_FRAMES_FILENAME = "frames.bin"
+ARCHIVE_HEADER_FILENAME = "frames_header.json"
+ARCHIVE_INDEX_FILENAME = "frames_index.pkl"
+THUMBNAILS_INDEX_FILENAME = "thumbnails_index.txt"
+THUMBNAILS_VERSION_FILENAME = "calibration_version.json"
+COMPACT_TIER_FILENAME = "compact_tier.json"
+UPLOADED_LOG_FILENAME = "uploaded.txt"
+COMPACT_FOLDER = "compact"
+NORMALIZATION_MAPS_FOLDER = "normalization_maps"
+NORMALIZED_THUMBNAILS_FOLDER = "thumbnails"
+
 DEFAULT_NORMALIZATION_SIZE = 501
+
+#
+# Memory budget of the cache of normalization remap tables.
+#
+NORMALIZATION_CACHE_MB = 128
+
+#
+# Disk budget of the stored normalization remap tables (per calibration).
+#
+NORMALIZATION_MAPS_MAX_MB = 64
+
+#
+# Number of per day images dataframes kept in memory by the server.
+#
+IMAGES_DF_CACHE_DAYS = 8
+
+#
+# Number of per day frame archives kept open.
+#
+ARCHIVE_CACHE_DAYS = 8
+
+#
+# Memory budget of the cache of decoded (stored) frames.
+#
+FRAME_CACHE_MB = 128
+
+#
+# Memory and disk budgets of the cache of seek replies. A disk budget of 0
+# disables spilling the replies to disk.
+#
+SEEK_CACHE_MB = 64
+SEEK_CACHE_SPILL_MB = 0
+
 #
 # Amit:
 # The default radiometric settings were taken from camera 109.
@@ -411,8 +523,12 @@ def initPaths(HOME_PATH=None):
     global UPLOAD_CMD
     global VIGNETTING_SETTINGS_PATH
     global RADIOMETRIC_SETTINGS_PATH
+    global CATALOG_PATH
+    global SEEK_CACHE_PATH
 
     CAPTURE_PATH = os.path.join(HOME_PATH, 'captured_images')
+    CATALOG_PATH = os.path.join(HOME_PATH, 'captured_images.sqlite')
+    SEEK_CACHE_PATH = os.path.join(HOME_PATH, 'seek_cache')
     GENERAL_SETTINGS_PATH = os.path.join(HOME_PATH, '.camera_data.json')
     CAPTURE_SETTINGS_PATH = os.path.join(HOME_PATH, '.capture_data.json')
     VIGNETTING_SETTINGS_PATH = os.path.join(HOME_PATH, VIGNETTING_SETTINGS_FILENAME)
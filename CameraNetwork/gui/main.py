@@ -2014,7 +2014,7 @@ class ServerModel(Atom):
 
         subprocess.Popen(putty_cmd)
 
-    def reply_status(self, git_result, memory_result):
+    def reply_status(self, git_result, memory_result, stats=None):
         """Open the putty client"""
 
         self.status_text = \
@@ -2022,6 +2022,18 @@ class ServerModel(Atom):
             memory_result[0], git_result[0]
         )
 
+        if stats:
+            stats_lines = []
+            for name in sorted(stats.keys()):
+                stats_lines.append("{}: {}".format(
+                    name,
+                    ", ".join(
+                        "{}={}".format(k, v) for k, v in sorted(stats[name].items()))
+                ))
+
+            self.status_text += "\n\nStatistics:\n-----------\n{}".format(
+                "\n".join(stats_lines))
+
     def reply_get_settings(self, camera_settings, capture_settings):
         """Handle reply of settings."""
 
@@ -0,0 +1,400 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+HDR bracketing and merging utilities.
+"""
+from __future__ import division
+import logging
+import numpy as np
+import time
+
+__all__ = (
+    'BracketPlanner',
+    'HDRMerger',
+)
+
+#
+# Limits (in uint8 values) of well exposed pixels. Same as in calcHDR.
+#
+HDR_LOW_LIMIT = 20
+HDR_HIGH_LIMIT = 230
+
+#
+# Weighting schemes of the HDR merge.
+#
+HDR_WINDOW = 'window'
+HDR_HAT = 'hat'
+HDR_SNR = 'snr'
+HDR_WEIGHTINGS = (HDR_WINDOW, HDR_HAT, HDR_SNR)
+
+#
+# Maximal exposure of an HDR bracket.
+#
+HDR_MAX_EXPOSURE = 6000000  # [usec]
+
+
+class BracketPlanner(object):
+    """Histogram driven planner of an HDR exposures bracket.
+
+    The bracket starts at the base exposure and goes up. After each frame,
+    the histogram of the frame is used to decide whether a longer exposure
+    is needed and by which factor. The factor is bounded so that the
+    well exposed ranges of consecutive frames overlap, which keeps the merge
+    of `calcHDR` valid. The bracket stops early when the frame has no
+    (significant) under exposed pixels, when the maximal exposure is
+    reached or when the next frame would overrun the time budget.
+
+    The saturation of the first frame is kept between cycles: a saturated
+    first frame makes the next cycle start at a shorter exposure.
+
+    Args:
+        max_frames (int): Maximal number of frames (the hdr mode).
+        time_budget (float, optional): Time budget (in seconds) of a
+            bracket. None means no budget.
+        low_limit, high_limit (int, optional): Limits of well exposed pixels.
+        dark_thresh (float, optional): Fraction of under exposed pixels
+            below which the bracket stops.
+        saturation_thresh (float, optional): Fraction of saturated pixels
+            in the first frame above which the next cycle starts shorter.
+        min_step, max_step (float, optional): Bounds of the exposure factor
+            between consecutive frames.
+        max_exposure_us (int, optional): Maximal exposure of the bracket.
+        subsample (int, optional): Stride used for computing the histograms.
+    """
+
+    def __init__(
+            self,
+            max_frames,
+            time_budget=None,
+            low_limit=HDR_LOW_LIMIT,
+            high_limit=HDR_HIGH_LIMIT,
+            dark_thresh=0.01,
+            saturation_thresh=0.001,
+            min_step=2,
+            max_step=8,
+            max_exposure_us=HDR_MAX_EXPOSURE,
+            subsample=4):
+
+        self.max_frames = max_frames
+        self.time_budget = time_budget
+        self.low_limit = low_limit
+        self.high_limit = high_limit
+        self.dark_thresh = dark_thresh
+        self.saturation_thresh = saturation_thresh
+        self.min_step = min_step
+        self.max_step = max_step
+        self.max_exposure_us = max_exposure_us
+        self.subsample = subsample
+
+        #
+        # Scale of the base exposure, carried between cycles.
+        #
+        self.start_scale = 1.
+        self.min_start_scale = 1 / max_step
+
+        self._reset()
+
+    def _reset(self):
+
+        self.exposures = []
+        self.dark_fractions = []
+        self.saturated_fractions = []
+        self.stop_reason = None
+        self._cycle_scale = self.start_scale
+        self._start_time = None
+        self._frame_overhead = 0.
+
+    def start(self, base_exposure_us):
+        """Start planning a new bracket.
+
+        Args:
+            base_exposure_us (int): The nominal first exposure.
+
+        Returns:
+            The first exposure of the bracket.
+        """
+
+        self._reset()
+        self._start_time = time.time()
+        self._last_frame_time = self._start_time
+        self._cycle_scale = self.start_scale
+
+        return max(1, int(base_exposure_us * self.start_scale))
+
+    def histogram_stats(self, img):
+        """Calculate the under exposed and saturated fractions of a frame."""
+
+        s = self.subsample
+        sample = img[::s, ::s] if img.ndim >= 2 else img
+        hist = np.bincount(
+            np.clip(sample, 0, 255).astype(np.uint8).ravel(), minlength=256)
+        total = hist.sum()
+
+        dark = hist[:self.low_limit].sum() / total
+        saturated = hist[self.high_limit + 1:].sum() / total
+        low_quantile = np.searchsorted(
+            np.cumsum(hist), self.dark_thresh * total, side='right')
+
+        return dark, saturated, low_quantile
+
+    def next(self, img, exposure_us, frames_num=1):
+        """Register a captured frame and plan the next exposure.
+
+        Args:
+            img (array): The captured (averaged) frame.
+            exposure_us (float): The actual exposure of the frame.
+            frames_num (int, optional): Number of frames averaged per
+                exposure. Used for estimating the time of the next capture.
+
+        Returns:
+            The next exposure, or None if the bracket should stop. The
+            reason is stored in `stop_reason`.
+        """
+
+        now = time.time()
+        dark, saturated, low_quantile = self.histogram_stats(img)
+
+        self.exposures.append(float(exposure_us))
+        self.dark_fractions.append(float(dark))
+        self.saturated_fractions.append(float(saturated))
+
+        #
+        # Estimate the per frame overhead (transfer, settings) from the
+        # last capture.
+        #
+        self._frame_overhead = max(
+            0., (now - self._last_frame_time) / max(1, frames_num) - exposure_us * 1e-6)
+        self._last_frame_time = now
+
+        if len(self.exposures) == 1 and self.max_frames > 1:
+            self._updateStartScale(saturated, dark)
+
+        if len(self.exposures) >= self.max_frames:
+            self.stop_reason = 'max_frames'
+            return None
+
+        if dark <= self.dark_thresh:
+            self.stop_reason = 'well_exposed'
+            return None
+
+        if exposure_us >= self.max_exposure_us:
+            self.stop_reason = 'max_exposure'
+            return None
+
+        #
+        # Choose the step so that the low quantile of the frame reaches the
+        # low limit.
+        #
+        step = self.low_limit / max(low_quantile, 1)
+        step = min(max(step, self.min_step), self.max_step)
+        next_exposure = int(min(exposure_us * step, self.max_exposure_us))
+
+        if self.time_budget is not None:
+            expected = frames_num * (next_exposure * 1e-6 + self._frame_overhead)
+            if now - self._start_time + expected > self.time_budget:
+                self.stop_reason = 'time_budget'
+                return None
+
+        return next_exposure
+
+    def _updateStartScale(self, saturated, dark):
+        """Adapt the start exposure of the next cycle."""
+
+        if saturated > self.saturation_thresh:
+            self.start_scale = max(self.start_scale / 2, self.min_start_scale)
+        elif dark > self.dark_thresh and self.start_scale < 1:
+            self.start_scale = min(self.start_scale * 2, 1.)
+
+    @property
+    def plan(self):
+        """The plan of the current bracket (so far)."""
+
+        return dict(
+            exposures_us=list(self.exposures),
+            dark_fractions=list(self.dark_fractions),
+            saturated_fractions=list(self.saturated_fractions),
+            start_scale=self._cycle_scale,
+            stop_reason=self.stop_reason,
+            low_limit=self.low_limit,
+            high_limit=self.high_limit,
+        )
+
+
+class HDRMerger(object):
+    """Streaming weighted merge of an HDR bracket.
+
+    The frames are added one at a time (in any order) and accumulated in a
+    float32 weighted sum (of frame/exposure) and a float32 sum of weights,
+    i.e. only two planes are kept regardless of the number of frames.
+
+    The weighting schemes are:
+
+    * window - Weight 1 for well exposed values (between the low and high
+      limits) and 0 otherwise. The shortest exposure is used also for the
+      high values and the longest for the low values. This is the merge of
+      `calcHDR`.
+    * hat - The window with a triangle weight that peaks at mid range. The
+      open side of the shortest/longest exposure is not attenuated.
+    * snr - The window with the inverse variance weight of a shot + read
+      noise model: t^2 / (value + read_noise^2).
+
+    Pixels that are not well exposed in any frame are NaN.
+
+    Args:
+        exposures (list): Exposures of the frames of the bracket.
+        weighting (str, optional): Weighting scheme (see above).
+        low_limit, high_limit (float, optional): Limits of well exposed
+            values.
+        read_noise (float, optional): Read noise (in pixel values) of the
+            snr weighting.
+        tile_rows (int, optional): Accumulate the frames in tiles of this
+            number of rows. This limits the temporaries of the merge to a
+            tile, for low memory devices. None means the whole frame.
+    """
+
+    def __init__(
+        self,
+        exposures,
+        weighting=HDR_WINDOW,
+        low_limit=HDR_LOW_LIMIT,
+        high_limit=HDR_HIGH_LIMIT,
+        read_noise=1.,
+        tile_rows=None):
+
+        if weighting not in HDR_WEIGHTINGS:
+            raise ValueError("Unknown HDR weighting: {}".format(weighting))
+
+        self.exposures = sorted(exposures)
+        self.weighting = weighting
+        self.low_limit = low_limit
+        self.high_limit = high_limit
+        self.read_noise = read_noise
+        self.tile_rows = tile_rows
+
+        self._used = [False] * len(self.exposures)
+        self._sum = None
+        self._weights = None
+
+    def _rank(self, exposure):
+        """Position of a frame in the (sorted) bracket."""
+
+        for i, e in enumerate(self.exposures):
+            if e == exposure and not self._used[i]:
+                self._used[i] = True
+                return i
+
+        raise ValueError(
+            "Exposure {} is not (or no longer) part of the bracket {}".format(
+                exposure, self.exposures))
+
+    def add(self, img, exposure):
+        """Add a frame to the merge."""
+
+        i = self._rank(exposure)
+        if i == 0:
+            limits = self.low_limit, np.inf
+        elif i == len(self.exposures) - 1:
+            limits = -np.inf, self.high_limit
+        else:
+            limits = self.low_limit, self.high_limit
+
+        if self._sum is None:
+            self._sum = np.zeros(img.shape, dtype=np.float32)
+            self._weights = np.zeros(img.shape, dtype=np.float32)
+
+        rows = self.tile_rows or img.shape[0]
+        for r in range(0, img.shape[0], rows):
+            self._addTile(
+                img[r:r+rows],
+                exposure,
+                limits,
+                self._sum[r:r+rows],
+                self._weights[r:r+rows]
+            )
+
+    def _addTile(self, img, exposure, limits, sum_tile, weights_tile):
+
+        low, high = limits
+        z = img.astype(np.float32)
+        w = ((z >= low) & (z <= high)).astype(np.float32)
+
+        if self.weighting == HDR_HAT:
+            mid = 127.5
+            hat = 1 - np.abs(z / mid - 1)
+            np.maximum(hat, 0, out=hat)
+            if high == np.inf:
+                hat[z > mid] = 1
+            if low == -np.inf:
+                hat[z < mid] = 1
+            w *= hat
+        elif self.weighting == HDR_SNR:
+            t = np.float32(exposure / self.exposures[-1])
+            snr = np.maximum(z, 0)
+            snr += self.read_noise ** 2
+            np.divide(t * t, snr, out=snr)
+            w *= snr
+
+        z *= w
+        z *= np.float32(1 / exposure)
+        sum_tile += z
+        weights_tile += w
+
+    def result(self):
+        """The merged float32 image.
+
+        Note:
+            The result is computed in place of the accumulated sum.
+        """
+
+        if self._sum is None:
+            raise Exception("No frames were added to the merge.")
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(self._sum, self._weights, out=self._sum)
+
+        self._weights = None
+
+        return self._sum
+
+    def merge(self, img_arrays, img_exposures):
+        """Merge all the frames of the bracket."""
+
+        for img, exposure in zip(img_arrays, img_exposures):
+            self.add(img, exposure)
+
+        return self.result()
@@ -37,11 +37,20 @@
 General utilities for image processing.
 """
 from __future__ import division, absolute_import, print_function
+import CameraNetwork.global_settings as gs
+from CameraNetwork.hdr import HDRMerger
+from CameraNetwork.utils import LRUCache
 from CameraNetwork.utils import obj
 import cv2
+import glob
+import hashlib
+import itertools
 import logging
 import numpy as np
+import os
 import pymap3d
+import threading
+import traceback
 
 try:
     import futures
@@ -73,25 +82,74 @@ def calcHDR(img_arrays, img_exposures, low_limit=20, high_limit=230):
         HDR image merged from the image arrays. There idea is that the shortest
         exposure is used for the high RGB values, and the longest for the low
         values. The other values are averaged from all images. The HDR image
-        returned is float in units of [RGB/ms]
+        returned is float32 in units of [RGB/ms]. Values that are not well
+        exposed in any image are NaN.
+
+    Note:
+        The images are merged by `HDRMerger` (window weighting), see it for
+        other weightings and a streaming merge.
 
     """
 
-    hdr_imgs = []
-    for i, (img, exp) in enumerate(zip(img_arrays, img_exposures)):
-        hdr_img = img.copy().astype(np.float) / exp
-        if i == 0:
-            mask_min, mask_max = low_limit, 255
-        elif i == len(img_arrays)-1:
-            mask_min, mask_max = 0, high_limit
-        else:
-            mask_min, mask_max = low_limit, high_limit
+    merger = HDRMerger(
+        img_exposures, low_limit=low_limit, high_limit=high_limit)
+
+    return merger.merge(img_arrays, img_exposures)
+
+
+#
+# Maximal value of a compact (sum of frames) array.
+#
+COMPACT_MAX_VALUE = 2**16 - 1
+
+
+def compactFrame(img_array, frames_num):
+    """Convert an averaged frame to a compact sum of frames.
+
+    Args:
+        img_array (array): Average of frames_num 8bit frames.
+        frames_num (int): Number of averaged frames.
+
+    Returns:
+        compact_array, scale. compact_array is a uint16 array of the
+        (rounded) sum of frames divided by scale.
+
+    Note:
+        The sum of up to 256 8bit frames fits in uint16, i.e. the scale
+        is 1 and the compaction is lossless.
+    """
+
+    img_sum = np.rint(np.asarray(img_array, dtype=np.float32) * frames_num)
+
+    scale = max(1, int(np.ceil(img_sum.max() / COMPACT_MAX_VALUE)))
+    if scale > 1:
+        img_sum = np.rint(img_sum / scale)
+
+    return img_sum.astype(np.uint16), scale
+
+
+def expandFrame(img_array, img_data):
+    """Restore the averaged values of a compact frame.
+
+    Args:
+        img_array (array): Stored array.
+        img_data (DataObj): Data object of the frame. Compact frames have
+            the ``sum_frames`` and ``sum_scale`` attributes.
+
+    Returns:
+        The averaged frame (float32). Arrays that were not compacted are
+        returned as is. A compact single frame is returned as uint8.
+    """
+
+    frames_num = getattr(img_data, 'sum_frames', None)
+    if frames_num is None:
+        return img_array
 
-        mask = (img < mask_min) | (img > mask_max)
-        hdr_img[mask] = np.nan
-        hdr_imgs.append(hdr_img)
+    scale = img_data.sum_scale
+    if frames_num == 1 and scale == 1:
+        return img_array.astype(np.uint8)
 
-    return np.nanmean(hdr_imgs, axis=0)
+    return img_array.astype(np.float32) * np.float32(scale / frames_num)
 
 
 def raw2RGB(img, dtype=None):
@@ -108,6 +166,64 @@ def raw2RGB(img, dtype=None):
     return R, ((G1+G2)/2).astype(R.dtype), B
 
 
+def bayerPlanes(img, out=None):
+    """Pack the Bayer planes of a Raw image as channels.
+
+    Args:
+        img (array): Raw image.
+        out (array, optional): Array (of shape (h/2, w/2, 4)) to store the
+            result in.
+
+    Returns:
+        Array of shape (h/2, w/2, 4) of the R, G, G, B planes (in the layout
+        of raw2RGB), copied from the image in a single pass.
+    """
+
+    h, w = img.shape[0] // 2, img.shape[1] // 2
+    planes = img[:2*h, :2*w].reshape(h, 2, w, 2)
+
+    return cv2.merge(
+        [planes[:, 0, :, 0], planes[:, 0, :, 1], planes[:, 1, :, 0], planes[:, 1, :, 1]],
+        out
+    )
+
+
+def bayerThumbnail(img, factor=4):
+    """Area downsample a frame to an RGB thumbnail in one pass.
+
+    Args:
+        img (array): Raw (Bayer mosaic, 2D) or RGB (3D) frame.
+        factor (int, optional): Downsample factor. Must be even for raw
+            frames. The default (4) turns a 1200x1600 frame to a 300x400
+            thumbnail.
+
+    Returns:
+        uint8 RGB thumbnail.
+
+    Note:
+        Each thumbnail pixel of a raw frame averages the R, G and B pixels of
+        its factor x factor block of the mosaic, i.e. debayering and
+        downsampling are done together.
+    """
+
+    h, w = img.shape[:2]
+    th, tw = h // factor, w // factor
+    blocks = img[:th*factor, :tw*factor].reshape((th, factor, tw, factor) + img.shape[2:])
+
+    if img.ndim == 2:
+        n = (factor // 2) ** 2
+        thumb = np.empty((th, tw, 3), dtype=np.float32)
+        thumb[..., 0] = blocks[:, 0::2, :, 0::2].sum(axis=(1, 3), dtype=np.float32) / n
+        thumb[..., 1] = (
+            blocks[:, 1::2, :, 0::2].sum(axis=(1, 3), dtype=np.float32) +
+            blocks[:, 0::2, :, 1::2].sum(axis=(1, 3), dtype=np.float32)) / (2 * n)
+        thumb[..., 2] = blocks[:, 1::2, :, 1::2].sum(axis=(1, 3), dtype=np.float32) / n
+    else:
+        thumb = blocks.sum(axis=(1, 3), dtype=np.float32) / factor**2
+
+    return np.clip(thumb, 0, 255).astype(np.uint8)
+
+
 def RGB2raw(R, G, B):
     """Convert RGB channels to Raw image."""
 
@@ -269,11 +385,218 @@ class FisheyeProxy(object):
         return phi, theta, mask
 
 
+#
+# dtypes that cv2.remap supports.
+#
+REMAP_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+
+class RemapTable(object):
+    """Fixed point remap table.
+
+    The float maps are converted once (`cv2.convertMaps`) to fixed point
+    (CV_16SC2) tables, which cv2.remap applies considerably faster. When
+    the shape of the source image is given, the tight mask (pixels that
+    are mapped inside the source image, eroded by one pixel) is also
+    computed once, and the pixels outside of it are mapped out of the
+    image so that the remap itself zeros them.
+
+    Args:
+        Xmap, Ymap (array): float32 maps of the x and y source coords.
+        src_shape (tuple, optional): Shape of the source images. Needed for
+            the tight mask.
+        mask (array, optional): Mask of valid pixels of the maps (combined
+            with the tight mask).
+        border_value (float, optional): Value of pixels mapped outside of
+            the source image. Ignored (0) when src_shape is given.
+    """
+
+    def __init__(self, Xmap, Ymap, src_shape=None, mask=None, border_value=0):
+
+        #
+        # 1D maps (sampling coords) are handled as a column.
+        #
+        if Xmap.ndim == 1:
+            Xmap, Ymap = Xmap.reshape(-1, 1), Ymap.reshape(-1, 1)
+
+        Xmap = np.array(Xmap, dtype=np.float32)
+        Ymap = np.array(Ymap, dtype=np.float32)
+        self.map1, self.map2 = cv2.convertMaps(Xmap, Ymap, cv2.CV_16SC2)
+        self.shape = tuple(Xmap.shape)
+        self.border_value = border_value
+
+        if src_shape is None:
+            self.tight_mask = None
+            return
+
+        #
+        # Pixels that are interpolated (partly) from outside of the image
+        # are not valid.
+        #
+        coverage = cv2.remap(
+            np.ones(src_shape[:2], dtype=np.float32),
+            self.map1,
+            self.map2,
+            cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0
+        )
+        tight_mask = coverage > 0.999
+        if mask is not None:
+            tight_mask &= mask
+
+        #
+        # Erod one pixel from the tight mask
+        #
+        self.tight_mask = cv2.erode(
+            tight_mask.astype(np.uint8),
+            kernel=np.ones((3, 3), dtype=np.uint8)
+            ).astype(np.bool)
+        self.tight_mask.flags.writeable = False
+
+        #
+        # Map the pixels outside the tight mask out of the image.
+        #
+        Xmap[~self.tight_mask] = -10
+        Ymap[~self.tight_mask] = -10
+        self.map1, self.map2 = cv2.convertMaps(Xmap, Ymap, cv2.CV_16SC2)
+        self.border_value = 0
+
+    @staticmethod
+    def dtype(img_dtype):
+        """dtype of the remapped image of a source dtype."""
+
+        if img_dtype in REMAP_DTYPES:
+            return img_dtype
+
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+
+        nbytes = self.map1.nbytes + self.map2.nbytes
+        if self.tight_mask is not None:
+            nbytes += self.tight_mask.nbytes
+
+        return nbytes
+
+    def remap(self, img, out=None):
+        """Remap an image.
+
+        Args:
+            img (array): Source image. Images of dtypes that are not
+                supported by cv2.remap are remapped as float32.
+            out (array, optional): Array to store the result in.
+        """
+
+        img = np.ascontiguousarray(img, dtype=self.dtype(img.dtype))
+        if out is None:
+            out = np.empty(self.shape + img.shape[2:], dtype=img.dtype)
+
+        out = cv2.remap(
+            img,
+            self.map1,
+            self.map2,
+            cv2.INTER_LINEAR,
+            dst=out,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=self.border_value
+        )
+
+        return out
+
+
+#
+# Cache of the normalization grids and remap tables. The cache is shared
+# by all the Normalization objects and bounded by memory.
+#
+NORMALIZATION_CACHE = LRUCache(max_bytes=gs.NORMALIZATION_CACHE_MB * 2**20)
+
+#
+# Unique keys of fisheye models that are not loaded from a file.
+#
+_model_keys = itertools.count()
+
+
+def fileHash(path):
+    """sha1 hash of the contents of a file."""
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def arrayHash(arr):
+    """sha1 hash of the values of an array."""
+
+    return hashlib.sha1(
+        np.ascontiguousarray(arr, dtype=np.float64).tostring()).hexdigest()
+
+
+def pruneMaps(maps_folder, max_bytes, keep=None):
+    """Remove the least recently used remap tables above a disk budget.
+
+    The tables are ordered by their modification time, which is updated
+    whenever a table is loaded.
+
+    Args:
+        maps_folder (str): Folder of the stored remap tables.
+        max_bytes (int): Disk budget of the folder.
+        keep (str, optional): Path of a table that should not be removed.
+    """
+
+    maps = []
+    for path in glob.glob(os.path.join(maps_folder, "*.npy")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        maps.append((st.st_mtime, st.st_size, path))
+
+    total_bytes = sum(m[1] for m in maps)
+    for _, size, path in sorted(maps):
+        if total_bytes <= max_bytes:
+            break
+        if path == keep:
+            continue
+
+        try:
+            os.remove(path)
+            total_bytes -= size
+            logging.debug("Removed normalization maps: {}".format(path))
+        except OSError:
+            logging.warn("Failed removing normalization maps: {}".format(path))
+
+
 class Normalization(object):
     """Normalized Image Class
 
     This class encapsulates the conversion between captured image and
     the normalized image.
+
+    Args:
+        resolution (int): Resolution of the normalized image.
+        fisheye_model (FisheyeProxy): Intrinsic model of the camera.
+        Rot (array, optional): Extrinsic rotation.
+        fov (float, optional): Field of view of the normalized image.
+        calibration_path (str, optional): Path of the file that the fisheye
+            model was loaded from.
+        bayer_remap (bool, optional): Normalize Raw images by remapping
+            their packed Bayer planes (see `bayerPlanes`) directly, instead
+            of converting them to RGB (raw2RGB) first.
+
+    Note:
+        The remap tables are cached (see `NORMALIZATION_CACHE`) by the
+        calibration (path and file hash), the rotation, the resolution and
+        the shape of the normalized image. Switching between resolutions,
+        days (rotations) or cameras does not recalculate them.
+        When the calibration path is given, the remap tables are also
+        stored next to it (in NORMALIZATION_MAPS_FOLDER) and memory mapped
+        by later instances (e.g. after a restart) instead of projecting the
+        grid through the fisheye model.
     """
 
     def __init__(
@@ -281,12 +604,25 @@ class Normalization(object):
         resolution,
         fisheye_model,
         Rot=np.eye(3),
-        fov=np.pi/2
+        fov=np.pi/2,
+        calibration_path=None,
+        bayer_remap=True
         ):
 
         self._fisheye_model = fisheye_model
         self._Rot = Rot
+        self._R_hash = arrayHash(Rot)
         self.fov = fov
+        self.bayer_remap = bayer_remap
+        self._local = threading.local()
+
+        if calibration_path is not None and os.path.exists(calibration_path):
+            self._calibration_key = (calibration_path, fileHash(calibration_path))
+            self._maps_folder = os.path.join(
+                os.path.dirname(calibration_path), gs.NORMALIZATION_MAPS_FOLDER)
+        else:
+            self._calibration_key = ('model', next(_model_keys))
+            self._maps_folder = None
 
         self.calc_normalization_map(resolution)
 
@@ -299,30 +635,76 @@ class Normalization(object):
         logging.debug('Calculating normalization map.')
         self.resolution = resolution
 
-        #
-        # Create a grid of directions.
-        # The coordinates create a 'linear' fisheye, where the distance
-        # from the center ranges between 0-pi/2 linearly.
-        #
-        X, Y = np.meshgrid(
-            np.linspace(-1, 1, self.resolution),
-            np.linspace(-1, 1, self.resolution)
-        )
+        key = ('grid', self.resolution, self.fov)
+        grid = NORMALIZATION_CACHE.get(key)
+        if grid is None:
+            #
+            # Create a grid of directions.
+            # The coordinates create a 'linear' fisheye, where the distance
+            # from the center ranges between 0-pi/2 linearly.
+            #
+            X, Y = np.meshgrid(
+                np.linspace(-1, 1, self.resolution),
+                np.linspace(-1, 1, self.resolution)
+            )
+
+            PHI = np.arctan2(Y, X)
+            PSI = self.fov * np.sqrt(X**2 + Y**2)
+            mask = PSI <= self.fov
+            PSI[~mask] = self.fov
+
+            z = np.cos(PSI)
+            x = np.sin(PSI) * np.cos(PHI)
+            y = np.sin(PSI) * np.sin(PHI)
 
-        self._PHI = np.arctan2(Y, X)
-        self._PSI = self.fov * np.sqrt(X**2 + Y**2)
-        self.mask = self._PSI <= self.fov
-        self._PSI[~self.mask] = self.fov
+            XYZ = np.hstack((x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)))
 
-        z = np.cos(self._PSI)
-        x = np.sin(self._PSI) * np.cos(self._PHI)
-        y = np.sin(self._PSI) * np.sin(self._PHI)
+            grid = (PHI, PSI, mask, XYZ)
+            for arr in grid:
+                arr.flags.writeable = False
+            NORMALIZATION_CACHE.put(key, grid)
 
-        self.XYZ = np.hstack((x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)))
+        self._PHI, self._PSI, self.mask, self.XYZ = grid
 
         self.update_rotation()
 
     def update_rotation(self):
+
+        self._Xmap, self._Ymap = self._maps(self._fisheye_model.img_shape)
+
+    def _maps(self, shape):
+        """Get the (cached) remap tables of an image shape."""
+
+        shape = tuple(shape[:2])
+        key = (self._calibration_key, self._R_hash, self.resolution, self.fov, shape)
+        maps = NORMALIZATION_CACHE.get(key)
+        if maps is not None:
+            return maps
+
+        calib_shape = tuple(self._fisheye_model.img_shape)
+        if shape == calib_shape:
+            maps = self._loadMaps()
+            if maps is None:
+                maps = self._projectMaps()
+                self._saveMaps(*maps)
+        else:
+            #
+            # The fisheye model is adapted to the size of the image.
+            #
+            Xmap, Ymap = self._maps(calib_shape)
+            x_scale = float(shape[1]) / float(calib_shape[1])
+            y_scale = float(shape[0]) / float(calib_shape[0])
+            maps = (Xmap * x_scale, Ymap * y_scale)
+
+        for arr in maps:
+            arr.flags.writeable = False
+        NORMALIZATION_CACHE.put(key, maps)
+
+        return maps
+
+    def _projectMaps(self):
+        """Calculate the remap tables by projecting the grid of directions."""
+
         #
         # Rot is the rotation applied to the camera coordinates to turn into world coordinates.
         # So I multiply from the right (like multiplying with the inverse of the matrix).
@@ -331,10 +713,90 @@ class Normalization(object):
         XYZ_rotated = np.dot(self.XYZ, self._Rot)
         YXmap = self._fisheye_model.projectPoints(XYZ_rotated)
 
-        self._Xmap = np.array(YXmap[:, 1], dtype=np.float32).reshape((self.resolution, self.resolution))
-        self._Ymap = np.array(YXmap[:, 0], dtype=np.float32).reshape((self.resolution, self.resolution))
-        self._Xmap[~self.mask] = -1
-        self._Ymap[~self.mask] = -1
+        Xmap = np.array(YXmap[:, 1], dtype=np.float32).reshape((self.resolution, self.resolution))
+        Ymap = np.array(YXmap[:, 0], dtype=np.float32).reshape((self.resolution, self.resolution))
+        Xmap[~self.mask] = -1
+        Ymap[~self.mask] = -1
+
+        return Xmap, Ymap
+
+    def _mapsPath(self):
+        """Path of the stored remap tables of the current settings."""
+
+        if self._maps_folder is None:
+            return None
+
+        digest = hashlib.sha1(
+            "{}_{}_{}_{!r}".format(
+                self._calibration_key[1], self._R_hash, self.resolution, self.fov)
+        ).hexdigest()
+
+        return os.path.join(
+            self._maps_folder, "{}_{}.npy".format(self.resolution, digest[:20]))
+
+    def _loadMaps(self):
+        """Memory map stored remap tables (None if not stored)."""
+
+        maps_path = self._mapsPath()
+        if maps_path is None or not os.path.exists(maps_path):
+            return None
+
+        try:
+            maps = np.load(maps_path, mmap_mode='r')
+        except:
+            logging.error(
+                "Failed loading normalization maps from {}:\n{}".format(
+                    maps_path, traceback.format_exc()))
+            return None
+
+        logging.debug('Loaded normalization map from {}.'.format(maps_path))
+
+        #
+        # Mark the tables as recently used (see `pruneMaps`).
+        #
+        try:
+            os.utime(maps_path, None)
+        except OSError:
+            pass
+
+        return maps[0], maps[1]
+
+    def _saveMaps(self, Xmap, Ymap):
+        """Store remap tables (next to the calibration)."""
+
+        maps_path = self._mapsPath()
+        if maps_path is None:
+            return
+
+        try:
+            if not os.path.exists(self._maps_folder):
+                os.makedirs(self._maps_folder)
+
+            #
+            # Write to a temporary file (unique per process and thread) and
+            # rename, so that a partially written file is never mapped.
+            #
+            tmp_path = maps_path + '.{}.{}.tmp'.format(
+                os.getpid(), threading.current_thread().ident)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.stack((Xmap, Ymap)))
+            os.rename(tmp_path, maps_path)
+
+            pruneMaps(
+                self._maps_folder,
+                gs.NORMALIZATION_MAPS_MAX_MB * 2**20,
+                keep=maps_path
+            )
+        except:
+            logging.error(
+                "Failed saving normalization maps to {}:\n{}".format(
+                    maps_path, traceback.format_exc()))
+
+    @staticmethod
+    def cacheStats():
+        """Hit/miss counters and memory of the normalization cache."""
+
+        return NORMALIZATION_CACHE.stats
 
     @property
     def R(self):
@@ -346,25 +808,36 @@ class Normalization(object):
             return
 
         self._Rot = R
+        self._R_hash = arrayHash(R)
         self.update_rotation()
 
-    def normalize(self, img):
+    def normalize(self, img, reuse_buffer=False):
         """Normalize Image
 
         Apply normalization to image.
+
+        Args:
+            img (array): Image to normalize. 2D images are assumed to be
+                RAW.
+            reuse_buffer (bool, optional): Store the normalized image in a
+                per thread buffer that is overwritten by the next call.
+
         Note:
         The fisheye model is adapted to the size of the image, therefore
         different sized images (1200x1600 or 600x800) can be normalized.
+        The image is remapped in its dtype if supported by cv2 (see
+        `RemapTable`).
         """
 
-        import cv2
-
         logging.debug('Applying normalization to image.')
-        self._tight_mask = self.mask.copy()
 
         if img is None:
+            self._tight_mask = self.mask.copy()
             return np.zeros((self.resolution, self.resolution, 3))
 
+        if img.ndim == 2 and self.bayer_remap:
+            return self._normalizeBayer(img, reuse_buffer)
+
         #
         # 2D images are assumed to be RAW, and converted to RGB
         #
@@ -374,51 +847,77 @@ class Normalization(object):
 
         logging.debug('Normalizing shape: {}'.format(img.shape))
 
-        #
-        # Check if there is need to scale the images
-        #
-        calib_shape = self._fisheye_model.img_shape
-        if img.shape[:2] != calib_shape:
-            x_scale = float(img.shape[1]) / float(calib_shape[1])
-            y_scale = float(img.shape[0]) / float(calib_shape[0])
-            Xmap = self._Xmap * x_scale
-            Ymap = self._Ymap * y_scale
-        else:
-            Xmap = self._Xmap
-            Ymap = self._Ymap
-
-        img_dtype = img.dtype
-        BORDER_MAP_VALUE = 100000
-        normalized_img = cv2.remap(
-            img.astype(np.float),
-            Xmap,
-            Ymap,
-            cv2.INTER_AREA,
-            borderMode=cv2.BORDER_CONSTANT,
-            borderValue=BORDER_MAP_VALUE
+        table = self._table(img.shape)
+        self._tight_mask = table.tight_mask
+
+        out = None
+        if reuse_buffer:
+            out = self._buffer('out', table.shape + img.shape[2:], table.dtype(img.dtype))
+
+        return table.remap(img, out=out)
+
+    def _buffer(self, name, shape, dtype):
+        """Get a per thread buffer."""
+
+        buff = getattr(self._local, name, None)
+        if buff is None or buff.shape != shape or buff.dtype != dtype:
+            buff = np.empty(shape, dtype=dtype)
+            setattr(self._local, name, buff)
+
+        return buff
+
+    def _normalizeBayer(self, img, reuse_buffer=False):
+        """Normalize a Raw image by remapping its Bayer planes.
+
+        The four Bayer planes are packed as channels and remapped together
+        by the table of the RGB (half size) image. As the remap is linear,
+        averaging the two remapped green planes is the same as remapping
+        their average (as in raw2RGB).
+        """
+
+        logging.debug('Normalizing raw shape: {}'.format(img.shape))
+
+        dtype = RemapTable.dtype(img.dtype)
+        rgb_shape = (img.shape[0] // 2, img.shape[1] // 2)
+        planes = bayerPlanes(
+            img.astype(dtype, copy=False),
+            out=self._buffer('planes', rgb_shape + (4,), dtype)
         )
 
-        if normalized_img.ndim == 2:
-            self._tight_mask[normalized_img>(BORDER_MAP_VALUE-1)] = 0
+        table = self._table(rgb_shape)
+        self._tight_mask = table.tight_mask
+        remapped = table.remap(
+            planes, out=self._buffer('remapped', table.shape + (4,), dtype))
+
+        shape = table.shape + (3,)
+        if reuse_buffer:
+            out = self._buffer('out', shape, dtype)
         else:
-            self._tight_mask[normalized_img[:,:, 0]>(BORDER_MAP_VALUE-1)] = 0
+            out = np.empty(shape, dtype=dtype)
 
-        #
-        # Erod one pixel from the tight mask
-        #
-        self._tight_mask = cv2.erode(
-            self._tight_mask.astype(np.uint8),
-            kernel=np.ones((3, 3), dtype=np.uint8)
-            ).astype(np.bool)
+        out[..., 0] = remapped[..., 0]
+        out[..., 2] = remapped[..., 3]
+        if np.issubdtype(dtype, np.floating):
+            np.add(remapped[..., 1], remapped[..., 2], out=out[..., 1])
+            out[..., 1] *= 0.5
+        else:
+            out[..., 1] = (
+                remapped[..., 1].astype(np.float32) + remapped[..., 2]) / 2
 
-        #
-        # TODO: Implement radiometric correction compare with RadiometricCalibration.applyRadiometric() in calibration.py
-        #
-        #normalized_img = radiometric_correction(normalized_img, self._radiometric_model).astype(np.uint8)
-        normalized_img = normalized_img.astype(img_dtype)
-        normalized_img[self._tight_mask==0] = 0
+        return out
+
+    def _table(self, shape):
+        """Get the (cached) fixed point remap table of an image shape."""
+
+        shape = tuple(shape[:2])
+        key = ('table', self._calibration_key, self._R_hash, self.resolution, self.fov, shape)
+        table = NORMALIZATION_CACHE.get(key)
+        if table is None:
+            Xmap, Ymap = self._maps(shape)
+            table = RemapTable(Xmap, Ymap, src_shape=shape, mask=self.mask)
+            NORMALIZATION_CACHE.put(key, table)
 
-        return normalized_img
+        return table
 
     def normalCoords2Direction(self, coords):
         """Convert Normal Coord to Direction Vector
@@ -0,0 +1,626 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Capture/persist pipeline.
+
+The camera thread only acquires frames. Compressing and writing them to
+disk is handed to a bounded pool of writer threads, so that the next capture
+cycle is not delayed by the disk. Thumbnails are created later by a rate
+limited background stage.
+"""
+from __future__ import division
+from CameraNetwork.image_utils import bayerThumbnail
+import CameraNetwork.global_settings as gs
+from datetime import datetime
+import glob
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+
+try:
+    from PIL import Image
+except:
+    # In case of old version
+    import Image
+
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import futures
+except:
+    #
+    # Support also python 2.7
+    #
+    from concurrent import futures
+
+__all__ = (
+    'loadThumbnailIndex',
+    'PreviewStage',
+    'ThumbnailStage',
+    'ThumbnailStore',
+    'WriterPool',
+)
+
+
+class WriterPool(object):
+    """Bounded pool of background writers.
+
+    At most `max_pending` jobs can be queued or running at once. When the
+    writers fall behind, `submit` blocks the producer (backpressure) and the
+    time spent blocked is recorded in the statistics.
+
+    Args:
+        max_workers (int): Number of writer threads.
+        max_pending (int): Maximal number of queued and running jobs.
+    """
+
+    def __init__(self, max_workers=2, max_pending=6):
+
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+        self._stats = dict(
+            submitted=0,
+            completed=0,
+            failed=0,
+            pending=0,
+            max_pending_seen=0,
+            blocked=0,
+            blocked_seconds=0.,
+            write_seconds=0.,
+            last_write_seconds=0.,
+        )
+
+    def submit(self, fn, *args, **kwds):
+        """Submit a write job.
+
+        Blocks while `max_pending` jobs are queued or running.
+
+        Returns:
+            A (concurrent) future of the job result.
+        """
+
+        if not self._slots.acquire(False):
+            #
+            # The writers fall behind. Wait for a free slot.
+            #
+            t0 = time.time()
+            self._slots.acquire()
+            dt = time.time() - t0
+            with self._lock:
+                self._stats['blocked'] += 1
+                self._stats['blocked_seconds'] += dt
+            logging.warn(
+                "Writers fall behind, capture blocked for {:.2f} secs.".format(dt))
+
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['pending'] += 1
+            self._stats['max_pending_seen'] = max(
+                self._stats['max_pending_seen'], self._stats['pending'])
+
+        try:
+            return self._executor.submit(self._run, fn, args, kwds)
+        except:
+            self._done(None, False)
+            raise
+
+    def _run(self, fn, args, kwds):
+        """Run a write job and account for it."""
+
+        t0 = time.time()
+        success = False
+        try:
+            result = fn(*args, **kwds)
+            success = True
+            return result
+        except:
+            logging.error("Writer job failed:\n{}".format(traceback.format_exc()))
+            raise
+        finally:
+            self._done(time.time() - t0, success)
+
+    def _done(self, dt, success):
+
+        with self._lock:
+            self._stats['pending'] -= 1
+            if success:
+                self._stats['completed'] += 1
+            else:
+                self._stats['failed'] += 1
+            if dt is not None:
+                self._stats['write_seconds'] += dt
+                self._stats['last_write_seconds'] = dt
+
+        self._slots.release()
+
+    @property
+    def stats(self):
+        """Copy of the pool statistics."""
+
+        with self._lock:
+            stats = self._stats.copy()
+
+        stats['max_pending'] = self.max_pending
+        stats['workers'] = self.max_workers
+
+        return stats
+
+    def shutdown(self, wait=True):
+        """Shutdown the writers."""
+
+        self._executor.shutdown(wait=wait)
+
+
+def loadThumbnailIndex(day_path):
+    """Load the names of the completed thumbnails of a day.
+
+    Returns:
+        Set of the jpg file names (without folder) that were completed.
+    """
+
+    index_path = os.path.join(day_path, gs.THUMBNAILS_INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return set()
+
+    with open(index_path, 'rb') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+class ThumbnailStage(object):
+    """Deferred, rate limited creation of the jpeg thumbnails.
+
+    Frames are queued by the writers after they are saved. A single low
+    rate thread downsamples them (see `bayerThumbnail`), saves the jpeg and
+    appends its name to the completion index of the day. Listeners are
+    called with the path of every completed thumbnail (e.g. for uploading
+    it).
+
+    Subclasses create other products of the frames by overriding `_create`
+    (and `_reduce`, see `PreviewStage`).
+
+    Args:
+        min_interval (float, optional): Minimal time (in seconds) between
+            thumbnails, so that the stage does not compete with the capture.
+        max_pending (int, optional): Maximal number of queued full size
+            frames. When the queue is full, frames are downsampled by the
+            caller and only the small thumbnail is queued.
+        quality (int, optional): Jpeg quality.
+        name (str, optional): Name of the stage thread.
+    """
+
+    def __init__(self, min_interval=0.5, max_pending=4, quality=90, name='thumbnails'):
+
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.quality = quality
+
+        self._queue = Queue.Queue()
+        self._full_frames = threading.BoundedSemaphore(max_pending)
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stats = dict(queued=0, completed=0, failed=0, inline=0, skipped=0)
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def addListener(self, callback):
+        """Add a callback called with the path of completed thumbnails."""
+
+        self._listeners.append(callback)
+
+    def submit(self, img_array, jpg_path):
+        """Queue a saved frame for creating its thumbnail."""
+
+        self._put(img_array, (jpg_path,))
+
+    def _put(self, img_array, args):
+        """Queue a frame (and the arguments of `_create`)."""
+
+        if self._full_frames.acquire(False):
+            item = (img_array, args, True)
+        else:
+            #
+            # Too many full size frames are waiting. Keep only the
+            # (cheap) reduced frame, or skip the frame.
+            #
+            img_array = self._reduce(img_array)
+            if img_array is None:
+                with self._lock:
+                    self._stats['skipped'] += 1
+                return
+
+            item = (img_array, args, False)
+            with self._lock:
+                self._stats['inline'] += 1
+
+        with self._lock:
+            self._stats['queued'] += 1
+        self._queue.put(item)
+
+    def _reduce(self, img_array):
+        """Reduce a frame that cannot be queued at full size.
+
+        Returns:
+            The reduced frame, or None to skip the frame.
+        """
+
+        return bayerThumbnail(img_array)
+
+    def _create(self, img_array, full_frame, jpg_path):
+        """Create the thumbnail of a frame.
+
+        Returns:
+            Path passed to the listeners (None to skip them).
+        """
+
+        if full_frame:
+            img_array = bayerThumbnail(img_array)
+
+        self._save(img_array, jpg_path)
+
+        return jpg_path
+
+    def _run(self):
+
+        last_time = 0
+        while True:
+            img_array, args, full_frame = self._queue.get()
+            if args is None:
+                break
+
+            #
+            # Rate limit.
+            #
+            wait = last_time + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            last_time = time.time()
+
+            try:
+                path = self._create(img_array, full_frame, *args)
+                with self._lock:
+                    self._stats['completed'] += 1
+            except Exception:
+                logging.error("Failed creating {} of {}:\n{}".format(
+                    self._thread.name,
+                    getattr(args[0], 'name_time', args[0]),
+                    traceback.format_exc()))
+                with self._lock:
+                    self._stats['failed'] += 1
+                continue
+            finally:
+                #
+                # Free the slot of the full size frame (also on failure).
+                #
+                del img_array
+                if full_frame:
+                    self._full_frames.release()
+
+            if path is None:
+                continue
+
+            for listener in self._listeners:
+                try:
+                    listener(path)
+                except Exception:
+                    logging.error("Thumbnail listener failed:\n{}".format(
+                        traceback.format_exc()))
+
+    def _save(self, thumb, jpg_path):
+        """Save the jpeg and mark it in the completion index."""
+
+        Image.fromarray(thumb).save(jpg_path, quality=self.quality)
+        logging.debug('Saved jpg file %s' % jpg_path)
+
+        day_path, jpg_name = os.path.split(jpg_path)
+        with open(os.path.join(day_path, gs.THUMBNAILS_INDEX_FILENAME), 'ab') as f:
+            f.write(jpg_name + '\n')
+
+    @property
+    def stats(self):
+        """Copy of the stage statistics."""
+
+        with self._lock:
+            stats = self._stats.copy()
+
+        stats['pending'] = self._queue.qsize()
+
+        return stats
+
+    def stop(self):
+        """Stop the stage thread (after the queued frames)."""
+
+        self._queue.put((None, None, False))
+
+
+class ThumbnailStore(object):
+    """Store of normalized jpeg thumbnails.
+
+    The jpeg streams (as created by `Controller.seekImageArray` with
+    ``jpeg=True``) are stored per day and resolution::
+
+        CAPTURE_PATH/YYYY_MM_DD/thumbnails/<resolution>/<time>_<hdr>.jpg
+
+    Note:
+        The thumbnails depend on the calibration. The thumbnails of a day
+        are stored with the version of the calibration they were created
+        with (see `Controller.calibrationVersion`), and are removed when
+        used with another version (see `validate`).
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, saved=0, invalidated=0)
+
+        #
+        # Calibration versions of the days (validated by this store).
+        #
+        self._versions = {}
+
+    @staticmethod
+    def dayPath(query_date):
+        """Folder of the thumbnails of a day."""
+
+        return os.path.join(
+            gs.CAPTURE_PATH,
+            query_date.strftime("%Y_%m_%d"),
+            gs.NORMALIZED_THUMBNAILS_FOLDER
+        )
+
+    def validate(self, query_date, version):
+        """Remove the thumbnails of a day created with another calibration.
+
+        Args:
+            query_date (datetime): The day.
+            version (tuple): Version of the current calibration of the day.
+        """
+
+        version = list(version)
+        day = query_date.strftime("%Y_%m_%d")
+        with self._lock:
+            if self._versions.get(day) == version:
+                return
+
+            folder = self.dayPath(query_date)
+            version_path = os.path.join(folder, gs.THUMBNAILS_VERSION_FILENAME)
+            try:
+                with open(version_path, 'rb') as f:
+                    stored_version = json.load(f)
+            except (IOError, ValueError):
+                stored_version = None
+
+            if stored_version != version:
+                if os.path.isdir(folder):
+                    logging.debug(
+                        "Calibration of day {} changed, removing its thumbnails.".format(day))
+                    shutil.rmtree(folder, ignore_errors=True)
+                    self._stats['invalidated'] += 1
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    pass
+                with open(version_path, 'wb') as f:
+                    json.dump(version, f)
+
+            self._versions[day] = version
+
+    @classmethod
+    def path(cls, frame_time, hdr_index, resolution):
+        """Path of the thumbnail of a frame."""
+
+        return os.path.join(
+            cls.dayPath(frame_time),
+            str(resolution),
+            "{}_{}.jpg".format(frame_time.strftime("%Y_%m_%d_%H_%M_%S"), hdr_index)
+        )
+
+    def load(self, frame_time, hdr_index, resolution):
+        """Load a stored thumbnail.
+
+        Returns:
+            The jpeg stream (uint8 array) or None if not stored.
+        """
+
+        path = self.path(frame_time, hdr_index, resolution)
+        try:
+            with open(path, 'rb') as f:
+                jpeg_array = np.fromstring(f.read(), dtype=np.uint8)
+        except IOError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['hits'] += 1
+
+        return jpeg_array
+
+    def save(self, frame_time, hdr_index, resolution, jpeg_array):
+        """Store a thumbnail."""
+
+        path = self.path(frame_time, hdr_index, resolution)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                #
+                # Created by another thread.
+                #
+                pass
+
+        #
+        # Write to a unique temporary file and rename it, so that
+        # concurrent saves (of the same thumbnail) never collide and a
+        # reader never sees a partial file.
+        #
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(jpeg_array.tobytes())
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        #
+        # Record the thumbnail in the index of the day.
+        #
+        index_path = self.indexPath(frame_time)
+        with self._lock:
+            with open(index_path, 'ab') as f:
+                f.write("{} {} {}\n".format(
+                    frame_time.strftime("%Y_%m_%d_%H_%M_%S"), hdr_index, resolution))
+            self._stats['saved'] += 1
+
+        return path
+
+    @classmethod
+    def indexPath(cls, query_date):
+        """Path of the thumbnails index of a day."""
+
+        return os.path.join(cls.dayPath(query_date), gs.THUMBNAILS_INDEX_FILENAME)
+
+    @classmethod
+    def index(cls, query_date):
+        """Table of the stored thumbnails of a day.
+
+        Returns:
+            DataFrame with the columns Time, hdr, resolution and path.
+        """
+
+        rows = []
+        index_path = cls.indexPath(query_date)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) != 3:
+                        continue
+
+                    frame_time = datetime.strptime(parts[0], "%Y_%m_%d_%H_%M_%S")
+                    resolution = int(parts[2])
+                    rows.append((
+                        frame_time,
+                        parts[1],
+                        resolution,
+                        cls.path(frame_time, parts[1], resolution)
+                    ))
+
+        df = pd.DataFrame.from_records(
+            rows, columns=('Time', 'hdr', 'resolution', 'path'))
+
+        return df.drop_duplicates(subset=['Time', 'hdr', 'resolution'])
+
+    def clear(self, query_date=None):
+        """Remove the stored thumbnails of a day (or of all days)."""
+
+        with self._lock:
+            if query_date is None:
+                folders = glob.glob(os.path.join(
+                    gs.CAPTURE_PATH, "*", gs.NORMALIZED_THUMBNAILS_FOLDER))
+                self._versions.clear()
+            else:
+                folders = [self.dayPath(query_date)]
+                self._versions.pop(query_date.strftime("%Y_%m_%d"), None)
+
+            for folder in folders:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    @property
+    def stats(self):
+        """Copy of the store statistics."""
+
+        with self._lock:
+            return self._stats.copy()
+
+
+class PreviewStage(ThumbnailStage):
+    """Background, rate limited creation of the normalized previews.
+
+    Captured frames are queued after they are handed to the writers. A
+    single low rate thread creates their normalized jpeg previews (using
+    the `create` callback), so that the thumbnails command can serve them
+    by reading them from the thumbnail store.
+
+    Args:
+        create (callable): Called with img_array, img_data and hdr index of
+            a frame. Creates (and stores) its previews.
+        min_interval (float, optional): Minimal time (in seconds) between
+            frames, so that the stage does not compete with the capture.
+        max_pending (int, optional): Maximal number of queued frames. Frames
+            submitted when the queue is full are skipped.
+    """
+
+    def __init__(self, create, min_interval=0.2, max_pending=6):
+
+        self._create_previews = create
+
+        super(PreviewStage, self).__init__(
+            min_interval=min_interval, max_pending=max_pending, name='previews')
+
+    def submit(self, img_array, img_data, hdr_i):
+        """Queue a captured frame for creating its previews."""
+
+        self._put(img_array, (img_data, hdr_i))
+
+    def _reduce(self, img_array):
+        """Frames are skipped when the queue is full."""
+
+        return None
+
+    def _create(self, img_array, full_frame, img_data, hdr_i):
+
+        self._create_previews(img_array, img_data, hdr_i)
@@ -0,0 +1,392 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Offline batch reprocessing of captured days.
+
+Stored frames are preprocessed (dark subtraction, HDR merge, vignetting,
+radiometric correction and normalization) on a pool of processes and the
+normalized radiance images are written to a chunked output store, one
+`DayArchive` per day::
+
+    <output_path>/<resolution>/YYYY_MM_DD/frames.bin
+
+The calibration state (calibration bundles, dark model and remap tables)
+is built once in the parent process before the pool is started. The
+worker processes inherit it (fork) read only, and the remap tables are
+memory mapped from their stored files (see `Normalization`).
+
+Reprocessing resumes: captures that are already in the output store are
+skipped.
+"""
+from __future__ import division
+from CameraNetwork.archive import isArchiveRef
+from CameraNetwork.archive import loadArchivedFrame
+from CameraNetwork.archive import openDayArchive
+from CameraNetwork.archive import parseArchiveRef
+from CameraNetwork.calibration import DarkCalibration
+from CameraNetwork.calibration import RawPreprocessor
+from CameraNetwork.calibration_registry import CalibrationRegistry
+from CameraNetwork.compression import loadArray
+import CameraNetwork.global_settings as gs
+from CameraNetwork.image_utils import expandFrame
+from CameraNetwork.utils import DataObj
+from CameraNetwork.utils import getImagesDF
+import cPickle
+from datetime import timedelta
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import time
+import traceback
+
+__all__ = (
+    'loadFrame',
+    'reprocessDays',
+)
+
+#
+# hdr index of the merged (HDR) images in the output store.
+#
+HDR_MERGED = -1
+
+
+def loadFrame(mat_path, camera_settings=None, seek_time=None):
+    """Load a stored frame and its data object.
+
+    Args:
+        mat_path (str): Path to the mat file of the frame or an archive
+            reference.
+        camera_settings (dict, optional): Camera settings. Used for old json
+            data files.
+        seek_time (pd.Timestamp, optional): Time of frame. Used for old json
+            data files.
+
+    Returns:
+        img_array, img_data
+    """
+
+    if isArchiveRef(mat_path):
+        frames_path, _ = parseArchiveRef(mat_path)
+        assert os.path.exists(frames_path), "Non existing archive: {}".format(frames_path)
+        img_array, img_data = loadArchivedFrame(mat_path)
+        return expandFrame(img_array, img_data), img_data
+
+    assert os.path.exists(mat_path), "Non existing array: {}".format(mat_path)
+    img_array = loadArray(mat_path)
+
+    img_data = None
+    base_path = os.path.splitext(mat_path)[0]
+    if os.path.exists(base_path + '.json'):
+        #
+        # Support old json data files.
+        #
+        camera_settings = camera_settings or {}
+        img_data = DataObj(
+            longitude=camera_settings.get(gs.CAMERA_LONGITUDE, gs.DEFAULT_LONGITUDE),
+            latitude=camera_settings.get(gs.CAMERA_LATITUDE, gs.DEFAULT_LATITUDE),
+            altitude=camera_settings.get(gs.CAMERA_ALTITUDE, gs.DEFAULT_ALTITUDE),
+            name_time=seek_time.to_pydatetime() if seek_time is not None else None
+        )
+
+        data_path = base_path + '.json'
+        with open(data_path, mode='rb') as f:
+            img_data.update(**json.load(f))
+
+    elif os.path.exists(base_path + '.pkl'):
+        #
+        # New pickle data files.
+        #
+        with open(base_path + '.pkl', 'rb') as f:
+            img_data = cPickle.load(f)
+
+    #
+    # Restore the values of compact (sum of frames) arrays.
+    #
+    return expandFrame(img_array, img_data), img_data
+
+
+#
+# Calibration state of the reprocessing. Built by the parent process and
+# inherited by the workers.
+#
+_state = None
+
+
+class ReprocessState(object):
+    """Read only calibration state shared by the reprocessing workers.
+
+    Args:
+        resolution (int): Resolution of the normalized images.
+        camera_settings (dict, optional): Camera settings (for old json
+            data files).
+    """
+
+    def __init__(self, resolution, camera_settings=None):
+
+        self.resolution = resolution
+        self.camera_settings = camera_settings
+        self.registry = CalibrationRegistry()
+        self.dark = DarkCalibration.load(gs.DARK_IMAGES_PATH)
+
+        self._preprocessors = {}
+        self._day_R = {}
+
+    def setRotation(self, bundle, day):
+        """Set the extrinsic rotation of a day."""
+
+        day_str = day.strftime("%Y_%m_%d")
+        if day_str not in self._day_R:
+            R = None
+            extrinsic_path = os.path.join(
+                gs.CAPTURE_PATH, day_str, gs.EXTRINSIC_SETTINGS_FILENAME)
+            if os.path.exists(extrinsic_path):
+                try:
+                    R = np.load(extrinsic_path)
+                except:
+                    logging.error(
+                        "Failed loading extrinsic data from {}\n{}".format(
+                            extrinsic_path, traceback.format_exc()))
+            self._day_R[day_str] = R
+
+        R = self._day_R[day_str]
+        bundle.normalization.R = R if R is not None else bundle.default_R
+
+    def preprocessor(self, bundle):
+
+        key = bundle.calibration_path
+        if key not in self._preprocessors:
+            self._preprocessors[key] = RawPreprocessor(
+                dark=self.dark,
+                vignetting=bundle.vignetting,
+                radiometric=bundle.radiometric,
+                hdr_weighting=gs.HDR_WEIGHTING,
+                hdr_tile_rows=gs.HDR_TILE_ROWS
+            )
+
+        return self._preprocessors[key]
+
+    def process(self, day, seek_time, paths):
+        """Preprocess and normalize the frames of a capture."""
+
+        img_arrays, img_datas = [], []
+        for path in paths:
+            img_array, img_data = loadFrame(path, self.camera_settings, seek_time)
+            img_arrays.append(img_array)
+            img_datas.append(img_data)
+
+        serial_num = img_datas[0].camera_info["serial_num"]
+        bundle = self.registry.bundle(serial_num, day)
+        if bundle.normalization is None:
+            raise Exception(
+                "No intrinsic calibration for camera {}".format(serial_num))
+
+        self.setRotation(bundle, day)
+        normalization = bundle.normalization
+        if normalization.resolution != self.resolution:
+            normalization.calc_normalization_map(self.resolution)
+
+        img = self.preprocessor(bundle).process(
+            img_arrays,
+            img_datas,
+            subtract_dark=img_datas[0].color_mode == gs.COLOR_RAW,
+            reuse_buffer=True
+        )
+        img = normalization.normalize(img)
+
+        img_data = DataObj(
+            name_time=seek_time.to_pydatetime(),
+            capture_time=getattr(img_datas[0], 'capture_time', None),
+            exposures_us=[d.exposure_us for d in img_datas],
+            camera_info=img_datas[0].camera_info,
+            longitude=img_datas[0].longitude,
+            latitude=img_datas[0].latitude,
+            altitude=img_datas[0].altitude,
+            calibration_path=bundle.calibration_path,
+            resolution=self.resolution,
+            units='RGB/ms'
+        )
+
+        return np.asarray(img, dtype=np.float32), img_data
+
+
+def _processCapture(task):
+    """Pool worker: process a single capture."""
+
+    day, seek_time, paths = task
+    try:
+        img, img_data = _state.process(day, seek_time, paths)
+        return seek_time, len(paths), img, img_data, None
+    except Exception:
+        return seek_time, len(paths), None, None, traceback.format_exc()
+
+
+def _dayTasks(day, hdr_index, archive):
+    """List the captures of a day that are not in the output store.
+
+    Returns:
+        tasks, number of skipped captures
+    """
+
+    df = getImagesDF(day)
+    if hdr_index != HDR_MERGED:
+        df = df.xs(str(hdr_index), level='hdr', drop_level=False)
+
+    tasks, skipped = [], 0
+    for seek_time, group in df.groupby(level='Time'):
+        if archive.has(seek_time.to_pydatetime().replace(microsecond=0), hdr_index):
+            skipped += 1
+            continue
+
+        paths = [p for p in group['path'].values.flatten() if p is not None]
+        if paths:
+            tasks.append((day, seek_time, paths))
+
+    return tasks, skipped
+
+
+def reprocessDays(
+        start_date,
+        end_date=None,
+        output_path=None,
+        resolution=301,
+        hdr_index=HDR_MERGED,
+        workers=None,
+        camera_settings=None,
+        report_interval=30):
+    """Reprocess the captures of a range of days.
+
+    Args:
+        start_date (datetime): First day.
+        end_date (datetime, optional): Last day (inclusive). Defaults to the
+            first day.
+        output_path (str, optional): Base path of the output store. Defaults
+            to ``<HOME>/reprocessed``.
+        resolution (int, optional): Resolution of the normalized images.
+        hdr_index (int, optional): Exposure to process. HDR_MERGED (-1)
+            merges all the exposures of a capture.
+        workers (int, optional): Number of worker processes. Defaults to the
+            number of cpus.
+        camera_settings (dict, optional): Camera settings (for old json
+            data files).
+        report_interval (float, optional): Interval (in seconds) between
+            progress reports.
+
+    Returns:
+        Summary dict (captures, frames, failed, skipped, seconds,
+        frames_per_second).
+    """
+
+    global _state
+
+    if end_date is None:
+        end_date = start_date
+    if output_path is None:
+        output_path = os.path.join(gs.HOME_PATH, 'reprocessed')
+    workers = workers or multiprocessing.cpu_count()
+
+    _state = ReprocessState(resolution, camera_settings)
+
+    summary = dict(captures=0, frames=0, failed=0, skipped=0)
+    archives = {}
+    t0 = time.time()
+
+    def store(result):
+        seek_time, frames_num, img, img_data, error = result
+        if error is not None:
+            logging.error("Failed reprocessing {}:\n{}".format(seek_time, error))
+            summary['failed'] += 1
+            return
+
+        archives[seek_time.strftime("%Y_%m_%d")].append(img, img_data, hdr_index)
+        summary['captures'] += 1
+        summary['frames'] += frames_num
+
+    #
+    # List the work, skipping captures that were already processed.
+    # The first capture of every day is processed here, before starting
+    # the pool. This builds (and stores) the calibration bundle and remap
+    # tables of the day once, and the workers inherit them.
+    #
+    tasks = []
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    for day in days:
+        day_str = day.strftime("%Y_%m_%d")
+        if not os.path.isdir(os.path.join(gs.CAPTURE_PATH, day_str)):
+            continue
+
+        archive = openDayArchive(os.path.join(output_path, str(resolution), day_str))
+        day_tasks, skipped = _dayTasks(day, hdr_index, archive)
+        summary['skipped'] += skipped
+        if not day_tasks:
+            continue
+
+        archives[day_str] = archive
+        store(_processCapture(day_tasks[0]))
+        tasks.extend(day_tasks[1:])
+
+    logging.info(
+        "Reprocessing {} captures ({} already processed) with {} workers.".format(
+            len(tasks) + summary['captures'] + summary['failed'],
+            summary['skipped'], workers))
+
+    last_report = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_processCapture, tasks, chunksize=4):
+            store(result)
+
+            now = time.time()
+            if now - last_report > report_interval:
+                last_report = now
+                logging.info(
+                    "Reprocessed {} captures, {:.2f} frames/sec".format(
+                        summary['captures'], summary['frames'] / (now - t0)))
+    finally:
+        pool.close()
+        pool.join()
+
+    summary['seconds'] = time.time() - t0
+    summary['frames_per_second'] = summary['frames'] / max(summary['seconds'], 1e-6)
+
+    logging.info(
+        "Reprocessed {captures} captures ({frames} frames, {failed} failed) "
+        "in {seconds:.1f} secs, {frames_per_second:.2f} frames/sec".format(**summary))
+
+    return summary
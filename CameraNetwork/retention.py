@@ -0,0 +1,353 @@
+#
+# Copyright (C) 2017, Amit Aides, all rights reserved.
+#
+# This file is part of Camera Network
+# (see https://bitbucket.org/amitibo/cameranetwork_git).
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1)  The software is provided under the terms of this license strictly for
+#     academic, non-commercial, not-for-profit purposes.
+# 2)  Redistributions of source code must retain the above copyright notice, this
+#     list of conditions (license) and the following disclaimer.
+# 3)  Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions (license) and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+# 4)  The name of the author may not be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+# 5)  As this software depends on other libraries, the user must adhere to and keep
+#     in place any licensing terms of those libraries.
+# 6)  Any publications arising from the use of this software, including but not
+#     limited to academic journal and conference publications, technical reports and
+#     manuals, must cite the following works:
+#     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis,
+#     "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Disk space aware retention of the captured data.
+
+Captured days go through two tiers:
+
+    full    - The captured frames (mat/pkl files or day archive) and the jpeg
+              thumbnails.
+    compact - The jpeg thumbnails and a low resolution normalized radiance
+              image per capture time (``compact/*.npz``).
+
+The `RetentionPolicy` decides which day to compact or delete next, either
+by age or when the free disk space falls below a threshold. The work itself
+is done incrementally by the server (see `Server.retention_timer`).
+
+Only days whose frames were confirmed uploaded are retired. Successful
+uploads are logged in the day folder (see `markUploaded`).
+"""
+from __future__ import division
+import CameraNetwork.global_settings as gs
+from datetime import datetime
+import glob
+import json
+import logging
+import os
+import shutil
+
+__all__ = (
+    'COMPACT_ACTION',
+    'DELETE_ACTION',
+    'dayTiers',
+    'DayUsageTracker',
+    'diskSpace',
+    'fullResolutionFiles',
+    'isCompactDay',
+    'isUploadedDay',
+    'listDays',
+    'markCompactDay',
+    'markUploaded',
+    'removeDay',
+    'removeFiles',
+    'RetentionPolicy',
+    'uploadedDays'
+)
+
+COMPACT_ACTION = 'compact'
+DELETE_ACTION = 'delete'
+
+FULL_TIER = 'full'
+COMPACT_TIER = 'compact'
+
+
+def diskSpace(path):
+    """Free and total bytes of the file system of path."""
+
+    st = os.statvfs(path)
+
+    return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+
+def listDays(capture_path):
+    """List the captured days.
+
+    Returns:
+        List of (date, day_path) sorted by date.
+    """
+
+    days = []
+    for day_path in glob.glob(os.path.join(capture_path, '*')):
+        if not os.path.isdir(day_path):
+            continue
+        try:
+            date = datetime.strptime(os.path.basename(day_path), "%Y_%m_%d").date()
+        except ValueError:
+            continue
+        days.append((date, day_path))
+
+    return sorted(days)
+
+
+def isCompactDay(day_path):
+    """Check whether a day was moved to the compact tier."""
+
+    return os.path.exists(os.path.join(day_path, gs.COMPACT_TIER_FILENAME))
+
+
+def markCompactDay(day_path, frames_num):
+    """Mark a day as moved to the compact tier."""
+
+    with open(os.path.join(day_path, gs.COMPACT_TIER_FILENAME), 'wb') as f:
+        json.dump(
+            dict(
+                compacted=datetime.utcnow().isoformat(),
+                frames=frames_num,
+                resolution=gs.COMPACT_RESOLUTION
+            ),
+            f
+        )
+
+
+def markUploaded(path):
+    """Log a file as (successfully) uploaded.
+
+    The file name is appended to the upload log of its folder.
+    """
+
+    folder, filename = os.path.split(path)
+    with open(os.path.join(folder, gs.UPLOADED_LOG_FILENAME), 'ab') as f:
+        f.write(filename + '\n')
+
+
+def isUploadedDay(day_path):
+    """Check whether the frames of a day were confirmed uploaded.
+
+    A day is confirmed uploaded if it has an upload log that lists all its
+    mat files. Archived frames are not uploaded, therefore a day with an
+    archive is never confirmed.
+    """
+
+    log_path = os.path.join(day_path, gs.UPLOADED_LOG_FILENAME)
+    if not os.path.exists(log_path):
+        return False
+
+    if os.path.exists(os.path.join(day_path, gs.ARCHIVE_HEADER_FILENAME)):
+        return False
+
+    with open(log_path, 'rb') as f:
+        uploaded = set(line.strip() for line in f)
+
+    return all(
+        os.path.basename(path) in uploaded
+        for path in glob.glob(os.path.join(day_path, '*.mat'))
+    )
+
+
+def uploadedDays(days):
+    """Filter the days (see `dayTiers`) confirmed uploaded."""
+
+    return [d for d in days if isUploadedDay(d[1])]
+
+
+def fullResolutionFiles(day_path):
+    """List the full resolution files of a day (frames and their data)."""
+
+    paths = []
+    for pattern in ('*.mat', '*.pkl', '*.json'):
+        paths.extend(glob.glob(os.path.join(day_path, pattern)))
+
+    for name in (
+            gs.ARCHIVE_FRAMES_FILENAME,
+            gs.ARCHIVE_HEADER_FILENAME,
+            gs.ARCHIVE_INDEX_FILENAME):
+        path = os.path.join(day_path, name)
+        if os.path.exists(path):
+            paths.append(path)
+
+    #
+    # The frames database is stale once the frames are removed.
+    #
+    database_path = os.path.join(day_path, "database.pkl")
+    if os.path.exists(database_path):
+        paths.append(database_path)
+
+    return sorted(
+        set(p for p in paths if os.path.basename(p) != gs.COMPACT_TIER_FILENAME))
+
+
+class DayUsageTracker(object):
+    """Track the disk usage of the captured days.
+
+    The usage of closed days is cached by the modification time of the day
+    folder, so that only new or changed days are walked.
+    """
+
+    def __init__(self):
+
+        self._cache = {}
+
+    def usage(self, day_path, closed=True):
+        """Disk usage (in bytes) of a day folder."""
+
+        mtime = os.path.getmtime(day_path)
+        cached = self._cache.get(day_path, None)
+        if closed and cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        nbytes = 0
+        for root, _, files in os.walk(day_path):
+            for name in files:
+                try:
+                    nbytes += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+
+        self._cache[day_path] = (mtime, nbytes)
+
+        return nbytes
+
+    def forget(self, day_path):
+
+        self._cache.pop(day_path, None)
+
+
+class RetentionPolicy(object):
+    """Retention policy of the captured days.
+
+    Args:
+        full_days (int, optional): Number of days for which the full
+            resolution data is kept. None means keep as long as there is
+            enough free space.
+        compact_days (int, optional): Number of days for which the compact
+            tier is kept. None means keep as long as there is enough free
+            space.
+        min_free_bytes (int, optional): Minimal free disk space. Below it,
+            the oldest full day is compacted, or (when no full day is left)
+            the oldest compact day is deleted.
+
+    Note:
+        The current day is never touched. When the free space falls below a
+        quarter of min_free_bytes, the oldest day is deleted without being
+        compacted first, as compacting takes too long to save the capture
+        loop. The policy should only be given days that are confirmed
+        uploaded (see `uploadedDays`).
+    """
+
+    def __init__(self, full_days=None, compact_days=None, min_free_bytes=0):
+
+        self.full_days = full_days
+        self.compact_days = compact_days
+        self.min_free_bytes = min_free_bytes
+
+    @classmethod
+    def fromSettings(cls, capture_settings):
+
+        return cls(
+            full_days=capture_settings[gs.RETENTION_FULL_DAYS],
+            compact_days=capture_settings[gs.RETENTION_COMPACT_DAYS],
+            min_free_bytes=capture_settings[gs.RETENTION_MIN_FREE_MB] * 2**20
+        )
+
+    def nextAction(self, days, free_bytes, today):
+        """Choose the next retention action.
+
+        Args:
+            days (list): List of (date, day_path, tier) sorted by date.
+            free_bytes (int): Free disk space.
+            today (date): The current date.
+
+        Returns:
+            (action, day_path), or (None, None) if nothing should be done.
+        """
+
+        closed = [d for d in days if d[0] < today]
+        full = [d for d in closed if d[2] == FULL_TIER]
+        compact = [d for d in closed if d[2] == COMPACT_TIER]
+
+        if closed and free_bytes < self.min_free_bytes / 4:
+            logging.warn(
+                "Critical free disk space ({} MB), deleting day {}.".format(
+                    free_bytes // 2**20, closed[0][1]))
+            return DELETE_ACTION, closed[0][1]
+
+        if self.full_days is not None:
+            for date, day_path, _ in full:
+                if (today - date).days > self.full_days:
+                    return COMPACT_ACTION, day_path
+
+        if self.compact_days is not None:
+            for date, day_path, _ in compact:
+                if (today - date).days > self.compact_days:
+                    return DELETE_ACTION, day_path
+
+        if free_bytes < self.min_free_bytes:
+            if full:
+                return COMPACT_ACTION, full[0][1]
+            if compact:
+                return DELETE_ACTION, compact[0][1]
+
+            logging.warn(
+                "Low free disk space ({} MB) and no day left to retire.".format(
+                    free_bytes // 2**20))
+
+        return None, None
+
+
+def dayTiers(capture_path):
+    """List the captured days with their tiers.
+
+    Returns:
+        List of (date, day_path, tier) sorted by date.
+    """
+
+    return [
+        (date, day_path, COMPACT_TIER if isCompactDay(day_path) else FULL_TIER)
+        for date, day_path in listDays(capture_path)
+    ]
+
+
+def removeFiles(paths):
+    """Remove files, returning the number of bytes removed."""
+
+    nbytes = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            nbytes += size
+        except OSError:
+            logging.warn("Failed removing: {}".format(path))
+
+    return nbytes
+
+
+def removeDay(day_path):
+    """Remove a day folder."""
+
+    shutil.rmtree(day_path, ignore_errors=True)
@@ -34,22 +34,39 @@
 ## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
 from __future__ import division
+from CameraNetwork.archive import forgetDayArchive
+from CameraNetwork.archive import isArchiveRef
+from CameraNetwork.catalog import getCatalog
 from CameraNetwork.hg import Repository
 import CameraNetwork.global_settings as gs
 from CameraNetwork.internet import retrieve_proxy_parameters
 from CameraNetwork.mdp import MDPWorker
+from CameraNetwork.retention import COMPACT_ACTION
+from CameraNetwork.retention import dayTiers
+from CameraNetwork.retention import DayUsageTracker
+from CameraNetwork.retention import diskSpace
+from CameraNetwork.retention import fullResolutionFiles
+from CameraNetwork.retention import markCompactDay
+from CameraNetwork.retention import markUploaded
+from CameraNetwork.retention import removeDay
+from CameraNetwork.retention import removeFiles
+from CameraNetwork.retention import RetentionPolicy
+from CameraNetwork.retention import uploadedDays
 from CameraNetwork.utils import DataObj
 from CameraNetwork.utils import dict2buff
 from CameraNetwork.utils import getImagesDF
+from CameraNetwork.utils import getImagesRangeDF
 from CameraNetwork.utils import handler
 from CameraNetwork.utils import handler_no_answer
 from CameraNetwork.utils import identify_server
+from CameraNetwork.utils import ImagesDFCache
 from CameraNetwork.utils import IOLoop
 from CameraNetwork.utils import load_camera_data
 from CameraNetwork.utils import name_time
 from CameraNetwork.utils import RestartException
 from CameraNetwork.utils import save_camera_data
 from CameraNetwork.utils import setup_reverse_ssh_tunnel
+from CameraNetwork.utils import SpillCache
 from CameraNetwork.utils import sync_time
 from CameraNetwork.utils import sun_direction
 import cPickle
@@ -121,10 +138,25 @@ def upload_thread(upload_queue):
         #
         # Upload image
         #
-        upload_log = subprocess.Popen(cmd_upload, shell=True).communicate()
+        p = subprocess.Popen(cmd_upload, shell=True)
+        upload_log = p.communicate()
 
         logging.debug(str(upload_log))
 
+        #
+        # Log successful uploads. The retention only retires days whose
+        # frames were confirmed uploaded.
+        #
+        if p.returncode == 0:
+            try:
+                markUploaded(capture_path)
+            except Exception:
+                logging.error("Failed logging upload of {}:\n{}".format(
+                    capture_path, traceback.format_exc()))
+        else:
+            logging.error("Failed uploading {} (return code: {})".format(
+                capture_path, p.returncode))
+
         #
         # Remove the frame from folder.
         #
@@ -196,6 +228,19 @@ class Server(MDPWorker):
         self._offline = offline
         self.capture_state = False
 
+        #
+        # Statistics of the capture loop timing.
+        #
+        self.loop_stats = dict(cycles=0, missed_slots=0, last_cycle_seconds=0.)
+
+        #
+        # Retention of the captured data.
+        #
+        self.retention_usage = DayUsageTracker()
+        self.retention_stats = dict(
+            free_mb=None, full_days=0, full_mb=0, compact_days=0, compact_mb=0,
+            compacted_days=0, deleted_days=0, last_action=None)
+
         #
         # Start the upload thread.
         # Note:
@@ -219,6 +264,27 @@ class Server(MDPWorker):
         #
         self._controller = controller
 
+        #
+        # Thumbnails are created in the background. Upload them when done.
+        #
+        self._controller.addThumbnailListener(self.upload_thumbnail)
+
+        #
+        # Per day images dataframes. The index of the captured day is
+        # updated from the saved frames.
+        #
+        self._images_dfs = ImagesDFCache(max_days=gs.IMAGES_DF_CACHE_DAYS)
+        self._controller.addFrameListener(self._images_dfs.addFrame)
+
+        #
+        # Finished (serialized) seek replies.
+        #
+        self._seek_replies = SpillCache(
+            max_bytes=gs.SEEK_CACHE_MB*2**20,
+            spill_path=gs.SEEK_CACHE_PATH if gs.SEEK_CACHE_SPILL_MB > 0 else None,
+            spill_max_bytes=gs.SEEK_CACHE_SPILL_MB*2**20
+        )
+
     def __del__(self):
 
         #
@@ -268,7 +334,12 @@ class Server(MDPWorker):
             IOLoop.current().spawn_callback(self.setup_sprinkler_timer)
 
             #
-            # 3) Start the capture loop.
+            # 3) Start the retention of the captured data.
+            #
+            IOLoop.current().spawn_callback(self.retention_timer)
+
+            #
+            # 4) Start the capture loop.
             #
             # If the start_loop is set, start the capture loop.
             #
@@ -566,8 +637,11 @@ class Server(MDPWorker):
 
             #
             # Schedule img/s capture.
+            # The controller returns once the frames are captured. The frames
+            # are saved in the background and uploaded when saved.
             #
-            jpg_names, mat_names, data_names = \
+            cycle_start = time.time()
+            save_futures = \
                 yield self.push_cmd(
                     gs.LOOP_CMD,
                     priority=1,
@@ -579,34 +653,284 @@ class Server(MDPWorker):
                         ),
                     frames_num=capture_settings[gs.FRAMES_NUM],
                     hdr_mode=capture_settings[gs.HDR_MODE],
-                    img_data=img_data
+                    img_data=img_data,
+                    storage_mode=self.capture_settings[gs.STORAGE_MODE],
+                    compact=self.capture_settings[gs.COMPACT_STORAGE],
+                    storage_codec=self.capture_settings[gs.STORAGE_CODEC],
+                    adaptive_hdr=self.capture_settings[gs.HDR_ADAPTIVE],
+                    hdr_time_budget=self.capture_settings[gs.HDR_TIME_BUDGET]
                 )
 
+            IOLoop.current().spawn_callback(
+                self.upload_loop_files, save_futures, img_data.name_time)
+
             #
-            # Setup upload of files to dropbox
+            # Check for drift of the loop, i.e. a capture cycle that
+            # overran its time slot.
             #
-            upload_list = []
-            if self.capture_settings[gs.UPLOAD_JPG_FILE]:
-                upload_list.extend(jpg_names)
-            if self.capture_settings[gs.UPLOAD_MAT_FILE]:
-                upload_list.extend(mat_names)
-            upload_list.extend(data_names)
-
-            operation = gs.DROPBOX_LOOP_PATH
-            subfolder = img_data.name_time.strftime("%Y_%m_%d")
-
-            for filepath in upload_list:
-                upload_path = gs.UPLOAD_PATH.format(
-                    operation=operation,
-                    camera_identity=self.camera_settings[gs.CAMERA_IDENTITY],
-                    subfolder=subfolder,
-                    filename=os.path.split(filepath)[1]
-                )
-                logging.debug('Putting file %s in queue' % filepath)
-                self.upload_queue.put((filepath, upload_path))
+            cycle_seconds = time.time() - cycle_start
+            self.loop_stats['cycles'] += 1
+            self.loop_stats['last_cycle_seconds'] = cycle_seconds
+            if cycle_seconds > next_capture_time:
+                missed = int((cycle_seconds - next_capture_time) / capture_delay) + 1
+                self.loop_stats['missed_slots'] += missed
+                logging.warn(
+                    "Capture cycle took {:.2f} secs, missed {} loop slots. "
+                    "Writers: {}".format(
+                        cycle_seconds, missed, self._controller.writer_stats))
+
+            yield nxt
+
+    @gen.coroutine
+    def upload_loop_files(self, save_futures, name_time):
+        """Queue the files of a loop cycle for upload once they are saved.
+
+        Args:
+            save_futures (list): Futures of the saved frames, as returned by
+                the controller loop command.
+            name_time (datetime object): Name time of the loop cycle.
+        """
+
+        mat_names, data_names = [], []
+        for save_future in save_futures:
+            try:
+                mat_path, jpg_path, data_path = yield save_future
+            except Exception:
+                logging.error("Failed saving a loop frame:\n{}".format(
+                    traceback.format_exc()))
+                continue
+
+            mat_names.append(mat_path)
+            data_names.append(data_path)
+
+        #
+        # Setup upload of files to dropbox.
+        # Note:
+        # The jpeg thumbnails are uploaded when completed by the thumbnails
+        # stage (see upload_thumbnail).
+        #
+        upload_list = []
+        if self.capture_settings[gs.UPLOAD_MAT_FILE]:
+            upload_list.extend(mat_names)
+        upload_list.extend(data_names)
+
+        for filepath in upload_list:
+            #
+            # Archived frames (and their data) are not uploaded
+            # separately.
+            #
+            if filepath is None or isArchiveRef(filepath):
+                continue
+
+            self.queue_loop_upload(filepath, name_time.strftime("%Y_%m_%d"))
+
+    def upload_thumbnail(self, jpg_path):
+        """Queue a completed loop thumbnail for upload.
+
+        Note:
+            Called from the thumbnails thread. The upload queue is thread
+            safe.
+        """
+
+        if not self.capture_settings[gs.UPLOAD_JPG_FILE]:
+            return
+
+        subfolder = os.path.basename(os.path.dirname(jpg_path))
+        self.queue_loop_upload(jpg_path, subfolder)
+
+    def queue_loop_upload(self, filepath, subfolder):
+        """Queue a loop file for upload to dropbox."""
+
+        upload_path = gs.UPLOAD_PATH.format(
+            operation=gs.DROPBOX_LOOP_PATH,
+            camera_identity=self.camera_settings[gs.CAMERA_IDENTITY],
+            subfolder=subfolder,
+            filename=os.path.split(filepath)[1]
+        )
+        logging.debug('Putting file %s in queue' % filepath)
+        self.upload_queue.put((filepath, upload_path))
+
+
+    @gen.coroutine
+    def retention_timer(self):
+        """Retain the captured data according to the retention policy.
+
+        The work is done incrementally, one frame or file at a time, on the
+        server executor. The I/O rate is bounded by sleeping (on the ioloop)
+        after each step, so that the capture loop is never stalled.
+        """
+
+        while True:
+            nxt = gen.sleep(gs.RETENTION_PERIOD)
+
+            try:
+                if self.capture_settings[gs.RETENTION_ENABLED]:
+                    yield self.retention_pass()
+            except Exception:
+                logging.error("Retention pass failed:\n{}".format(
+                    traceback.format_exc()))
 
             yield nxt
 
+    @gen.coroutine
+    def retention_pass(self):
+        """Apply retention actions until the policy is satisfied."""
+
+        today = datetime.utcnow().date()
+        retired = set()
+        while True:
+            policy = RetentionPolicy.fromSettings(self.capture_settings)
+            free_bytes, _ = diskSpace(gs.CAPTURE_PATH)
+            days = yield self.retention_usage_update(today)
+            self.retention_stats['free_mb'] = free_bytes // 2**20
+
+            #
+            # Never retire a day that was not confirmed uploaded.
+            #
+            days = yield self.executor.submit(uploadedDays, days)
+
+            action, day_path = policy.nextAction(days, free_bytes, today)
+            if action is None:
+                break
+
+            if day_path in retired:
+                #
+                # The day was already handled in this pass (e.g. removing
+                # files failed). Avoid looping over it.
+                #
+                logging.warn("Retention of {} did not complete.".format(day_path))
+                break
+            retired.add(day_path)
+
+            logging.info("Retention: {} {}".format(action, day_path))
+            self.retention_stats['last_action'] = "{} {}".format(
+                action, os.path.basename(day_path))
+
+            if action == COMPACT_ACTION:
+                yield self.retention_compact_day(day_path)
+                self.retention_stats['compacted_days'] += 1
+            else:
+                yield self.retention_delete_day(day_path)
+                self.retention_stats['deleted_days'] += 1
+
+            self.retention_usage.forget(day_path)
+
+    @run_on_executor
+    def retention_usage_update(self, today):
+        """Update the per tier usage statistics.
+
+        Returns:
+            List of (date, day_path, tier) of the captured days.
+        """
+
+        days = dayTiers(gs.CAPTURE_PATH)
+        stats = dict(full_days=0, full_mb=0, compact_days=0, compact_mb=0)
+        for date, day_path, tier in days:
+            usage = self.retention_usage.usage(day_path, closed=date < today)
+            stats['{}_days'.format(tier)] += 1
+            stats['{}_mb'.format(tier)] += usage // 2**20
+
+        self.retention_stats.update(stats)
+
+        return days
+
+    def retention_sleep(self, nbytes):
+        """Sleep long enough to keep the retention I/O rate bounded."""
+
+        rate = max(self.capture_settings[gs.RETENTION_RATE_MB], 0.01) * 2**20
+        return gen.sleep(nbytes / rate)
+
+    @gen.coroutine
+    def retention_compact_day(self, day_path):
+        """Move a day to the compact tier.
+
+        A low resolution normalized radiance image is stored for every
+        capture time (resuming previously compacted times), then the full
+        resolution files are removed. The jpeg thumbnails are kept.
+        """
+
+        query_date = datetime.strptime(os.path.basename(day_path), "%Y_%m_%d")
+        compact_path = os.path.join(day_path, gs.COMPACT_FOLDER)
+        if not os.path.isdir(compact_path):
+            os.makedirs(compact_path)
+
+        try:
+            df = getImagesDF(query_date)
+            seek_times = df.index.get_level_values(0).unique()
+        except Exception:
+            logging.error("Failed querying day {}, compacting without radiance:\n{}".format(
+                day_path, traceback.format_exc()))
+            df, seek_times = None, []
+
+        frames_num = 0
+        for seek_time in seek_times:
+            npz_path = os.path.join(
+                compact_path, "{}.npz".format(name_time(seek_time.to_pydatetime())[2]))
+            if os.path.exists(npz_path):
+                frames_num += 1
+                continue
+
+            nbytes = yield self.retention_compact_frame(df, seek_time, npz_path)
+            if nbytes:
+                frames_num += 1
+            yield self.retention_sleep(nbytes)
+
+        #
+        # Remove the full resolution files.
+        #
+        for path in fullResolutionFiles(day_path):
+            nbytes = yield self.executor.submit(removeFiles, [path])
+            yield self.retention_sleep(nbytes)
+
+        markCompactDay(day_path, frames_num)
+        forgetDayArchive(day_path)
+        getCatalog().removeDay(query_date)
+        self._images_dfs.invalidate(query_date)
+
+    @run_on_executor
+    def retention_compact_frame(self, df, seek_time, npz_path):
+        """Store the low resolution radiance of a capture time.
+
+        Returns:
+            Number of bytes read (0 if failed).
+        """
+
+        try:
+            img_datas, img_array = self._controller.seekImageArray(
+                df,
+                seek_time,
+                hdr_index=-1,
+                normalize=True,
+                resolution=gs.COMPACT_RESOLUTION,
+                jpeg=False,
+                camera_settings=self.camera_settings
+            )
+        except Exception:
+            logging.error("Failed compacting {}:\n{}".format(
+                seek_time, traceback.format_exc()))
+            return 0
+
+        np.savez_compressed(
+            npz_path,
+            radiance=img_array.astype(np.float16),
+            exposures_us=[d.exposure_us for d in img_datas],
+            time=str(seek_time)
+        )
+
+        paths = df["path"].loc[seek_time].values.flatten()
+        return sum(
+            os.path.getsize(p) for p in paths if os.path.exists(p)) or 1
+
+    @gen.coroutine
+    def retention_delete_day(self, day_path):
+        """Delete a day (of any tier)."""
+
+        query_date = datetime.strptime(os.path.basename(day_path), "%Y_%m_%d")
+        yield self.executor.submit(removeDay, day_path)
+        forgetDayArchive(day_path)
+        getCatalog().removeDay(query_date)
+        self._images_dfs.invalidate(query_date)
+
 
     ###########################################################
     # Message handlers
@@ -649,12 +973,32 @@ class Server(MDPWorker):
         )
         git_result = p.communicate()
 
+        #
+        # Get the capture pipeline statistics.
+        #
+        stats = dict(
+            loop=self.loop_stats.copy(),
+            writers=self._controller.writer_stats,
+            thumbnails=self._controller.thumbnail_stats,
+            retention=self.retention_stats.copy(),
+            camera=self._controller.camera_stats,
+            dark=self._controller.dark_stats,
+            normalization=self._controller.normalization_stats,
+            calibration=self._controller.calibration_stats,
+            frames=self._controller.frame_cache_stats,
+            thumbnail_store=self._controller.thumbnail_store_stats,
+            previews=self._controller.preview_stats,
+            seek_replies=self._seek_replies.stats,
+            images_df=self._images_dfs.stats
+        )
+
         raise gen.Return(
             (
                 (),
                 {
                     'git_result': git_result,
-                    'memory_result': mem_result
+                    'memory_result': mem_result,
+                    'stats': stats
                 }
             )
         )
@@ -769,40 +1113,37 @@ class Server(MDPWorker):
                 return None
             return array_like.iloc[-1]
 
-        query_df = getImagesDF(query_date, force=True)
+        query_df = self._images_dfs.get(query_date)
         thumbs_df = query_df.xs(hdr_index, level="hdr").resample(
             rule=time_period,
             label="right").apply(custom_resampler).dropna()
 
+        #
+        # The thumbnails are read from the thumbnails store or created in
+        # parallel (see `Controller.normalizedThumbnails`).
+        #
+        slots = list(thumbs_df.iterrows())
         new_inds, new_rows = [], []
         thumbnails = []
-        for ind, row in thumbs_df.iterrows():
-            try:
-                _, thumb_array = self._controller.seekImageArray(
-                    query_df,
-                    seek_time=ind,
-                    hdr_index=hdr_index,
-                    normalize=True,
-                    resolution=resolution,
-                    jpeg=True,
-                    camera_settings=self.camera_settings
-                )
-                new_inds.append(ind)
-                new_rows.append(row)
-                thumbnails.append(thumb_array)
-            except:
-                #
-                # Sampling the "right" time creates a time sample
-                # that might not be in the data frame (e.g. hdr=0).
-                #
-                pass
+        for slot, _, thumb_array in self._controller.normalizedThumbnails(
+                query_df,
+                [ind for ind, _ in slots],
+                hdr_index=hdr_index,
+                resolution=resolution,
+                camera_settings=self.camera_settings):
+            ind, row = slots[slot]
+            new_inds.append(ind)
+            new_rows.append(row)
+            thumbnails.append(thumb_array)
 
         #
         # Send reply on next ioloop cycle.
         # The array is sent as mat file to save
         # band width
         #
-        matfile = dict2buff(dict(thumbnails=thumbnails, jpeg=True))
+        matfile = dict2buff(
+            dict(thumbnails=thumbnails, jpeg=True),
+            codec=self.capture_settings[gs.WIRE_CODEC])
 
         return (), dict(
             thumbnails=matfile,
@@ -871,7 +1212,9 @@ class Server(MDPWorker):
         # The array is sent as mat file to save
         # band width
         #
-        matfile = dict2buff(dict(img_array=img_array, jpeg=jpeg))
+        matfile = dict2buff(
+            dict(img_array=img_array, jpeg=jpeg),
+            codec=self.capture_settings[gs.WIRE_CODEC])
 
         raise gen.Return(((), dict(matfile=matfile, img_data=img_data)))
 
@@ -908,7 +1251,7 @@ class Server(MDPWorker):
         raise gen.Return(((), dict(days_list=days)))
 
     @gen.coroutine
-    def handle_query(self, query_date, force=False):
+    def handle_query(self, query_date, force=False, end_date=None):
         """Seek for a previously captured (loop) array.
 
         Args:
@@ -917,6 +1260,8 @@ class Server(MDPWorker):
                 will be used for guessing the right date.
             force (bool, optional): Force calculating the images database
                 for this day.
+            end_date (datetime object or string, optional): When given,
+                query all days from query_date to end_date (inclusive).
 
         Returns:
             A list of mat file names from the requested date.
@@ -927,8 +1272,13 @@ class Server(MDPWorker):
         #
         if type(query_date) == str:
             query_date = dtparser.parse(query_date)
+        if type(end_date) == str:
+            end_date = dtparser.parse(end_date)
 
-        query_df = getImagesDF(query_date, force)
+        if end_date is None:
+            query_df = self._images_dfs.get(query_date, force)
+        else:
+            query_df = getImagesRangeDF(query_date, end_date, force)
 
         #
         # Send reply on next ioloop cycle.
@@ -972,32 +1322,64 @@ class Server(MDPWorker):
 
         if type(seek_time) == str:
             query_date = dtparser.parse(seek_time).date()
+            seek_timestamp = pd.Timestamp(dtparser.parse(seek_time))
         else:
             query_date = seek_time.date()
+            seek_timestamp = pd.Timestamp(seek_time)
 
-        query_df = getImagesDF(query_date, force=False)
+        query_df = self._images_dfs.get(query_date)
 
-        img_datas, img_array = self._controller.seekImageArray(
-            query_df,
-            seek_time,
+        #
+        # Check for a cached reply of the same request.
+        # Note:
+        # The key includes the number of frames of the day and the version
+        # of the calibration, so that replies are not reused after new
+        # frames are captured or the calibration (or extrinsic calibration
+        # of the day) is changed.
+        #
+        codec = self.capture_settings[gs.WIRE_CODEC]
+        reply_key = (
+            seek_timestamp.isoformat(),
             hdr_index,
             normalize,
-            resolution,
             jpeg,
-            self.camera_settings,
-            correct_radiometric=correct_radiometric,
-            ignore_date_extrinsic=ignore_date_extrinsic,
-            timedelta_threshold=timedelta_threshold
+            resolution,
+            correct_radiometric,
+            ignore_date_extrinsic,
+            timedelta_threshold,
+            repr(codec),
+            len(query_df),
+            self._controller.calibrationVersion(query_date, ignore_date_extrinsic)
         )
+        reply = self._seek_replies.get(reply_key)
+        if reply is None:
+            img_datas, img_array = self._controller.seekImageArray(
+                query_df,
+                seek_time,
+                hdr_index,
+                normalize,
+                resolution,
+                jpeg,
+                self.camera_settings,
+                correct_radiometric=correct_radiometric,
+                ignore_date_extrinsic=ignore_date_extrinsic,
+                timedelta_threshold=timedelta_threshold
+            )
+
+            #
+            # The array is sent as mat file to save
+            # band width
+            #
+            matfile = dict2buff(
+                dict(img_array=img_array, jpeg=jpeg), codec=codec)
+
+            reply = dict(matfile=matfile, img_data=img_datas[0])
+            self._seek_replies.put(reply_key, reply)
 
         #
         # Send reply on next ioloop cycle.
-        # The array is sent as mat file to save
-        # band width
         #
-        matfile = dict2buff(dict(img_array=img_array, jpeg=jpeg))
-
-        raise gen.Return(((), dict(matfile=matfile, img_data=img_datas[0])))
+        raise gen.Return(((), dict(reply)))
 
     @gen.coroutine
     def handle_sprinkler(self, period):
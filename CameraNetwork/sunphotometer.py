@@ -34,6 +34,9 @@
 ## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 ## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
 from __future__ import division, print_function, absolute_import
+from CameraNetwork.image_utils import arrayHash
+from CameraNetwork.image_utils import RemapTable
+from CameraNetwork.utils import LRUCache
 import cv2
 import datetime
 from dateutil import parser
@@ -145,6 +148,30 @@ def parseSunPhotoMeter(path):
     return df
 
 
+#
+# Value of samples outside the image.
+#
+BORDER_MAP_VALUE = 100000
+
+#
+# Remap tables of the sampling coords (keyed by the hash of the coords).
+# The same coords are sampled repeatedly, e.g. once per color channel.
+#
+_SAMPLING_TABLES = LRUCache(max_items=16)
+
+
+def samplingTable(coords):
+    """Get the (cached) remap table of sampling coords."""
+
+    key = arrayHash(coords)
+    table = _SAMPLING_TABLES.get(key)
+    if table is None:
+        table = RemapTable(coords[0], coords[1], border_value=BORDER_MAP_VALUE)
+        _SAMPLING_TABLES.put(key, table)
+
+    return table
+
+
 def findClosestImageTime(images_df, timestamp, hdr='2'):
     """Find the image taken closest to a given time stamp."""
 
@@ -175,34 +202,15 @@ def sampleImage(img, img_data, almucantar_angles=None, principleplane_angles=Non
             almucantar_angles=almucantar_angles,
             principleplane_angles=principleplane_angles)
 
-    img = np.ascontiguousarray(img)
-
     #
-    # Sample the Almucantar angles.
+    # Sample the Almucantar and PrinciplePlane angles.
+    # Note:
+    # Samples outside the image get the BORDER_MAP_VALUE.
     #
-    BORDER_MAP_VALUE = 100000
-    almucantar_samples = cv2.remap(
-        img.astype(np.float),
-        Almucantar_coords[0].astype(np.float32),
-        Almucantar_coords[1].astype(np.float32),
-        cv2.INTER_AREA,
-        borderMode=cv2.BORDER_CONSTANT,
-        borderValue=BORDER_MAP_VALUE
-    )
-    almucantar_samples = np.squeeze(almucantar_samples)
-
-    # Sample the PrinciplePlane angles.
-    #
-    BORDER_MAP_VALUE = 100000
-    principalplane_samples = cv2.remap(
-        img.astype(np.float),
-        PrincipalPlane_coords[0].astype(np.float32),
-        PrincipalPlane_coords[1].astype(np.float32),
-        cv2.INTER_AREA,
-        borderMode=cv2.BORDER_CONSTANT,
-        borderValue=BORDER_MAP_VALUE
-    )
-    principalplane_samples = np.squeeze(principalplane_samples)
+    img = np.ascontiguousarray(img, dtype=np.float32)
+    almucantar_samples = np.squeeze(samplingTable(Almucantar_coords).remap(img))
+    principalplane_samples = np.squeeze(
+        samplingTable(PrincipalPlane_coords).remap(img))
 
     return almucantar_samples, almucantar_angles, Almucantar_coords, \
            principalplane_samples, principleplane_angles, PrincipalPlane_coords
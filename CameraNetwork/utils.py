@@ -37,8 +37,15 @@
 # coding: utf-8
 
 from __future__ import division
+from CameraNetwork.archive import archiveRef
+from CameraNetwork.archive import DayArchive
+from CameraNetwork.archive import openDayArchive
+from CameraNetwork.catalog import getCatalog
+from CameraNetwork.compression import decodeBuffer
+from CameraNetwork.compression import encodeBuffer
 import CameraNetwork.global_settings as gs
 from CameraNetwork.transformation_matrices import euler_matrix
+from collections import OrderedDict
 import copy
 import cPickle
 from datetime import datetime
@@ -46,6 +53,7 @@ from datetime import timedelta
 import ephem
 import functools
 import glob
+import hashlib
 import json
 import random
 import logging
@@ -60,6 +68,7 @@ from sklearn.base import BaseEstimator
 from sklearn import linear_model
 import StringIO
 import subprocess
+import threading
 from tornado import gen
 from tornado.ioloop import PollIOLoop
 import traceback
@@ -68,6 +77,9 @@ from zmq.eventloop.ioloop import ZMQIOLoop
 
 __all__ = [
     'DataObj',
+    'ImagesDFCache',
+    'LRUCache',
+    'SpillCache',
     'sync_time',
     'save_camera_data',
     'load_camera_data',
@@ -116,6 +128,269 @@ class DataObj(object):
         self.__dict__.update(kwds)
 
 
+def _nbytes(value):
+    """Estimate the memory size of a cached value."""
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+
+    return 0
+
+
+class LRUCache(object):
+    """A thread safe least recently used cache.
+
+    Args:
+        max_items (int, optional): Maximal number of items. None means no
+            limit.
+        max_bytes (int, optional): Maximal memory (as estimated by sizeof)
+            of the cached values. None means no limit.
+        sizeof (callable, optional): Estimates the memory of a value.
+            Defaults to the size of arrays/strings (and containers of these).
+
+    Note:
+        The cached values are shared. Cache arrays as read only if they
+        should not be modified by the users of the cache.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None):
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof if sizeof is not None else _nbytes
+
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Get a cached value (marking it as recently used)."""
+
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache a value, evicting least recently used values if needed."""
+
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                #
+                # Too big to be cached.
+                #
+                return
+
+            self._items[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+
+    def _evict(self):
+
+        while self._items and (
+                (self.max_items is not None and len(self._items) > self.max_items) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, size) = self._items.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a cached value."""
+
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+
+            self.nbytes -= size
+            return value
+
+    def keys(self):
+
+        with self._lock:
+            return list(self._items.keys())
+
+    def clear(self):
+
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+
+        return len(self._items)
+
+    @property
+    def stats(self):
+        """Hit/miss counters and memory of the cache."""
+
+        with self._lock:
+            return dict(
+                items=len(self._items),
+                nbytes=self.nbytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions
+            )
+
+
+class SpillCache(object):
+    """A least recently used cache that can spill its values to disk.
+
+    Values are kept in memory (an `LRUCache`) and, optionally, pickled to
+    a folder so that they survive a restart.
+
+    Args:
+        max_bytes (int): Memory budget of the cached values.
+        spill_path (str, optional): Folder of the spilled values. None
+            disables spilling.
+        spill_max_bytes (int, optional): Disk budget of the spilled values.
+            Least recently used files are removed first.
+
+    Note:
+        The spilled file of a key is named by the hash of its repr, so keys
+        should be tuples of simple values (strings, numbers, bools).
+    """
+
+    def __init__(self, max_bytes, spill_path=None, spill_max_bytes=None):
+
+        self._memory = LRUCache(max_bytes=max_bytes)
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_writes = 0
+
+    def _path(self, key):
+
+        return os.path.join(
+            self.spill_path, "{}.pkl".format(hashlib.sha1(repr(key)).hexdigest()))
+
+    def get(self, key, default=None):
+        """Get a cached value (from memory or disk)."""
+
+        value = self._memory.get(key)
+        if value is not None:
+            return value
+
+        if self.spill_path is None:
+            return default
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return default
+
+        try:
+            with open(path, 'rb') as f:
+                stored_key, value = cPickle.load(f)
+
+            #
+            # Mark the file as recently used.
+            #
+            os.utime(path, None)
+        except Exception:
+            logging.error("Failed loading spilled value {}:\n{}".format(
+                path, traceback.format_exc()))
+            return default
+
+        if stored_key != key:
+            return default
+
+        with self._lock:
+            self.disk_hits += 1
+        self._memory.put(key, value)
+
+        return value
+
+    def put(self, key, value):
+        """Cache a value (and spill it to disk)."""
+
+        self._memory.put(key, value)
+
+        if self.spill_path is None:
+            return
+
+        try:
+            if not os.path.isdir(self.spill_path):
+                os.makedirs(self.spill_path)
+
+            path = self._path(key)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump((key, value), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+
+            with self._lock:
+                self.disk_writes += 1
+                self._prune()
+        except Exception:
+            logging.error("Failed spilling value to {}:\n{}".format(
+                self.spill_path, traceback.format_exc()))
+
+    def _prune(self):
+        """Remove least recently used files above the disk budget."""
+
+        if self.spill_max_bytes is None:
+            return
+
+        files = []
+        for path in glob.glob(os.path.join(self.spill_path, "*.pkl")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+
+        nbytes = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if nbytes <= self.spill_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            nbytes -= size
+
+    @property
+    def stats(self):
+        """Hit/miss counters and memory of the cache."""
+
+        stats = self._memory.stats
+        stats.update(disk_hits=self.disk_hits, disk_writes=self.disk_writes)
+
+        return stats
+
+
 def name_time(time_object=None):
     """Create path names form datetime object."""
 
@@ -719,19 +994,31 @@ def mean_with_outliers(data, thresh_ratio=2):
     return mean, indices
 
 
-def dict2buff(d, do_compression=True):
-    """Saves a dict as mat file in a string buffer."""
+def dict2buff(d, do_compression=True, codec=None):
+    """Saves a dict as mat file in a string buffer.
+
+    Args:
+        d (dict): The dict to save.
+        do_compression (bool, optional): Compress the buffer.
+        codec (Codec or spec, optional): Codec used for compressing the
+            buffer (see `compression.Codec`). None means the mat file
+            (zlib) compression.
+    """
 
     f = StringIO.StringIO()
-    sio.savemat(f, d, do_compression=do_compression)
+    if codec is None or not do_compression:
+        sio.savemat(f, d, do_compression=do_compression)
+        return f.getvalue()
+
+    sio.savemat(f, d, do_compression=False)
 
-    return f.getvalue()
+    return encodeBuffer(f.getvalue(), codec)
 
 
 def buff2dict(buff):
     """Convert a mat file in the form of a string buffer to a dict."""
 
-    f = StringIO.StringIO(buff)
+    f = StringIO.StringIO(decodeBuffer(buff))
     d = sio.loadmat(f)
 
     return d
@@ -810,6 +1097,14 @@ def getImagesDF(query_date, force=False):
 
     Returns:
         Database of images in the form of a pandas dataframe.
+
+    Note:
+        Frames stored in the day archive are listed with an archive
+        reference in the ``path`` column.
+        Days that are complete in the capture catalog (and whose folder
+        holds the number of frames cataloged) are returned from the
+        catalog. Other days are indexed from the day folder and added to
+        the catalog.
     """
 
     base_path = os.path.join(
@@ -818,20 +1113,53 @@ def getImagesDF(query_date, force=False):
     if not os.path.isdir(base_path):
         raise Exception('Non existing day: {}'.format(base_path))
 
-    image_list = sorted(glob.glob(os.path.join(base_path, '*.mat')))
+    #
+    # Note:
+    # The count of frames added to the catalog is taken before listing
+    # the folder, so that frames saved meanwhile are detected (see
+    # `CaptureCatalog.indexDay`).
+    #
+    try:
+        catalog = getCatalog()
+        adds_count = catalog.addsCount(query_date)
+    except Exception:
+        logging.error("Failed opening the capture catalog:\n{}".format(
+            traceback.format_exc()))
+        catalog = None
+        adds_count = None
+
+    image_list, archive, frames_num = _dayFrames(base_path)
+
+    if catalog is not None and not force:
+        try:
+            if catalog.hasDay(query_date, frames_num):
+                return catalog.query(query_date)
+        except Exception:
+            logging.error("Failed querying the capture catalog:\n{}".format(
+                traceback.format_exc()))
+            catalog = None
+
+    archive_df = None if archive is None else archive.index
 
     #
     # Check if there is a valid database.
+    # Note:
+    # The database stores the number of frames it was created from (before
+    # removing duplicates), e.g. a converted day might keep its mat files
+    # also in the archive. Old databases (a bare dataframe) are recreated.
     #
     database_path = os.path.join(base_path, "database.pkl")
     if os.path.exists(database_path) and not force:
-        df = pd.read_pickle(database_path)
+        database = pd.read_pickle(database_path)
 
-        if df.shape[0] == len(image_list):
+        if isinstance(database, dict) and database['frames_num'] == frames_num:
+            df = database['images_df']
+            _catalogDay(catalog, query_date, df, frames_num, adds_count)
             return df
 
     datetimes = []
     hdrs = []
+    paths = []
     alts = []
     lons = []
     lats = []
@@ -845,6 +1173,7 @@ def getImagesDF(query_date, force=False):
         tmp_parts = os.path.split(path)[-1].split('_')
         datetimes.append(datetime(*[int(i) for i in tmp_parts[1:-1]]))
         hdrs.append(tmp_parts[-1])
+        paths.append(image_path)
 
         try:
             with open("{}.pkl".format(path), "rb") as f:
@@ -863,11 +1192,24 @@ def getImagesDF(query_date, force=False):
             lats.append(None)
             sns.append(None)
 
+    if archive_df is not None:
+        #
+        # Add the archived frames.
+        #
+        datetimes.extend(archive_df['Time'].tolist())
+        hdrs.extend(archive_df['hdr'].tolist())
+        paths.extend(
+            [archiveRef(archive.frames_path, c) for c in archive_df['chunk']])
+        alts.extend(archive_df['altitude'].tolist())
+        lons.extend(archive_df['longitude'].tolist())
+        lats.extend(archive_df['latitude'].tolist())
+        sns.extend(archive_df['serial_num'].tolist())
+
     new_df = pd.DataFrame(
         data=dict(
             Time=datetimes,
             hdr=hdrs,
-            path=image_list,
+            path=paths,
             longitude=lons,
             latitude=lats,
             altitude=alts,
@@ -882,16 +1224,254 @@ def getImagesDF(query_date, force=False):
     # by changing settings of the camera.
     #
     new_df = new_df.reset_index().drop_duplicates(
-        subset=['Time', 'hdr'], keep='last').set_index(['Time', 'hdr'])
+        subset=['Time', 'hdr'], keep='last').set_index(['Time', 'hdr']).sort_index()
 
     #
     # Save the new database
     #
-    pd.to_pickle(new_df, database_path)
+    pd.to_pickle(dict(frames_num=frames_num, images_df=new_df), database_path)
+    _catalogDay(catalog, query_date, new_df, frames_num, adds_count)
 
     return new_df
 
 
+def _dayFrames(base_path):
+    """List the frames saved in a day folder.
+
+    Returns:
+        List of mat files, the day archive (or None) and the number of
+        frames (mat files and archived frames).
+    """
+
+    image_list = sorted(glob.glob(os.path.join(base_path, '*.mat')))
+
+    archive = None
+    frames_num = len(image_list)
+    if DayArchive.exists(base_path):
+        archive = openDayArchive(base_path)
+        frames_num += len(archive)
+
+    return image_list, archive, frames_num
+
+
+def _catalogDay(catalog, query_date, images_df, frames_num, adds_count):
+    """Add an indexed day to the capture catalog."""
+
+    if catalog is None:
+        return
+
+    try:
+        catalog.indexDay(query_date, images_df, frames_num, adds_count)
+    except Exception:
+        logging.error("Failed cataloging day {}:\n{}".format(
+            query_date, traceback.format_exc()))
+
+
+def getImagesRangeDF(start_date, end_date, force=False):
+    """Get dataframe of images captured in a range of days.
+
+    Args:
+        start_date (datetime object): First day to query.
+        end_date (datetime object): Last day (inclusive) to query.
+        force (bool, optional): Force the recreation of the databases.
+
+    Returns:
+        Database of images in the form of a pandas dataframe.
+
+    Note:
+        Days that are not complete in the capture catalog are first indexed
+        from their day folders, then the range is queried in one go.
+    """
+
+    start_date = datetime(start_date.year, start_date.month, start_date.day)
+    end_date = datetime(end_date.year, end_date.month, end_date.day)
+    if end_date < start_date:
+        raise ValueError("End date {} precedes start date {}".format(
+            end_date, start_date))
+
+    catalog = getCatalog()
+
+    day = start_date
+    while day <= end_date:
+        base_path = os.path.join(gs.CAPTURE_PATH, day.strftime("%Y_%m_%d"))
+        if os.path.isdir(base_path) and \
+                (force or not catalog.hasDay(day, _dayFrames(base_path)[2])):
+            getImagesDF(day, force=force)
+        day += timedelta(days=1)
+
+    return catalog.query(start_date, end_date)
+
+
+class ImagesDFCache(object):
+    """In memory LRU of per day images dataframes.
+
+    Repeated queries of a day are served from memory. The index of a day
+    that is being captured ("live" day) is updated incrementally from the
+    saved frames (see `addFrame`). Other days are invalidated when the
+    modification time of their folder changes.
+
+    Args:
+        max_days (int, optional): Number of days to keep.
+    """
+
+    def __init__(self, max_days=8):
+
+        self._cache = LRUCache(max_items=max_days)
+        self._lock = threading.RLock()
+
+        #
+        # Frames added to days that are cached or being loaded, and not
+        # yet merged in their dataframes.
+        #
+        self._pending = {}
+        self._loading = set()
+        self._live = set()
+        self._invalidations = 0
+
+    def get(self, query_date, force=False):
+        """Get the images dataframe of a day.
+
+        Args:
+            query_date (datetime object): Day to query.
+            force (bool, optional): Force the recreation of the database.
+
+        Returns:
+            Database of images in the form of a pandas dataframe (see
+            `getImagesDF`). The dataframe is shared and should not be
+            modified.
+        """
+
+        day = query_date.strftime("%Y_%m_%d")
+        day_path = os.path.join(gs.CAPTURE_PATH, day)
+
+        with self._lock:
+            entry = None if force else self._cache.get(day)
+            if entry is not None:
+                df, mtime = entry
+                if day in self._live or self._mtime(day_path) == mtime:
+                    return self._merge(day, df, mtime)
+
+                self._cache.pop(day)
+                self._invalidations += 1
+
+            self._loading.add(day)
+            self._pending.setdefault(day, [])
+
+        try:
+            #
+            # Note:
+            # The mtime is taken after the query, as the query might update
+            # the database file in the day folder.
+            #
+            df = getImagesDF(query_date, force=force)
+            mtime = self._mtime(day_path)
+        except:
+            with self._lock:
+                self._loading.discard(day)
+                self._pending.pop(day, None)
+            raise
+
+        with self._lock:
+            self._loading.discard(day)
+            self._cache.put(day, (df, mtime))
+            return self._merge(day, df, mtime)
+
+    def addFrame(self, path, img_data, hdr_i):
+        """Add a saved frame to the index of its day.
+
+        Args:
+            path (str): Path (or archive reference) of the saved frame.
+            img_data (DataObj): Data object of the frame.
+            hdr_i (int): Index of the hdr exposure.
+        """
+
+        name_time = img_data.name_time.replace(microsecond=0)
+        day = name_time.strftime("%Y_%m_%d")
+        camera_info = getattr(img_data, 'camera_info', None) or {}
+        gain_boost = getattr(img_data, 'gain_boost', None)
+
+        row = dict(
+            Time=name_time,
+            hdr=str(hdr_i),
+            path=path,
+            longitude=getattr(img_data, 'longitude', None),
+            latitude=getattr(img_data, 'latitude', None),
+            altitude=getattr(img_data, 'altitude', None),
+            serial_num=camera_info.get('serial_num', None),
+            exposure_us=getattr(img_data, 'exposure_us', None),
+            gain_db=getattr(img_data, 'gain_db', None),
+            gain_boost=None if gain_boost is None else int(gain_boost),
+            color_mode=getattr(img_data, 'color_mode', None)
+        )
+
+        with self._lock:
+            #
+            # Only the day currently captured is live. Previous days are
+            # validated again by the mtime of their folder.
+            #
+            if day not in self._live:
+                self._live = set([day])
+            if day in self._pending:
+                self._pending[day].append(row)
+
+    def invalidate(self, query_date=None):
+        """Drop a day (or all days) from the cache."""
+
+        with self._lock:
+            if query_date is None:
+                self._cache.clear()
+                self._pending.clear()
+                self._live.clear()
+            else:
+                day = query_date.strftime("%Y_%m_%d")
+                self._cache.pop(day)
+                self._pending.pop(day, None)
+                self._live.discard(day)
+            self._invalidations += 1
+
+    @property
+    def stats(self):
+        """Statistics of the cache."""
+
+        with self._lock:
+            stats = self._cache.stats
+            stats.update(
+                live_days=len(self._live), invalidations=self._invalidations)
+            return stats
+
+    @staticmethod
+    def _mtime(day_path):
+        try:
+            return os.path.getmtime(day_path)
+        except OSError:
+            return None
+
+    def _merge(self, day, df, mtime):
+        """Merge the pending frames of a day in its dataframe (lock held)."""
+
+        #
+        # Keep collecting frames only for cached days.
+        #
+        for pending_day in list(self._pending):
+            if pending_day not in self._loading and pending_day not in self._cache:
+                del self._pending[pending_day]
+
+        rows = self._pending.get(day)
+        if not rows:
+            return df
+
+        new_df = pd.DataFrame.from_records(rows).set_index(['Time', 'hdr'])
+        new_df = new_df.reindex(columns=df.columns)
+
+        df = pd.concat((df, new_df))
+        df = df[~df.index.duplicated(keep='last')].sort_index()
+
+        self._pending[day] = []
+        self._cache.put(day, (df, mtime))
+
+        return df
+
+
 class PuritanicalIOLoop(ZMQIOLoop):
     """A loop that quits when it encounters an Exception.
     """
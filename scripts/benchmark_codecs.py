@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+##
+## Copyright (C) 2017, Amit Aides, all rights reserved.
+## 
+## This file is part of Camera Network
+## (see https://bitbucket.org/amitibo/cameranetwork_git).
+## 
+## Redistribution and use in source and binary forms, with or without modification,
+## are permitted provided that the following conditions are met:
+## 
+## 1)  The software is provided under the terms of this license strictly for
+##     academic, non-commercial, not-for-profit purposes.
+## 2)  Redistributions of source code must retain the above copyright notice, this
+##     list of conditions (license) and the following disclaimer.
+## 3)  Redistributions in binary form must reproduce the above copyright notice,
+##     this list of conditions (license) and the following disclaimer in the
+##     documentation and/or other materials provided with the distribution.
+## 4)  The name of the author may not be used to endorse or promote products derived
+##     from this software without specific prior written permission.
+## 5)  As this software depends on other libraries, the user must adhere to and keep
+##     in place any licensing terms of those libraries.
+## 6)  Any publications arising from the use of this software, including but not
+##     limited to academic journal and conference publications, technical reports and
+##     manuals, must cite the following works:
+##     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis, "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+## 
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+## WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+## MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+## EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+## BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+## DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+## LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
+"""
+Benchmark the compression codecs on captured frames.
+
+The script loads frames stored in ``CAPTURE_PATH`` (the latest day by
+default) and measures, for every codec, the compression ratio and the
+encode/decode throughput. Use the results to choose the ``storage_codec``
+and ``wire_codec`` capture settings of the camera.
+
+Codecs are given as ``name[:level][:filter+filter]``, e.g.
+``zlib:1:delta+shuffle``.
+"""
+
+from __future__ import division, print_function
+import argparse
+from CameraNetwork.archive import isArchiveRef
+from CameraNetwork.archive import loadArchivedFrame
+from CameraNetwork.compression import Codec
+from CameraNetwork.compression import loadArray
+import CameraNetwork.global_settings as gs
+from CameraNetwork.utils import getImagesDF
+from datetime import datetime
+import glob
+import numpy as np
+import os
+import time
+
+DEFAULT_CODECS = (
+    'raw',
+    'zlib:1',
+    'zlib:6',
+    'zlib:1:delta',
+    'zlib:1:delta+shuffle',
+    'zlib:6:delta+shuffle',
+    'bz2:9',
+    'bz2:9:delta',
+    'lzma:0',
+    'lzma:6',
+)
+
+
+def loadFrames(day, frames_num):
+    """Load stored frames (as stored, i.e. not expanded) of a day."""
+
+    if day is None:
+        days_paths = sorted(
+            p for p in glob.glob(os.path.join(gs.CAPTURE_PATH, "*")) if os.path.isdir(p))
+        if not days_paths:
+            raise Exception("No captured days in {}".format(gs.CAPTURE_PATH))
+        day_path = days_paths[-1]
+    else:
+        day_path = os.path.join(gs.CAPTURE_PATH, day)
+
+    df = getImagesDF(datetime.strptime(os.path.basename(day_path), "%Y_%m_%d"))
+    paths = df['path'].values
+    if len(paths) > frames_num:
+        paths = paths[np.linspace(0, len(paths)-1, frames_num).astype(np.int)]
+
+    frames = []
+    for path in paths:
+        if isArchiveRef(path):
+            img_array, _ = loadArchivedFrame(path)
+        else:
+            img_array = loadArray(path)
+        frames.append(np.ascontiguousarray(img_array))
+
+    return day_path, frames
+
+
+def benchmark(codec, frames, repeats):
+    """Measure ratio and encode/decode throughput (MB/s) of a codec."""
+
+    raw_bytes = sum(f.nbytes for f in frames) * repeats
+    enc_bytes = 0
+    enc_time = dec_time = 0.
+    for _ in range(repeats):
+        for frame in frames:
+            t0 = time.time()
+            data = codec.encodeArray(frame)
+            t1 = time.time()
+            decoded = codec.decodeArray(data, frame.shape, frame.dtype)
+            t2 = time.time()
+
+            assert np.array_equal(decoded, frame), "Codec {} is lossy".format(codec)
+
+            enc_bytes += len(data)
+            enc_time += t1 - t0
+            dec_time += t2 - t1
+
+    return (
+        raw_bytes / enc_bytes,
+        raw_bytes / 2**20 / enc_time,
+        raw_bytes / 2**20 / dec_time
+    )
+
+
+def main(codecs, day=None, frames_num=10, repeats=1, local_path=None):
+
+    gs.initPaths(local_path)
+
+    day_path, frames = loadFrames(day, frames_num)
+    print("Day: {}, frames: {}, dtype: {}, shape: {}".format(
+        day_path, len(frames), frames[0].dtype, frames[0].shape))
+
+    print("{:<24}{:>8}{:>14}{:>14}".format("codec", "ratio", "enc [MB/s]", "dec [MB/s]"))
+    for spec in codecs:
+        try:
+            codec = Codec.fromSpec(spec)
+            ratio, enc_speed, dec_speed = benchmark(codec, frames, repeats)
+        except Exception as e:
+            print("{:<24}{}".format(spec, e))
+            continue
+
+        print("{:<24}{:>8.2f}{:>14.1f}{:>14.1f}".format(
+            repr(codec), ratio, enc_speed, dec_speed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compression codecs.")
+    parser.add_argument(
+        'codecs',
+        nargs='*',
+        default=DEFAULT_CODECS,
+        help='Codecs to benchmark (name[:level][:filters]).'
+    )
+    parser.add_argument(
+        '--day',
+        type=str,
+        default=None,
+        help='Day to load frames from (YYYY_MM_DD). Defaults to the latest day.'
+    )
+    parser.add_argument(
+        '--frames',
+        type=int,
+        default=10,
+        help='Number of frames to benchmark.'
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=1,
+        help='Number of repeats per frame.'
+    )
+    parser.add_argument(
+        '--local_path',
+        type=str,
+        default=None,
+        help='Home path of the captured data (defaults to the user home).'
+    )
+    args = parser.parse_args()
+
+    main(args.codecs, args.day, args.frames, args.repeats, args.local_path)
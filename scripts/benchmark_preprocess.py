@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+##
+## Copyright (C) 2017, Amit Aides, all rights reserved.
+## 
+## This file is part of Camera Network
+## (see https://bitbucket.org/amitibo/cameranetwork_git).
+## 
+## Redistribution and use in source and binary forms, with or without modification,
+## are permitted provided that the following conditions are met:
+## 
+## 1)  The software is provided under the terms of this license strictly for
+##     academic, non-commercial, not-for-profit purposes.
+## 2)  Redistributions of source code must retain the above copyright notice, this
+##     list of conditions (license) and the following disclaimer.
+## 3)  Redistributions in binary form must reproduce the above copyright notice,
+##     this list of conditions (license) and the following disclaimer in the
+##     documentation and/or other materials provided with the distribution.
+## 4)  The name of the author may not be used to endorse or promote products derived
+##     from this software without specific prior written permission.
+## 5)  As this software depends on other libraries, the user must adhere to and keep
+##     in place any licensing terms of those libraries.
+## 6)  Any publications arising from the use of this software, including but not
+##     limited to academic journal and conference publications, technical reports and
+##     manuals, must cite the following works:
+##     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis, "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+## 
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+## WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+## MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+## EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+## BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+## DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+## LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
+"""
+Benchmark the preprocessing of raw frames.
+
+Compares the fused float32 preprocessing (`RawPreprocessor`) with the
+previous float64 path (dark subtraction, clamping, exposure scaling,
+vignetting and radiometric correction done as separate steps) on
+synthetic 1200x1600 Bayer frames. The dark model and the calibration are
+loaded from the home path if available, otherwise synthetic ones are used.
+"""
+
+from __future__ import division, print_function
+import argparse
+from CameraNetwork.calibration import DarkCalibration
+from CameraNetwork.calibration import RadiometricCalibration
+from CameraNetwork.calibration import RawPreprocessor
+from CameraNetwork.calibration import VignettingCalibration
+import CameraNetwork.global_settings as gs
+from CameraNetwork.image_utils import raw2RGB
+from CameraNetwork.utils import DataObj
+import numpy as np
+import time
+
+SHAPE = (1200, 1600)
+
+
+def loadCalibration():
+    """Load the calibration of the camera or create synthetic one."""
+
+    dark = DarkCalibration.load(gs.DARK_IMAGES_PATH)
+    if dark is None:
+        offsets = {
+            gb: np.random.uniform(0, 4, SHAPE).astype(np.float32) for gb in (False, True)}
+        slopes = {
+            gb: np.random.uniform(0, 1e-6, SHAPE).astype(np.float32) for gb in (False, True)}
+        dark = DarkCalibration(offsets, slopes)
+
+    try:
+        vignetting = VignettingCalibration.load(gs.VIGNETTING_SETTINGS_PATH)
+    except:
+        vignetting = VignettingCalibration()
+        vignetting._ratio = np.random.uniform(0.1, 1, SHAPE).astype(np.float32)
+
+    try:
+        radiometric = RadiometricCalibration.load(gs.RADIOMETRIC_SETTINGS_PATH)
+    except:
+        radiometric = RadiometricCalibration(gs.DEFAULT_RADIOMETRIC_SETTINGS)
+
+    return dark, vignetting, radiometric
+
+
+def legacyPreprocess(img, img_data, dark, vignetting, radiometric):
+    """The previous (float64) preprocessing path."""
+
+    dark_image = dark.darkFrame(img_data.gain_boost, img_data.exposure_us).astype(np.float)
+    img = img.astype(np.float) - dark_image
+    img[img < 0] = 0
+    img = img.astype(np.float) / (img_data.exposure_us / 1000)
+    img = img / vignetting.ratio.astype(np.float)
+
+    return radiometric.applyRadiometric(np.dstack(raw2RGB(img))).astype(np.float32)
+
+
+def fusedPreprocess(img, img_data, preprocessor):
+    """The fused (float32) preprocessing path."""
+
+    img = preprocessor.process([img], [img_data], reuse_buffer=True)
+
+    return np.dstack(raw2RGB(img))
+
+
+def timeit(func, repeats):
+
+    t0 = time.time()
+    for _ in range(repeats):
+        result = func()
+
+    return (time.time() - t0) / repeats, result
+
+
+def main(repeats=20, local_path=None):
+
+    gs.initPaths(local_path)
+
+    dark, vignetting, radiometric = loadCalibration()
+    preprocessor = RawPreprocessor(dark, vignetting, radiometric)
+
+    img = np.random.randint(0, 256, size=SHAPE).astype(np.uint8)
+    img_data = DataObj(exposure_us=50000, gain_boost=False)
+
+    #
+    # Warm the caches (dark frame and gain plane) of both paths.
+    #
+    legacyPreprocess(img, img_data, dark, vignetting, radiometric)
+    fusedPreprocess(img, img_data, preprocessor)
+
+    legacy_time, legacy_img = timeit(
+        lambda: legacyPreprocess(img, img_data, dark, vignetting, radiometric), repeats)
+    fused_time, fused_img = timeit(
+        lambda: fusedPreprocess(img, img_data, preprocessor), repeats)
+
+    print("Frame: {}, repeats: {}".format(SHAPE, repeats))
+    print("{:<10}{:>12}".format("path", "time [ms]"))
+    print("{:<10}{:>12.2f}".format("legacy", legacy_time * 1000))
+    print("{:<10}{:>12.2f}".format("fused", fused_time * 1000))
+    print("Speedup: {:.2f}, max relative error: {:.2e}".format(
+        legacy_time / fused_time,
+        np.abs(fused_img - legacy_img).max() / max(np.abs(legacy_img).max(), 1e-12)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark raw frames preprocessing.")
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=20,
+        help='Number of repeats.'
+    )
+    parser.add_argument(
+        '--local_path',
+        type=str,
+        default=None,
+        help='Home path of the calibration data (defaults to the user home).'
+    )
+    args = parser.parse_args()
+
+    main(args.repeats, args.local_path)
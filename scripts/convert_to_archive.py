@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+##
+## Copyright (C) 2017, Amit Aides, all rights reserved.
+## 
+## This file is part of Camera Network
+## (see https://bitbucket.org/amitibo/cameranetwork_git).
+## 
+## Redistribution and use in source and binary forms, with or without modification,
+## are permitted provided that the following conditions are met:
+## 
+## 1)  The software is provided under the terms of this license strictly for
+##     academic, non-commercial, not-for-profit purposes.
+## 2)  Redistributions of source code must retain the above copyright notice, this
+##     list of conditions (license) and the following disclaimer.
+## 3)  Redistributions in binary form must reproduce the above copyright notice,
+##     this list of conditions (license) and the following disclaimer in the
+##     documentation and/or other materials provided with the distribution.
+## 4)  The name of the author may not be used to endorse or promote products derived
+##     from this software without specific prior written permission.
+## 5)  As this software depends on other libraries, the user must adhere to and keep
+##     in place any licensing terms of those libraries.
+## 6)  Any publications arising from the use of this software, including but not
+##     limited to academic journal and conference publications, technical reports and
+##     manuals, must cite the following works:
+##     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis, "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+## 
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+## WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+## MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+## EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+## BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+## DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+## LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
+"""
+Convert captured days to the per day archive format.
+
+The script migrates the mat/jpg/pkl triplets stored in the
+``CAPTURE_PATH/YYYY_MM_DD`` folders to a single frames archive per day.
+By default all days are converted. Use the ``--remove`` flag to delete the
+converted mat and pkl files (the jpg thumbnails are kept).
+"""
+
+import argparse
+from CameraNetwork.archive import convertDay
+import CameraNetwork.global_settings as gs
+import glob
+import os
+
+
+def main(days=None, remove_files=False, local_path=None):
+
+    gs.initPaths(local_path)
+
+    if not days:
+        days_paths = sorted(glob.glob(os.path.join(gs.CAPTURE_PATH, "*")))
+    else:
+        days_paths = [os.path.join(gs.CAPTURE_PATH, day) for day in days]
+
+    for day_path in days_paths:
+        if not os.path.isdir(day_path):
+            print("Skipping non existing day: {}".format(day_path))
+            continue
+
+        print("Converting day: {}".format(day_path))
+        converted = convertDay(day_path, remove_files=remove_files)
+        print("Archived {} frames.".format(converted))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert captured days to archives.")
+    parser.add_argument(
+        'days',
+        nargs='*',
+        help='Days to convert (YYYY_MM_DD). Defaults to all days.'
+    )
+    parser.add_argument(
+        '--remove',
+        action='store_true',
+        help='When set, the converted mat and pkl files will be deleted.'
+    )
+    parser.add_argument(
+        '--local_path',
+        type=str,
+        default=None,
+        help='Home path of the captured data (defaults to the user home).'
+    )
+    args = parser.parse_args()
+
+    main(args.days, args.remove, args.local_path)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+##
+## Copyright (C) 2017, Amit Aides, all rights reserved.
+## 
+## This file is part of Camera Network
+## (see https://bitbucket.org/amitibo/cameranetwork_git).
+## 
+## Redistribution and use in source and binary forms, with or without modification,
+## are permitted provided that the following conditions are met:
+## 
+## 1)  The software is provided under the terms of this license strictly for
+##     academic, non-commercial, not-for-profit purposes.
+## 2)  Redistributions of source code must retain the above copyright notice, this
+##     list of conditions (license) and the following disclaimer.
+## 3)  Redistributions in binary form must reproduce the above copyright notice,
+##     this list of conditions (license) and the following disclaimer in the
+##     documentation and/or other materials provided with the distribution.
+## 4)  The name of the author may not be used to endorse or promote products derived
+##     from this software without specific prior written permission.
+## 5)  As this software depends on other libraries, the user must adhere to and keep
+##     in place any licensing terms of those libraries.
+## 6)  Any publications arising from the use of this software, including but not
+##     limited to academic journal and conference publications, technical reports and
+##     manuals, must cite the following works:
+##     Dmitry Veikherman, Amit Aides, Yoav Y. Schechner and Aviad Levis, "Clouds in The Cloud" Proc. ACCV, pp. 659-674 (2014).
+## 
+## THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+## WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+## MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+## EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+## INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+## BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+## DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+## LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+## OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.##
+"""
+Reprocess captured days to normalized radiance images.
+
+The frames of each capture are dark subtracted, merged (HDR), corrected for
+vignetting and radiometric response and normalized, using a pool of worker
+processes. The results are stored per day in a chunked archive under
+``<output_path>/<resolution>/YYYY_MM_DD``. Rerunning the script resumes
+from where it stopped.
+"""
+
+import argparse
+import CameraNetwork.global_settings as gs
+from CameraNetwork.reprocess import HDR_MERGED
+from CameraNetwork.reprocess import reprocessDays
+from CameraNetwork.utils import load_camera_data
+from datetime import datetime
+import logging
+import os
+
+
+def main(
+        start_date,
+        end_date=None,
+        output_path=None,
+        resolution=301,
+        hdr_index=HDR_MERGED,
+        workers=None,
+        local_path=None):
+
+    gs.initPaths(local_path)
+    logging.basicConfig(level=logging.INFO)
+
+    camera_settings = None
+    if os.path.exists(gs.GENERAL_SETTINGS_PATH):
+        camera_settings, _ = load_camera_data(
+            gs.GENERAL_SETTINGS_PATH, gs.CAPTURE_SETTINGS_PATH)
+
+    summary = reprocessDays(
+        datetime.strptime(start_date, "%Y_%m_%d"),
+        datetime.strptime(end_date, "%Y_%m_%d") if end_date else None,
+        output_path=output_path,
+        resolution=resolution,
+        hdr_index=hdr_index,
+        workers=workers,
+        camera_settings=camera_settings
+    )
+
+    print(
+        "Reprocessed {captures} captures ({frames} frames), {failed} failed, "
+        "{skipped} already processed. {frames_per_second:.2f} frames/sec.".format(**summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reprocess captured days.")
+    parser.add_argument(
+        'start_date',
+        help='First day to reprocess (YYYY_MM_DD).'
+    )
+    parser.add_argument(
+        'end_date',
+        nargs='?',
+        default=None,
+        help='Last day to reprocess (YYYY_MM_DD). Defaults to the first day.'
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default=None,
+        help='Base path of the output store (defaults to <home>/reprocessed).'
+    )
+    parser.add_argument(
+        '--resolution',
+        type=int,
+        default=301,
+        help='Resolution of the normalized images.'
+    )
+    parser.add_argument(
+        '--hdr_index',
+        type=int,
+        default=HDR_MERGED,
+        help='Exposure to process. Defaults to merging all exposures (HDR).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes (defaults to the number of cpus).'
+    )
+    parser.add_argument(
+        '--local_path',
+        type=str,
+        default=None,
+        help='Home path of the captured data (defaults to the user home).'
+    )
+    args = parser.parse_args()
+
+    main(
+        args.start_date,
+        args.end_date,
+        args.output_path,
+        args.resolution,
+        args.hdr_index,
+        args.workers,
+        args.local_path
+    )
@@ -42,6 +42,11 @@ from PyQt4 import QtGui
     #QVBoxLayout, QWidget
 #import QtCore.QString.fromUtf8 as asdf
 
+import argparse
+import CameraNetwork.global_settings as gs
+from CameraNetwork.pipeline import ThumbnailStore
+from CameraNetwork.utils import getImagesDF
+from datetime import datetime
 import glob
 import numpy as np
 import os
@@ -65,6 +70,34 @@ def convertMapData(lat, lon, hgt, lat0=32.775776, lon0=35.024963, alt0=229):
     return x, y
 
 
+def loadStoredThumbnails(local_path, day, resolution=101, hdr_index=2, time_period="30T"):
+    """Load the stored (precomputed) thumbnails of a camera.
+
+    Args:
+        local_path (str): Local copy of the home folder of the camera.
+        day (str): The day (YYYY_MM_DD).
+        resolution (int, optional): Resolution of the thumbnails.
+        hdr_index (int, optional): The hdr index of the thumbnails.
+        time_period (string, optional): The sampling period.
+
+    Returns:
+        Thumbnails dataframe (same format as the downloaded thumbnails).
+    """
+
+    gs.initPaths(local_path)
+    query_date = datetime.strptime(day, "%Y_%m_%d")
+
+    store_df = ThumbnailStore.index(query_date)
+    store_df = store_df[
+        (store_df["resolution"] == resolution) & (store_df["hdr"] == str(hdr_index))]
+    store_df = store_df.set_index("Time")[["path"]].rename(columns={"path": "thumbnail"})
+
+    images_df = getImagesDF(query_date).xs(str(hdr_index), level="hdr")
+    df = store_df.join(images_df[["latitude", "longitude"]], how="inner")
+
+    return df.resample(rule=time_period, label="right").last().dropna()
+
+
 class Slider(QtGui.QWidget):
     def __init__(self, maximum, parent=None):
         super(Slider, self).__init__(parent=parent)
@@ -91,7 +124,7 @@ class Slider(QtGui.QWidget):
 class MainWindow(QtGui.QWidget):
     """main widget."""
 
-    def __init__(self, parent=None):
+    def __init__(self, dfs, base_path, parent=None):
         super(MainWindow, self).__init__(parent=parent)
 
         #
@@ -113,9 +146,8 @@ class MainWindow(QtGui.QWidget):
         self.view.setAspectLocked(True)
 
         #
-        # Load the thumbnails dataframes
+        # Load the thumbnails
         #
-        dfs = pd.read_pickle(r"..\ipython\system\thumbnails_downloaded.pkl")
         self.thumbs = {}
         self.image_items = {}
         server_id_list, df_list = [], []
@@ -130,7 +162,7 @@ class MainWindow(QtGui.QWidget):
             index = 0
             for _, row in df.iterrows():
                 try:
-                    images.append(io.imread(os.path.join(r"..\ipython\system", row["thumbnail"])))
+                    images.append(io.imread(os.path.join(base_path, row["thumbnail"])))
                     indices.append(index)
                     index += 1
                 except:
@@ -188,7 +220,43 @@ class MainWindow(QtGui.QWidget):
             image_label.setY(y+120)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Browse the thumbnails of the cameras.")
+    parser.add_argument(
+        '--day',
+        type=str,
+        default=None,
+        help='Browse the stored thumbnails of a day (YYYY_MM_DD) read from the local copies of the cameras.'
+    )
+    parser.add_argument(
+        '--resolution',
+        type=int,
+        default=101,
+        help='Resolution of the stored thumbnails.'
+    )
+    parser.add_argument(
+        'local_paths',
+        nargs='*',
+        help='Local copies of the home folders of the cameras (named by the camera id).'
+    )
+    args = parser.parse_args()
+
+    if args.day is None:
+        #
+        # Thumbnails downloaded from the cameras.
+        #
+        base_path = r"..\ipython\system"
+        dfs = pd.read_pickle(os.path.join(base_path, "thumbnails_downloaded.pkl"))
+    else:
+        #
+        # Thumbnails read directly from the thumbnail store of the cameras.
+        #
+        base_path = ""
+        dfs = {}
+        for local_path in args.local_paths:
+            server_id = os.path.basename(os.path.normpath(local_path))
+            dfs[server_id] = loadStoredThumbnails(local_path, args.day, args.resolution)
+
     app = QtGui.QApplication(sys.argv)
-    w = MainWindow()
+    w = MainWindow(dfs, base_path)
     w.show()
     sys.exit(app.exec_())
\ No newline at end of file